@@ -0,0 +1,2 @@
+from .server import StubServer
+from .suite import Suite, compare, loadbaseline, machine, savebaseline
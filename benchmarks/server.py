@@ -0,0 +1,151 @@
+"""
+Copyright (c) 2016 Olof Montin <olof@thebrewery.se>
+
+This file is part of loadr.
+
+loadr is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+loadr is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with loadr.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import json
+
+from threading import Event, Thread
+
+from util import random_string
+
+
+class StubProtocol(asyncio.Protocol):
+    """Answers every HTTP/1.1 request on a connection with the server's
+    fixed response, after its latency. The connections are kept alive unless
+    the client closes them.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.buffer = b''
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+
+        while True:
+            end = self.buffer.find(b'\r\n\r\n')
+
+            if end < 0:
+                return
+
+            head = self.buffer[:end].lower()
+            length = 0
+            start = head.find(b'content-length:')
+
+            if start >= 0:
+                stop = head.find(b'\r\n', start)
+                length = int(head[start + 15:stop if stop >= 0 else None])
+
+            if len(self.buffer) < end + 4 + length:
+                return
+
+            self.buffer = self.buffer[end + 4 + length:]
+            self.server.requests += 1
+            close = b'connection: close' in head
+
+            if self.server.latency:
+                self.server.loop.call_later(self.server.latency,
+                                            self.respond, close)
+            else:
+                self.respond(close)
+
+    def respond(self, close):
+        if self.transport.is_closing():
+            return
+
+        self.transport.write(self.server.response)
+
+        if close:
+            self.transport.close()
+
+
+class StubServer:
+    """An HTTP server with a fixed response, to benchmark the workers against
+    without the target being the bottleneck. It runs its own event loop in a
+    thread of this process.
+
+    Every response has the same json body, so that request configs can
+    refer to it, like "{{from(0).json.token}}":
+        {"token": <random string>,
+         "id": 1,
+         "payload": <payload x's>}
+
+    Using it:
+        server = StubServer(latency=0.01, payload=1024)
+        server.start()
+        ... send requests to server.url ...
+        server.stop()
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0, payload=0):
+        """
+            host, port = Where to listen, port 0 picks a free port
+            latency = Seconds to wait before each response
+            payload = Number of padding bytes in each response body
+        """
+
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.body = json.dumps({'token': random_string(32),
+                                'id': 1,
+                                'payload': 'x' * payload}).encode()
+        self.response = ('HTTP/1.1 200 OK\r\n'
+                         'Content-Type: application/json\r\n'
+                         'Content-Length: {}\r\n'
+                         '\r\n'.format(len(self.body))).encode() + self.body
+        # Number of answered requests
+        self.requests = 0
+        self.loop = None
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(self.host, self.port)
+
+    def serve(self, started):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(self.loop.create_server(
+            lambda: StubProtocol(self), self.host, self.port))
+        self.port = self.server.sockets[0].getsockname()[1]
+        started.set()
+        self.loop.run_forever()
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
+
+    def start(self):
+        """Starts the server in its own thread, and returns when it's
+        listening.
+        """
+
+        started = Event()
+        self.thread = Thread(target=self.serve, args=(started,), daemon=True)
+        self.thread.start()
+        started.wait()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
@@ -0,0 +1,383 @@
+"""
+Copyright (c) 2016 Olof Montin <olof@thebrewery.se>
+
+This file is part of loadr.
+
+loadr is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+loadr is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with loadr.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import os
+import platform
+
+from multiprocessing import Array, Pipe, Process, Queue
+from resource import RUSAGE_CHILDREN, RUSAGE_SELF, getrusage
+from threading import Event, Thread
+from time import monotonic, time
+
+from benchmarks.server import StubServer
+from providers.localhost import Localhost, RingPool, RingWriter
+from util.thresholds import iserror
+from wrkloadr import (decodebatch, encodebatch, multirepeater,
+                      optiondefaults, processcount)
+
+# Where the baseline is tracked
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'baseline.json')
+# The metrics compared to the baseline, and whether higher is better
+METRICS = {'rps': True, 'cpu': False, 'memory': False}
+
+
+class CountWriter:
+    """An output writer which only counts the data rows and errors, so that
+    it costs as little as possible. The counts are added to a shared Array
+    when it's closed.
+    """
+
+    def __init__(self, counts):
+        self.counts = counts
+        self.rows = 0
+        self.errors = 0
+
+    def wait(self):
+        pass
+
+    def write(self, *data):
+        self.rows += 1
+        self.errors += iserror(data[3])
+
+    def record(self, kind, data):
+        pass
+
+    def close(self):
+        with self.counts.get_lock():
+            self.counts[0] += self.rows
+            self.counts[1] += self.errors
+
+
+def requestconfig(url):
+    """Returns the benchmarked requests cycle: a POST and a GET which refers
+    to the json body of the first response, like a login and a use of its
+    token.
+    """
+
+    return [{'name': 'login',
+             'method': 'POST',
+             'url': url + '/login',
+             'body': {'user': 'loadr'}},
+            {'url': url + "/items/{{from('login').json.token}}",
+             'headers': {
+                 'Authorization': "Bearer {{from('login').json.token}}"}}]
+
+
+def repeaters(concurrency, repeat, config, options):
+    """Runs multirepeater, and returns its rows, errors and processes.
+    """
+
+    counts = Array('q', 2)
+    multirepeater(concurrency, repeat, (CountWriter, counts), config,
+                  dict(options))
+
+    return (counts[0], counts[1],
+            processcount(concurrency, optiondefaults(dict(options))))
+
+
+def localhost(concurrency, repeat, config, options):
+    """Runs the Localhost provider with one shard per core, and returns its
+    rows, errors and processes. The rows are counted as they arrive through
+    the output Queue, like a UI would.
+    """
+
+    output = Queue()
+    provider = Localhost(output)
+    provider.create_instances(0)
+    shards = len(provider.instances)
+    counts = [0, 0]
+    consumer = Thread(target=consume, args=(output, counts))
+    consumer.start()
+    provider.run_multiple_workers(max(1, concurrency // shards), repeat,
+                                  config, dict(options))
+    consumer.join()
+
+    return counts[0], counts[1], shards
+
+
+def consume(output, counts):
+    """Counts the data rows and errors from the output Queue until the
+    Localhost provider has ended.
+    """
+
+    while True:
+        data = output.get()
+
+        if data[0] == 'data':
+            for line in data[2].splitlines():
+                counts[0] += 1
+                counts[1] += iserror(line.split(',')[3])
+        elif data[0] == 'status' and data[2] == 'ended':
+            return
+
+
+def produce(pool, output, rows):
+    """Writes synthetic data rows into a Ring, as fast as it takes them.
+    """
+
+    writer = RingWriter(pool, output, 'localhost-0')
+    now = int(time() * 1000000)
+
+    for i in range(rows):
+        writer.write(i, i % 4, 0, 200, now + i, now + i + 1000)
+
+
+def ringpipeline(rows):
+    """Moves synthetic rows from a producer process through a Ring, the
+    Localhost drain and the output Queue, and returns the rows, errors and
+    processes.
+    """
+
+    output = Queue()
+    provider = Localhost(output)
+    provider.create_instances(1)
+    pool = RingPool(1, provider.ring_size)
+    producer = Process(target=produce, args=(pool, output, rows))
+    stopped = Event()
+    drainer = Thread(target=provider.drain,
+                     args=({'localhost-0': pool}, stopped))
+    counts = [0, 0]
+    consumer = Thread(target=consume, args=(output, counts))
+    consumer.start()
+    drainer.start()
+    producer.start()
+    producer.join()
+    stopped.set()
+    drainer.join()
+    output.put(('status', 'localhost', 'ended'))
+    consumer.join()
+
+    return counts[0], counts[1], 1
+
+
+def batchpipeline(rows, batch_size=1000):
+    """Encodes and decodes synthetic rows in batches, like they're sent by
+    the RabbitWriter and received by the Messenger, and returns the rows,
+    errors and processes.
+    """
+
+    now = int(time() * 1000000)
+    batch = [(i, i % 4, 0, 200, now + i, now + i + 1000)
+             for i in range(batch_size)]
+    count = 0
+
+    for i in range(0, rows, batch_size):
+        count += len(decodebatch(encodebatch(batch)))
+
+    return count, 0, 0
+
+
+def measured(pipe, target, args):
+    """Runs target, within the benchmark process, and sends its counts, wall
+    time and resource usage through pipe.
+    """
+
+    start = monotonic()
+    rows, errors, processes = target(*args)
+    seconds = monotonic() - start
+    own, children = getrusage(RUSAGE_SELF), getrusage(RUSAGE_CHILDREN)
+    pipe.send({'rows': rows,
+               'errors': errors,
+               'processes': processes,
+               'seconds': seconds,
+               'cpu': own.ru_utime + own.ru_stime +
+               children.ru_utime + children.ru_stime,
+               'maxrss': children.ru_maxrss})
+
+
+def measure(target, *args):
+    """Runs target in a process of its own, so that the resource usage of
+    its worker processes, and nothing else, is counted as its children's.
+    """
+
+    receiver, sender = Pipe(False)
+    p = Process(target=measured, args=(sender, target, args))
+    p.start()
+    result = receiver.recv()
+    p.join()
+
+    return result
+
+
+class Suite:
+    """Benchmarks the load generator itself against a StubServer in this
+    process, at increasing concurrency:
+        multirepeater/<engine>/<concurrency> - by each engine
+        localhost/<concurrency> - by the Localhost provider's shards
+        pipeline/ring, pipeline/batch - the result pipelines alone
+
+    Every benchmark is run in a process of its own, and measures:
+        rps - generated requests, or pipeline rows, per second
+        cpu - CPU microseconds per request, of all its processes
+        memory - KB of max resident memory per virtual user, estimated as the
+                 largest worker process times the processes per user
+
+    Using it:
+        suite = Suite(latency=0.001)
+        results = suite.run()
+        for message in compare(results, loadbaseline()): ...
+        savebaseline(results, {'latency': 0.001})
+    """
+
+    # Total concurrency of each benchmark, in order
+    concurrencies = (1, 4, 16, 64)
+    # Engines to benchmark multirepeater by
+    engines = ('process', 'async')
+    # Requests of each benchmark, spread over the virtual users
+    requests = 2000
+    # Rows through each result pipeline
+    pipeline_rows = 200000
+
+    def __init__(self, latency=0, payload=0, options=None,
+                 concurrencies=None, requests=None):
+        """
+            latency = Seconds the stub server waits before each response
+            payload = Bytes of padding in each response
+            options = Extra worker options, like the client
+        """
+
+        self.latency = latency
+        self.payload = payload
+        self.options = options if options is not None else {}
+
+        if concurrencies is not None:
+            self.concurrencies = concurrencies
+
+        if requests is not None:
+            self.requests = requests
+
+    def repeat(self, concurrency, config):
+        return max(1, self.requests // concurrency // len(config))
+
+    def benchmarks(self, url):
+        """Yields the name, concurrency, target and arguments of each
+        benchmark.
+        """
+
+        config = requestconfig(url)
+
+        for concurrency in self.concurrencies:
+            repeat = self.repeat(concurrency, config)
+
+            for engine in self.engines:
+                yield ('multirepeater/{}/{}'.format(engine, concurrency),
+                       concurrency, repeaters,
+                       (concurrency, repeat, config,
+                        dict(self.options, engine=engine)))
+
+            yield ('localhost/{}'.format(concurrency), concurrency, localhost,
+                   (concurrency, repeat, config, self.options))
+
+        yield 'pipeline/ring', None, ringpipeline, (self.pipeline_rows,)
+        yield 'pipeline/batch', None, batchpipeline, (self.pipeline_rows,)
+
+    def run(self, progress=None):
+        """Runs all benchmarks, and returns their results by name. Each
+        result is passed to progress, if given, as it's done.
+        """
+
+        server = StubServer(latency=self.latency, payload=self.payload)
+        server.start()
+        results = {}
+
+        try:
+            for name, concurrency, target, args in \
+                    self.benchmarks(server.url):
+                result = measure(target, *args)
+                rows = max(result['rows'], 1)
+                results[name] = {
+                    'requests': result['rows'],
+                    'errors': result['errors'],
+                    'rps': result['rows'] / result['seconds'],
+                    'cpu': result['cpu'] * 1000000 / rows,
+                    'memory': None if concurrency is None else
+                    result['maxrss'] * result['processes'] / concurrency}
+
+                if progress is not None:
+                    progress(name, results[name])
+        finally:
+            server.stop()
+
+        return results
+
+
+def machine():
+    """Describes this machine, since the baselines only compare on the same
+    kind of machine.
+    """
+
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cores': os.cpu_count()}
+
+
+def loadbaseline(path=BASELINE):
+    """Returns the tracked baseline, or None if there is none.
+    """
+
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def savebaseline(results, settings, path=BASELINE):
+    """Saves results, and the settings they were run with, as the tracked
+    baseline.
+    """
+
+    with open(path, 'w') as f:
+        json.dump({'machine': machine(),
+                   'settings': settings,
+                   'results': results}, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def compare(results, baseline, tolerance=10):
+    """Returns a message for each metric which is more than tolerance
+    percent worse than in the baseline.
+    """
+
+    messages = []
+
+    if baseline is None:
+        return messages
+
+    for name, result in sorted(results.items()):
+        previous = baseline['results'].get(name)
+
+        if previous is None:
+            continue
+
+        for metric, higher in sorted(METRICS.items()):
+            if not result.get(metric) or not previous.get(metric):
+                continue
+
+            change = 100 * (result[metric] / previous[metric] - 1)
+
+            if (-change if higher else change) > tolerance:
+                messages.append('{}: {} is {:.1f}, {:+.1f}% from the '
+                                'baseline {:.1f}'.format(
+                                    name, metric, result[metric], change,
+                                    previous[metric]))
+
+    return messages
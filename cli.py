@@ -21,10 +21,12 @@ import click
 import json
 import sys
 
+from benchmarks import (Suite, compare, loadbaseline, machine,
+                        savebaseline)
 from clustrloadr import Session
 from loadr import Loadr
-from util import config
-from wrkloadr import multirepeater, csvwriter
+from util import config, health, store
+from wrkloadr import multirepeater, CsvWriter
 
 
 @click.command()
@@ -32,10 +34,57 @@ from wrkloadr import multirepeater, csvwriter
               help='How many concurrent requests to send')
 @click.option('-r', '--repeat', type=int, default=1,
               help='How many times to repeat the whole requests cycle')
+@click.option('-e', '--engine', type=click.Choice(['process', 'async']),
+              default='process',
+              help='Run each concurrent user in its own process, ' +
+                   'or as coroutines in one process per core')
+@click.option('-t', '--rate', type=float, default=None,
+              help='Start request cycles at a constant rate per second, ' +
+                   'instead of repeating them')
+@click.option('-d', '--duration', type=int, default=60,
+              help='For how many seconds to keep the rate')
+@click.option('-a', '--aggregate', type=int, default=None,
+              help='Aggregate latencies into histograms, and write them ' +
+                   'every x seconds')
+@click.option('--rows/--no-rows', default=True,
+              help='Whether to write every request as a row or not')
+@click.option('-b', '--backend', type=click.Choice(['requests', 'http',
+                                                    'aiohttp']),
+              default=None,
+              help='Which HTTP client to use, defaults to requests for ' +
+                   'the process engine and aiohttp for async')
+@click.option('--reuse/--no-reuse', default=False,
+              help='Whether to reuse connections between the cycles or not')
+@click.option('-R', '--replay', type=click.Path(exists=True, dir_okay=False),
+              default=None,
+              help='Replay the requests of a json lines file or access ' +
+                   'log at their original pace, instead of the requests file')
+@click.option('-x', '--speed', type=float, default=1,
+              help='How many times faster than the original pace to replay')
+@click.option('--base', type=str, default='',
+              help='Url which the replayed paths are relative to')
 @click.argument('requestfile', type=click.File('r'), default=sys.stdin)
-def worker(concurrency, repeat, requestfile):
-    multirepeater(concurrency, repeat, csvwriter(sys.stdout.write),
-                  config.load(requestfile))
+def worker(concurrency, repeat, engine, rate, duration, aggregate, rows,
+           backend, reuse, replay, speed, base, requestfile):
+    options = {'engine': engine,
+               'aggregate': aggregate,
+               'rows': rows,
+               'client': {'reuse': reuse}}
+
+    if backend is not None:
+        options['client']['backend'] = backend
+
+    if rate is not None:
+        options['rate'] = {'start': rate,
+                           'stages': [{'duration': duration,
+                                       'target': rate}]}
+
+    if replay is not None:
+        options['replay'] = {'path': replay, 'speed': speed, 'base': base}
+
+    multirepeater(concurrency, repeat, (CsvWriter, sys.stdout),
+                  [] if replay is not None else config.load(requestfile),
+                  options)
 
 
 @click.command()
@@ -72,9 +121,143 @@ def cluster(provider, instances, concurrency, repeat,
               help='Requests cycle configuration json file')
 @click.option('-u', '--ui', type=str, default='Csv',
               help='Which ui to use')
-def main(session, environments, requests, ui):
+@click.option('-o', '--out', type=click.Path(file_okay=False), default=None,
+              help='Where the Store ui stores the results')
+@click.option('-T', '--thresholds', type=click.File('r'), default=None,
+              help='Thresholds json file, to check the run by')
+@click.option('-S', '--saturation', type=click.File('r'), default=None,
+              help='Saturation limits json file, to flag the workers by')
+def main(session, environments, requests, ui, out, thresholds, saturation):
+    if out is not None and ui != 'Store':
+        raise click.BadParameter('only the Store ui stores the results',
+                                 param_hint='--out')
+
     loadr = Loadr()
     loadr.providers(config.load(environments))
     loadr.requests(config.load(requests))
     loadr.start(config.load(session))
-    loadr.ui(ui)
+    options = {}
+
+    if out is not None:
+        options['path'] = out
+
+    if thresholds is not None:
+        options['thresholds'] = config.load(thresholds)
+
+    if saturation is not None:
+        options['saturation'] = config.load(saturation)
+
+    loadr.ui(ui, **options)
+
+
+@click.command()
+@click.option('-t', '--timeline', is_flag=True,
+              help='Also show the requests and errors per second')
+@click.option('-i', '--instance', type=str, default=None,
+              help='Only report the requests from this instance')
+@click.option('-s', '--step', type=int, default=None,
+              help='Only report the requests of this step')
+@click.option('--from', 'begin', type=float, default=None,
+              help='Only report the requests started this many seconds ' +
+                   'after the first request, or later')
+@click.option('--to', 'end', type=float, default=None,
+              help='Only report the requests started before this many ' +
+                   'seconds after the first request')
+@click.option('-D', '--discount', is_flag=True,
+              help='Leave out the requests started while their instance ' +
+                   'was saturated')
+@click.option('-S', '--saturation', type=click.File('r'), default=None,
+              help='Saturation limits json file, to discount by')
+@click.argument('path', type=click.Path(exists=True, file_okay=False))
+def report(timeline, instance, step, begin, end, discount, saturation, path):
+    filters = {'instance': instance, 'step': step}
+    index = store.loadindex(path)
+    firsttime = int(index[:, 2].min()) if len(index) else 0
+
+    if begin is not None:
+        filters['start'] = firsttime + int(begin * 1000000)
+
+    if end is not None:
+        filters['end'] = firsttime + int(end * 1000000)
+
+    if discount:
+        saturated = health.saturated(
+            store.loadrecords(path),
+            None if saturation is None else config.load(saturation))
+        filters['exclude'] = saturated.exclusions(store.loadinstances(path))
+
+        for source in sorted(saturated.intervals):
+            click.echo('Discounted {:.1f} s while {} was saturated'.format(
+                saturated.seconds(source), source))
+
+    steps, statuses, seconds = store.report(
+        path, **{key: val for key, val in filters.items() if val is not None})
+
+    click.echo('Steps:')
+    click.echo(steps.to_string(index=False))
+    click.echo('\nStatuses:')
+    click.echo(statuses.to_string(index=False))
+
+    if timeline:
+        click.echo('\nTimeline:')
+        click.echo(seconds.to_string())
+
+
+@click.command()
+@click.option('-c', '--concurrency', type=str, default=None,
+              help='Comma separated concurrencies to benchmark, ' +
+                   'defaults to 1,4,16,64')
+@click.option('-n', '--requests', type=int, default=None,
+              help='Requests of each benchmark, defaults to 2000')
+@click.option('-l', '--latency', type=float, default=0,
+              help='Milliseconds the stub server waits before responding')
+@click.option('-p', '--payload', type=int, default=0,
+              help='Bytes of padding in each response')
+@click.option('-b', '--baseline', type=click.Path(dir_okay=False),
+              default=None,
+              help='Baseline json file, defaults to the tracked one')
+@click.option('--save', is_flag=True,
+              help='Save the results as the new baseline')
+@click.option('--tolerance', type=float, default=10,
+              help='Percent a metric may be worse than the baseline')
+def bench(concurrency, requests, latency, payload, baseline, save,
+          tolerance):
+    suite = Suite(latency=latency / 1000,
+                  payload=payload,
+                  concurrencies=None if concurrency is None
+                  else [int(c) for c in concurrency.split(',')],
+                  requests=requests)
+    path = {} if baseline is None else {'path': baseline}
+    settings = {'concurrency': list(suite.concurrencies),
+                'requests': suite.requests,
+                'latency': latency,
+                'payload': payload}
+
+    def progress(name, result):
+        click.echo('{:<28} {:>10.1f} req/s {:>8.1f} us cpu/req {:>10} '
+                   'KB/user {:>6} errors'.format(
+                       name, result['rps'], result['cpu'],
+                       '-' if result['memory'] is None
+                       else '{:.0f}'.format(result['memory']),
+                       result['errors']))
+
+    results = suite.run(progress)
+
+    if save:
+        savebaseline(results, settings, **path)
+        return
+
+    previous = loadbaseline(**path)
+
+    if previous is not None and (previous['machine'] != machine() or
+                                 previous['settings'] != settings):
+        click.echo('The baseline was run on another machine or with other '
+                   'settings', err=True)
+
+    messages = compare(results, previous, tolerance)
+
+    for message in messages:
+        click.echo(message, err=True)
+
+    if messages:
+        sys.exit(1)
@@ -22,6 +22,7 @@ import sys
 from multiprocessing import get_context
 
 from providers import get_provider
+from wrkloadr import partitioned
 
 
 class Session:
@@ -45,6 +46,10 @@ class Session:
       | +-------------------------------------------------------+   +--------------------------+
     4.+-> run()                                                 +---> run_multiple_workers()   |
       | +-------------------------------------------------------+   +--------------------------+
+      +-> control({"command": "pause"})                         +---> control()                |
+      | +-------------------------------------------------------+   +--------------------------+
+      +-> abort()                                               |
+      | +-------------------------------------------------------+
     5.+-> stop()                                                +---> remove_instances()       |
         +-------------------------------------------------------+   +--------------------------+
 
@@ -59,6 +64,8 @@ class Session:
         self._session = []
         # Output Queue
         self.output = output
+        # The worker runners of the current run
+        self._running = []
 
     def add_provider(self, name, provider_type, **config):
         """Adds a provider by name, type and configuration.
@@ -106,8 +113,11 @@ class Session:
                 "provider": "<provider-name>",
                 "instances": <number-of-instances>,
                 "concurrency" <number-of-simultaneous-request-workers>,
-                "repeat": <number-of-repeatness>
+                "repeat": <number-of-repeatness>,
+                "engine": <"process"-or-"async">
             }
+        Any key besides provider and instances are passed on to the
+        workers as options.
         """
 
         self._session = config
@@ -158,16 +168,37 @@ class Session:
 
         processes = []
         mp = get_context('fork')
+        # The feed and replay files of each session part, if any. The parts
+        # which share a file get a partition each.
+        files = [(s['feed']['path'] if s.get('feed') else None,
+                  s['replay']['path'] if s.get('replay') else None)
+                 for s in self._session]
 
-        for s in self._session:
+        for i, s in enumerate(self._session):
             provider = self._providers[s['provider']]
+            # Everything but the instance definition are worker options,
+            # like "engine".
+            options = {key: val
+                       for key, val
+                       in s.items()
+                       if key not in ('provider', 'instances',
+                                      'concurrency', 'repeat')}
+
+            if files[i] != (None, None):
+                options = partitioned(options,
+                                      files[:i].count(files[i]),
+                                      files.count(files[i]))
+
             # Start the worker runner in it's own thread for later joining...
             process = mp.Process(target=provider.run_multiple_workers,
                                  args=(s['concurrency'],
                                        s['repeat'],
-                                       self._requests))
+                                       self._requests,
+                                       options))
             processes += [process]
 
+        self._running = processes
+
         # Start all of them...
         for p in processes:
             p.start()
@@ -175,3 +206,36 @@ class Session:
         # Now wait for doneness
         for p in processes:
             p.join()
+
+        self._running = []
+        self.output.put(('status', 'session', 'ended'))
+
+    def control(self, command):
+        """Sends a control command, like {"command": "pause"}, to the running
+        workers of all providers. See wrkloadr.Control for the commands.
+        """
+
+        for name, provider in self._providers.items():
+            if not hasattr(provider, 'control'):
+                continue
+
+            try:
+                provider.control(command)
+            except Exception as e:
+                self.output.put(('error', name,
+                                 'Could not control the workers: {}'
+                                 .format(e)))
+
+    def abort(self):
+        """Aborts the current run by stopping the workers, and terminating
+        all the worker runners. The run then ends as usual, and the instances
+        are stopped by stop.
+        """
+
+        self.control({'command': 'stop'})
+
+        for p in self._running:
+            if p.is_alive():
+                p.terminate()
+
+        self.output.put(('status', 'session', 'aborted'))
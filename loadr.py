@@ -20,6 +20,7 @@ along with loadr.  If not, see <http://www.gnu.org/licenses/>.
 import sys
 
 from multiprocessing import get_context
+from threading import Thread
 
 import ui
 
@@ -55,8 +56,15 @@ class Loadr:
             +----------------------------+
             | run()                      |
             +----------------------------+
+            | control(<command-dict>)    |
+            +----------------------------+
+            | abort()                    |
+            +----------------------------+
             | stop()                     |
             +----------------------------+
+
+    The Session runs in a thread of the listener, so that the UI can abort it
+    while it's running.
     """
 
     def __init__(self):
@@ -93,25 +101,32 @@ class Loadr:
                 elif data[1] == 'start':
                     self._session.start(data[2])
                 elif data[1] == 'run':
-                    self._session.run()
+                    Thread(target=self._session.run).start()
+                elif data[1] == 'control':
+                    self._session.control(data[2])
+                elif data[1] == 'abort':
+                    self._session.abort()
                 elif data[1] == 'stop':
                     self._session.stop()
                 elif data[1] == 'quit':
                     self.quit()
 
-    def ui(self, name=None, module=None):
+    def ui(self, name=None, module=None, **options):
         """Sets the UI by name or module and starts it within it's own thread.
+        Any options are passed on to the UI.
         """
 
         if name is not None:
             # UI module was passed by name
             self._ui = ui.get_ui(name,
                                  input=self._session_output,
-                                 output=self._ui_input)
+                                 output=self._ui_input,
+                                 **options)
         elif module is not None:
             # UI module was passed itself
             self._ui = module(input=self._session_output,
-                              output=self._output)
+                              output=self._output,
+                              **options)
 
         if self._ui is not None:
             # If UI was found - start it within it's thread
@@ -149,6 +164,20 @@ class Loadr:
 
         self._ui_input.send(('command', 'run'))
 
+    def control(self, command, **arguments):
+        """Control Session - sends a command, like "pause", "run", "stop" or
+        "rate" with a factor, to all running workers.
+        """
+
+        self._ui_input.send(('command', 'control',
+                             dict(arguments, command=command)))
+
+    def abort(self):
+        """Abort Session - stops all running workers at all instances.
+        """
+
+        self._ui_input.send(('command', 'abort'))
+
     def quit(self):
         """Send the stop command and quits current processes.
         """
@@ -1,2 +1,2 @@
 from .get_provider import get_provider
-from .messenger import Messenger
+from .messenger import Messenger, broadcast
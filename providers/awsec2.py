@@ -19,18 +19,24 @@ along with loadr.  If not, see <http://www.gnu.org/licenses/>.
 
 import asyncio
 import boto3
+import hashlib
 import json
 import math
+import os
 import paramiko
 import pika
+import shlex
 import sys
+import tempfile
 
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from io import StringIO
-from multiprocessing import get_context, Queue
 from time import time, sleep
 
 from util import random_string
-from providers import Messenger
+from providers import Messenger, broadcast
+from wrkloadr import Feeder, Replay, partitioned
 
 
 class Awsec2:
@@ -44,14 +50,26 @@ class Awsec2:
     instances_per_messenger = 20
     # How many simultaneous ssh connections for setting up the environments.
     concurrent_ssh_sessions = 10
-    # How many times to retry the ssh connections before giving up.
+    # How many times to try the ssh connections before giving up.
     ssh_retries = 10
-    # How long to wait before next ssh connection retry.
-    ssh_retry_timeout = 10
+    # How long to wait before the first ssh connection retry. It's doubled
+    # for each retry.
+    ssh_retry_timeout = 2
+    # Longest wait between two ssh connection retries.
+    ssh_retry_max_timeout = 30
     # When to give up connection if no response.
     ssh_timeout = 60
-    # How long to wait before instances are ready after bootstrapping.
-    bootscript_wait_timeout = 60
+    # How long to wait for the instances' bootscripts to be done before giving
+    # up.
+    bootscript_wait_timeout = 900
+    # How often to check whether the bootscripts are done.
+    bootscript_poll_interval = 5
+    # How many instances to describe per call while waiting for them to run.
+    describe_batch_size = 500
+    # File which the workers' bootscript creates when it's done.
+    boot_marker = '/var/tmp/loadr-booted'
+    # Seconds from all workers are deployed until they start.
+    start_delay = 10
 
     # RabbitMQ AWS EC2 image id
     messengers_image_id = 'ami-e2df388d'
@@ -61,43 +79,80 @@ class Awsec2:
     messengers_username = ''
     # RabbitMQ randomized password - created when messenger instance is created.
     messengers_password = ''
-    # RabbitMQ bootstrap script. Installs RabbitMQ and starts it.
-    messengers_bootscript = """#!/bin/bash
-yum update -y
+    # RabbitMQ install script. Installs RabbitMQ and enables it at boot.
+    messengers_installscript = """yum update -y
 wget http://www.rabbitmq.com/releases/erlang/erlang-18.3-1.el6.x86_64.rpm
 yum install -y erlang-18.3-1.el6.x86_64.rpm
 wget http://www.rabbitmq.com/releases/rabbitmq-server/v3.6.1/rabbitmq-server-3.6.1-1.noarch.rpm
 rpm --import https://www.rabbitmq.com/rabbitmq-signing-key-public.asc
 yum install -y rabbitmq-server-3.6.1-1.noarch.rpm
 chkconfig rabbitmq-server on
-service rabbitmq-server start
+"""
+    # RabbitMQ bootstrap script. Installs RabbitMQ, unless it's baked into the
+    # image, starts it and adds the user.
+    messengers_bootscript = """#!/bin/bash
+{install}service rabbitmq-server start
 rabbitmqctl add_user {username} {password}
 rabbitmqctl set_permissions {username} ".*" ".*" ".*"
 """
 
-    # Worker bootstrap script. Installs python 3.4 with pika and requests modules
+    # Worker install script. Installs python 3.8 with pika, requests and
+    # aiohttp modules, from the extras of Amazon Linux 2
+    workers_installscript = """yum update -y
+amazon-linux-extras install -y python3.8
+pip3.8 install pika requests aiohttp
+"""
+    # The python which runs the workers, they need 3.7 or later
+    workers_python = 'python3.8'
+    # Worker bootstrap script. Installs the worker, unless it's baked into the
+    # image, and then creates the boot marker. It also bakes the images.
     workers_bootscript = """#!/bin/bash
-yum update -y
-yum install -y python34 python34-pip
-alternatives --set python /usr/bin/python3.4
-pip install pika requests
+set -e
+{install}touch {marker}
 """
-
-    def __init__(self, output, image_id, instance_type, **kwargs):
+    # Prefix of the baked images' names, which ends with a hash of what's
+    # installed into them.
+    image_prefix = 'loadr'
+    # Where the pools' keypairs and RabbitMQ credentials are kept between the
+    # sessions.
+    pool_state_file = '~/.loadr/awsec2-pools.json'
+
+    def __init__(self, output, image_id, instance_type, bake=False,
+                 pool_ttl=None, pool_name='default', **kwargs):
         # All output in a single queue
         self.output = output
 
         # Save these for later -> create_instances
         self.image_id, self.instance_type = image_id, instance_type
 
+        # Whether to install everything into baked images, once, which are
+        # then reused by all sessions.
+        self.bake = bake
+        self.workers_baked_image_id = None
+        self.messengers_baked_image_id = None
+
+        # With a pool_ttl the instances, keypair and security groups are kept
+        # when the session stops, and adopted by the next session. Instances
+        # idle for longer than pool_ttl seconds are terminated, by the next
+        # session or by shutting themselves down.
+        self.pool_ttl, self.pool_name = pool_ttl, pool_name
+
         self.session = self.create_session(**kwargs)
         self.ec2 = self.session.resource('ec2')
         self.keypair = self.create_keypair()
         self.messengers_securitygroup = self.create_messengers_securitygroup()
         self.workers_securitygroup = self.create_workers_securitygroup()
 
-        self.messengers_username = random_string(16)
-        self.messengers_password = random_string(16)
+        state = self.load_pool_state()
+
+        if 'messengers_username' in state:
+            self.messengers_username = state['messengers_username']
+            self.messengers_password = state['messengers_password']
+        else:
+            self.messengers_username = random_string(16)
+            self.messengers_password = random_string(16)
+            self.save_pool_state(messengers_username=self.messengers_username,
+                                 messengers_password=self.messengers_password)
 
         self.messengers = []
         self.instances = []
@@ -130,20 +185,94 @@ pip install pika requests
 
         raise ValueError('Either profile or access_key/secret_key has to be set')
 
+    def load_pool_state(self):
+        """Returns what's saved about the pool, or an empty dict when not
+        pooling.
+        """
+
+        if self.pool_ttl is None:
+            return {}
+
+        try:
+            with open(os.path.expanduser(self.pool_state_file)) as f:
+                pools = json.load(f)
+        except FileNotFoundError:
+            pools = {}
+
+        return pools.get('{}/{}'.format(self.session.region_name,
+                                        self.pool_name), {})
+
+    def save_pool_state(self, **state):
+        """Saves data about the pool to pool_state_file, only readable by the
+        current user since it contains the private key. Does nothing when
+        not pooling.
+        """
+
+        if self.pool_ttl is None:
+            return
+
+        filename = os.path.expanduser(self.pool_state_file)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+        try:
+            with open(filename) as f:
+                pools = json.load(f)
+        except FileNotFoundError:
+            pools = {}
+
+        key = '{}/{}'.format(self.session.region_name, self.pool_name)
+        pools[key] = dict(pools.get(key, {}), **state)
+
+        with open(os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                          0o600), 'w') as f:
+            json.dump(pools, f)
+
+    def pool_suffix(self):
+        """Returns the name suffix for keypairs and security groups. It's
+        fixed for pools, so that they can be found by the next session.
+        """
+
+        if self.pool_ttl is None:
+            return random_string()
+
+        return 'pool-' + self.pool_name
+
     def create_keypair(self):
-        """Creates a rsa key pair for ssh access
+        """Creates a rsa key pair for ssh access, or reuses the pool's.
         """
 
-        keyname = 'loadr-%s' % random_string()
+        state = self.load_pool_state()
+
+        if 'keyname' in state:
+            keypair = self.ec2.KeyPair(state['keyname'])
+
+            try:
+                keypair.load()
+                self.key_material = state['key_material']
+                return keypair
+            except ClientError:
+                pass
+
+        keyname = 'loadr-%s' % self.pool_suffix()
+
+        if self.pool_ttl is not None:
+            # Not to be mixed up with the pool's earlier keypairs
+            keyname += '-' + random_string()
+
         keypair = self.ec2.KeyPair(keyname)
         keypair.delete()
-        return self.ec2.create_key_pair(KeyName=keyname)
+        keypair = self.ec2.create_key_pair(KeyName=keyname)
+        self.key_material = keypair.key_material
+        self.save_pool_state(keyname=keyname,
+                             key_material=self.key_material)
+
+        return keypair
 
     def create_messengers_securitygroup(self):
         """Creates a security policy which makes rabbitmq reachable
         """
 
-        sgname = 'loadr-messenger-%s' % random_string()
+        sgname = 'loadr-messenger-%s' % self.pool_suffix()
         sg = None
 
         # Look for existing security group
@@ -165,6 +294,17 @@ pip install pika requests
                                  FromPort=5672,
                                  ToPort=5672)
 
+        # Pooled messengers are given their shutdown timers by ssh
+        if self.pool_ttl is not None:
+            try:
+                sg.authorize_ingress(IpProtocol='tcp',
+                                     CidrIp='0.0.0.0/0',
+                                     FromPort=22,
+                                     ToPort=22)
+            except ClientError:
+                # Already authorized
+                pass
+
         return sg
 
 
@@ -172,7 +312,7 @@ pip install pika requests
         """Creates a security policy which makes a ssh access possible
         """
 
-        sgname = 'loadr-worker-%s' % random_string()
+        sgname = 'loadr-worker-%s' % self.pool_suffix()
         sg = None
 
         # Look for existing security group
@@ -204,90 +344,460 @@ pip install pika requests
 
         self.output.put(('status', 'awsec2', 'creating instances'))
 
-        messengers_count = math.ceil(instances / self.instances_per_messenger)
+        if self.bake:
+            self.bake_images()
 
-        self.messengers = self.ec2.create_instances(
-                            ImageId=self.messengers_image_id,
-                            InstanceType=self.messengers_type,
-                            MinCount=messengers_count,
-                            MaxCount=messengers_count,
-                            UserData=self.messengers_bootscript.format(
-                                username=self.messengers_username,
-                                password=self.messengers_password),
-                            SecurityGroupIds=[self.messengers_securitygroup.id])
-
-        self.instances = self.ec2.create_instances(
-                            ImageId=self.image_id,
-                            InstanceType=self.instance_type,
-                            MinCount=instances,
-                            MaxCount=instances,
-                            UserData=self.workers_bootscript,
-                            KeyName=self.keypair.name,
-                            SecurityGroupIds=[self.workers_securitygroup.id])
+        messengers_count = math.ceil(instances / self.instances_per_messenger)
+        messengers_image_id = self.messengers_baked_image_id or \
+            self.messengers_image_id
+        workers_image_id = self.workers_baked_image_id or self.image_id
+
+        if self.pool_ttl is not None:
+            self.reap_pool()
+            self.messengers = self.adopt_instances(
+                                'messenger',
+                                messengers_image_id,
+                                self.messengers_type,
+                                messengers_count,
+                                [{'Name': 'tag:loadr-credentials',
+                                  'Values': [self.credentials_hash()]},
+                                 {'Name': 'key-name',
+                                  'Values': [self.keypair.name]}])
+            self.instances = self.adopt_instances(
+                                'worker',
+                                workers_image_id,
+                                self.instance_type,
+                                instances,
+                                [{'Name': 'key-name',
+                                  'Values': [self.keypair.name]}])
+        else:
+            self.messengers = []
+            self.instances = []
+
+        if len(self.messengers) < messengers_count:
+            count = messengers_count - len(self.messengers)
+            self.messengers += self.ec2.create_instances(
+                                ImageId=messengers_image_id,
+                                InstanceType=self.messengers_type,
+                                MinCount=count,
+                                MaxCount=count,
+                                UserData=self.messengers_bootscript.format(
+                                    install='' if self.bake else
+                                    self.messengers_installscript,
+                                    username=self.messengers_username,
+                                    password=self.messengers_password),
+                                KeyName=self.keypair.name,
+                                SecurityGroupIds=[
+                                    self.messengers_securitygroup.id],
+                                **self.pool_tags('messenger',
+                                                 [{'Key': 'loadr-credentials',
+                                                   'Value':
+                                                   self.credentials_hash()}]))
+
+        if len(self.instances) < instances:
+            count = instances - len(self.instances)
+            self.instances += self.ec2.create_instances(
+                                ImageId=workers_image_id,
+                                InstanceType=self.instance_type,
+                                MinCount=count,
+                                MaxCount=count,
+                                UserData=self.workers_bootscript.format(
+                                    install='' if self.bake else
+                                    self.workers_installscript,
+                                    marker=self.boot_marker),
+                                KeyName=self.keypair.name,
+                                SecurityGroupIds=[
+                                    self.workers_securitygroup.id],
+                                **self.pool_tags('worker'))
 
         if wait:
             self.wait_for_running_instances()
 
+    def image_name(self, kind, image_id, installscript, files=()):
+        """Returns the name of a baked image, by a hash of its base image,
+        its install script and the files uploaded to it.
+        """
+
+        digest = hashlib.sha256()
+        digest.update(image_id.encode())
+        digest.update(installscript.encode())
+
+        for filename in files:
+            with open(filename, 'rb') as f:
+                digest.update(f.read())
+
+        return '{}-{}-{}'.format(self.image_prefix, kind,
+                                 digest.hexdigest()[:16])
+
+    def bake_images(self):
+        """Finds, or bakes, the images for the messengers and the workers
+        concurrently.
+        """
+
+        with ThreadPoolExecutor(2) as executor:
+            messengers = executor.submit(self.bake_image,
+                                         'messenger',
+                                         self.messengers_image_id,
+                                         self.messengers_type,
+                                         self.messengers_installscript)
+            workers = executor.submit(self.bake_image,
+                                      'worker',
+                                      self.image_id,
+                                      self.instance_type,
+                                      self.workers_installscript,
+                                      ['wrkloadr.py'])
+
+            self.messengers_baked_image_id = messengers.result()
+            self.workers_baked_image_id = workers.result()
+
+    def bake_image(self, kind, image_id, instance_type, installscript,
+                   files=()):
+        """Returns the id of a baked image with the install script run and the
+        files uploaded. If there's no such image since before, it's baked by
+        an instance which runs the install script and is then imaged.
+        """
+
+        name = self.image_name(kind, image_id, installscript, files)
+
+        for image in self.ec2.images.filter(
+                Owners=['self'],
+                Filters=[{'Name': 'name', 'Values': [name]}]):
+            if image.state == 'available':
+                return image.id
+
+        self.output.put(('status', 'awsec2', 'baking image ' + name))
+
+        instance = self.ec2.create_instances(
+                        ImageId=image_id,
+                        InstanceType=instance_type,
+                        MinCount=1,
+                        MaxCount=1,
+                        UserData=self.workers_bootscript.format(
+                            install=installscript,
+                            marker=self.boot_marker),
+                        KeyName=self.keypair.name,
+                        SecurityGroupIds=[self.workers_securitygroup.id])[0]
+
+        try:
+            instance.wait_until_running()
+            instance.load()
+            self.wait_for_worker(instance,
+                                 time() + self.bootscript_wait_timeout)
+
+            client = self.connect(instance)
+
+            try:
+                sftp = client.open_sftp()
+
+                for filename in files:
+                    sftp.put(filename, filename)
+
+                sftp.close()
+
+                # The boot marker has to be created by the new instances
+                stdin, stdout, stderr = client.exec_command(
+                    'sudo rm -f {}'.format(shlex.quote(self.boot_marker)))
+                stdout.channel.recv_exit_status()
+            finally:
+                client.close()
+
+            image = instance.create_image(Name=name,
+                                          Description='loadr ' + kind)
+            self.ec2.meta.client.get_waiter('image_available').wait(
+                ImageIds=[image.id])
+        finally:
+            instance.terminate()
+
+        self.output.put(('status', 'awsec2', 'baked image ' + name))
+
+        return image.id
+
     def wait_for_running_instances(self):
-        """Blocks current thread until all instances are running.
+        """Blocks current thread until all instances are running and their
+        bootscripts are done.
+
+        All instances are waited for at once: first by describing them in
+        batches until all are running, and then by checking, at most
+        concurrent_ssh_sessions at a time, that the messengers accept the
+        RabbitMQ login and that the workers have created the boot marker.
         This method must be thread-safe.
         """
 
-        for i in self.messengers + self.instances:
-            i.wait_until_running()
-            sleep(self.bootscript_wait_timeout)
-            self.output.put(('status', i.id, 'running'))
+        instances = self.messengers + self.instances
+        waiter = self.ec2.meta.client.get_waiter('instance_running')
+
+        for i in range(0, len(instances), self.describe_batch_size):
+            waiter.wait(
+                InstanceIds=[instance.id for instance in
+                             instances[i:i + self.describe_batch_size]],
+                WaiterConfig={'Delay': self.bootscript_poll_interval,
+                              'MaxAttempts': math.ceil(
+                                  self.bootscript_wait_timeout /
+                                  self.bootscript_poll_interval)})
+
+        # Get the dns names, and so on, of all instances at once.
+        loaded = {}
+
+        for i in range(0, len(instances), self.describe_batch_size):
+            for instance in self.ec2.instances.filter(
+                    InstanceIds=[instance.id for instance in
+                                 instances[i:i + self.describe_batch_size]]):
+                loaded[instance.id] = instance
+                self.output.put(('status', instance.id, 'running'))
+
+        self.messengers = [loaded[i.id] for i in self.messengers]
+        self.instances = [loaded[i.id] for i in self.instances]
+
+        deadline = time() + self.bootscript_wait_timeout
+
+        with ThreadPoolExecutor(self.concurrent_ssh_sessions) as executor:
+            futures = {}
+
+            for wait, group in ((self.wait_for_messenger, self.messengers),
+                                (self.wait_for_worker, self.instances)):
+                futures.update({executor.submit(wait, i, deadline): i
+                                for i in group})
+
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                    self.output.put(('status', futures[future].id, 'ready'))
+                except Exception as e:
+                    self.output.put(('error', futures[future].id,
+                                     'Not ready: {}'.format(e)))
+
+    def wait_for_messenger(self, messenger, deadline):
+        """Blocks until the messenger's RabbitMQ accepts the login, which is
+        the last thing its bootscript does, or raises TimeoutError when the
+        deadline has passed.
+        """
+
+        parameters = pika.URLParameters(self.get_messenger_url(messenger))
+        parameters.socket_timeout = self.bootscript_poll_interval
+
+        while True:
+            try:
+                pika.BlockingConnection(parameters).close()
+                return
+            except pika.exceptions.AMQPError:
+                if time() >= deadline:
+                    raise TimeoutError('RabbitMQ never accepted the login')
+
+            sleep(self.bootscript_poll_interval)
+
+    def wait_for_worker(self, instance, deadline):
+        """Blocks until the worker's bootscript has created the boot marker,
+        or raises TimeoutError when the deadline has passed.
+        """
+
+        client = self.connect(instance)
+
+        try:
+            while True:
+                stdin, stdout, stderr = client.exec_command(
+                    'test -f {}'.format(shlex.quote(self.boot_marker)))
+
+                if stdout.channel.recv_exit_status() == 0:
+                    return
+
+                if time() >= deadline:
+                    raise TimeoutError('The bootscript never finished')
+
+                sleep(self.bootscript_poll_interval)
+        finally:
+            client.close()
+
+    def credentials_hash(self):
+        """Returns a hash of the RabbitMQ credentials, which the pool's
+        messengers are tagged with.
+        """
+
+        return hashlib.sha256('{}:{}'.format(
+            self.messengers_username,
+            self.messengers_password).encode()).hexdigest()[:16]
+
+    def pool_tags(self, role, tags=()):
+        """Returns the create_instances arguments for tagging new instances as
+        busy members of the pool, which are terminated when they shut
+        themselves down, or nothing when not pooling.
+        """
+
+        if self.pool_ttl is None:
+            return {}
+
+        return {'InstanceInitiatedShutdownBehavior': 'terminate',
+                'TagSpecifications': [{
+            'ResourceType': 'instance',
+            'Tags': [{'Key': 'loadr-pool', 'Value': self.pool_name},
+                     {'Key': 'loadr-role', 'Value': role},
+                     {'Key': 'loadr-state', 'Value': 'busy'}] + list(tags)}]}
+
+    def pool_instances(self, state, filters=()):
+        """Returns the pool's running instances in specified state.
+        """
+
+        return self.ec2.instances.filter(Filters=[
+            {'Name': 'tag:loadr-pool', 'Values': [self.pool_name]},
+            {'Name': 'tag:loadr-state', 'Values': [state]},
+            {'Name': 'instance-state-name', 'Values': ['running']}] +
+            list(filters))
+
+    def adopt_instances(self, role, image_id, instance_type, count,
+                        filters=()):
+        """Claims at most count idle instances of the pool, with the same role,
+        image and instance type, and returns them. Their shutdown timers are
+        cancelled, and those whose timers can't be are terminated.
+        """
+
+        candidates = []
+
+        for instance in self.pool_instances('idle', [
+                {'Name': 'tag:loadr-role', 'Values': [role]},
+                {'Name': 'image-id', 'Values': [image_id]},
+                {'Name': 'instance-type', 'Values': [instance_type]}] +
+                list(filters)):
+            if len(candidates) == count:
+                break
+
+            candidates.append(instance)
+
+        failed = self.run_commands(candidates, 'sudo shutdown -c')
+        adopted = []
+
+        for instance in candidates:
+            if instance in failed:
+                instance.terminate()
+                self.output.put(('status', instance.id, 'removed'))
+            else:
+                adopted.append(instance)
+                self.output.put(('status', instance.id, 'adopted'))
+
+        if len(adopted) > 0:
+            self.ec2.create_tags(Resources=[i.id for i in adopted],
+                                 Tags=[{'Key': 'loadr-state',
+                                        'Value': 'busy'}])
+
+        return adopted
+
+    def run_commands(self, instances, command):
+        """Runs a command on the instances by ssh, at most
+        concurrent_ssh_sessions at a time, and returns those where it failed.
+        """
+
+        def run(instance):
+            client = self.connect(instance)
+
+            try:
+                stdin, stdout, stderr = client.exec_command(command)
+
+                if stdout.channel.recv_exit_status() != 0:
+                    raise OSError('"{}" failed'.format(command))
+            finally:
+                client.close()
+
+        failed = []
+
+        with ThreadPoolExecutor(self.concurrent_ssh_sessions) as executor:
+            futures = {executor.submit(run, i): i for i in instances}
+
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    failed.append(futures[future])
+                    self.output.put(('error', futures[future].id,
+                                     'Command failed: {}'.format(e)))
+
+        return failed
+
+    def reap_pool(self):
+        """Terminates the pool's instances which have been idle for longer
+        than pool_ttl.
+        """
+
+        for instance in self.pool_instances('idle'):
+            tags = {tag['Key']: tag['Value'] for tag in instance.tags or []}
+
+            if float(tags.get('loadr-idle-since', 0)) + self.pool_ttl < time():
+                instance.terminate()
+                self.output.put(('status', instance.id, 'removed'))
 
     def remove_instances(self, wait=True):
-        """Terminates all instances.
+        """Terminates all instances, or returns them to the pool as idle.
+        The idle instances are given shutdown timers of pool_ttl, so that
+        they're terminated even if no session follows, and those whose
+        timers can't be set are terminated at once.
         This method is not thread-safe.
         """
 
-        for i in self.messengers + self.instances:
-            i.terminate()
+        if self.pool_ttl is not None:
+            failed = self.run_commands(
+                self.messengers + self.instances,
+                'sudo shutdown -h +{}'.format(math.ceil(self.pool_ttl / 60)))
+
+            for i in failed:
+                i.terminate()
+                self.output.put(('status', i.id, 'removed'))
+
+            self.messengers = [i for i in self.messengers if i not in failed]
+            self.instances = [i for i in self.instances if i not in failed]
+            instances = self.messengers + self.instances
+
+            if len(instances) > 0:
+                self.ec2.create_tags(Resources=[i.id for i in instances],
+                                     Tags=[{'Key': 'loadr-state',
+                                            'Value': 'idle'},
+                                           {'Key': 'loadr-idle-since',
+                                            'Value': str(int(time()))}])
+
+            self.reap_pool()
+        else:
+            for i in self.messengers + self.instances:
+                i.terminate()
 
         if wait:
             self.wait_for_removed_instances()
 
     def wait_for_removed_instances(self):
-        """Blocks current thread until all instances are terminated.
+        """Blocks current thread until all instances are terminated, or
+        returned to the pool.
         This method must be thread-safe.
         """
 
         for i in self.messengers + self.instances:
+            if self.pool_ttl is not None:
+                self.output.put(('status', i.id, 'idle'))
+                continue
+
             i.wait_until_terminated()
             self.output.put(('status', i.id, 'removed'))
 
+        self.messengers = []
         self.instances = []
 
-    def run_single_worker(self, instance, messenger,
-                          concurrency, repeat, requests):
-        """Creates a ssh connection to specified instance,
-        uploads wrkloadr.py and runs it. It will the write all stdout to
-        specified writer.
-        Used by the run_multiple_workers method.
+    def ssh_backoff(self, attempt):
+        """Returns how long to wait before the next ssh connection attempt.
+        It doubles for each attempt, up to ssh_retry_max_timeout.
         """
 
-        self.output.put(('status', instance.id, 'connecting'))
+        return min(self.ssh_retry_timeout * 2 ** attempt,
+                   self.ssh_retry_max_timeout)
 
-        # Get all the necessary data for the instance,
-        # like IP and dns name.
-        messenger.wait_until_running()
-        messenger.load()
-        instance.wait_until_running()
-        instance.load()
+    def connect(self, instance):
+        """Creates a ssh connection to specified instance. The first attempt is
+        made at once, and then retried with an exponential backoff until the
+        instance responds.
+        """
 
         client = paramiko.SSHClient()
         client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
 
-        keyfile = StringIO(self.keypair.key_material)
+        keyfile = StringIO(self.key_material)
         key = paramiko.RSAKey.from_private_key(keyfile)
+        keyfile.close()
 
         # Retry loop
         for r in range(self.ssh_retries):
-            # It will take at least 60 seconds before the server is responding
-            sleep(self.ssh_retry_timeout)
-
             try:
                 client.connect(instance.public_dns_name,
                                username='ec2-user',
@@ -295,85 +805,172 @@ pip install pika requests
                                look_for_keys=False,
                                timeout=self.ssh_timeout)
                 self.output.put(('status', instance.id, 'connected'))
-                break
-            except:
-                if r == retries - 1:
+                return client
+            except (paramiko.SSHException, OSError):
+                if r == self.ssh_retries - 1:
                     raise
 
-        # Upload wrkloadr
-        sftp = client.open_sftp()
-        sftp.put('wrkloadr.py', 'wrkloadr.py')
+            self.output.put(('status', instance.id,
+                             'retrying connection ({}/{})'.format(
+                                r + 1, self.ssh_retries - 1)))
+            sleep(self.ssh_backoff(r))
 
-        # Then execute
-        client.exec_command('sh -c "python wrkloadr.py \'{}\' {} {} \'{}\' & echo $!"'.format(
-            self.get_messenger_url(messenger),
-            concurrency,
-            repeat,
-            json.dumps(requests)))
-        self.output.put(('status', instance.id, 'running command'))
-
-        # Close and quit
-        client.close()
-        keyfile.close()
-
-    def run_multiple_workers(self, concurrency, repeat, requests, starttime):
-        """Runs multiple workers on each instance.
-        Each worker within its own thread.
-        Used run_single_worker method.
+    def run_single_worker(self, instance, messenger,
+                          concurrency, repeat, requests, options=None):
+        """Creates a ssh connection to specified instance,
+        uploads wrkloadr.py, and the instance's partition of the feed and
+        replay files if any, and runs it in the background.
+        Used by the run_multiple_workers method.
+        Returns the number of seconds it took.
         """
 
-        # Initialize the instance processes
-        mp = get_context('fork')
-        processes = []
+        begintime = time()
+        self.output.put(('status', instance.id, 'connecting'))
 
-        for i, messenger in enumerate(self.messengers):
-            for instance in self.instances[i * self.instances_per_messenger:]:
-                processes.append(mp.Process(target=self.run_single_worker,
-                                            args=(instance, messenger,
-                                                  concurrency, repeat, requests)))
+        # Get all the necessary data for the instance,
+        # like IP and dns name.
+        instance.wait_until_running()
+        instance.load()
 
-        # This is not correct!
-        # Rewrite this!
+        client = self.connect(instance)
+
+        options = dict(options or {})
+
+        try:
+            sftp = client.open_sftp()
+
+            # Upload wrkloadr, unless it's baked into the image
+            if not self.bake:
+                sftp.put('wrkloadr.py', 'wrkloadr.py')
+
+            # Upload the instance's partition of the feed and replay files
+            # from this machine, which the worker then reads from its home
+            # directory
+            for name, cls, encoding in (('feed', Feeder, None),
+                                        ('replay', Replay, 'utf-8')):
+                if options.get(name):
+                    path = options[name]['path']
+                    remote = '{}-{}'.format(name, os.path.basename(path))
+                    local = dict(options[name],
+                                 path=os.path.expanduser(path))
+
+                    with tempfile.TemporaryFile(
+                            'w+b' if encoding is None else 'w+',
+                            encoding=encoding) as f:
+                        config = cls(local).extract(f)
+                        f.seek(0)
+                        sftp.putfo(f, remote)
+
+                    options[name] = dict(config, path=remote)
+
+            sftp.close()
+
+            # Then execute, and wait for its pid to know that it's started
+            command = ' '.join([self.workers_python, 'wrkloadr.py'] +
+                               [shlex.quote(str(arg)) for arg in [
+                                   self.get_messenger_url(messenger),
+                                   concurrency,
+                                   repeat,
+                                   json.dumps(requests),
+                                   json.dumps(options)]])
+            stdin, stdout, stderr = client.exec_command(
+                'sh -c {}'.format(shlex.quote(
+                    'nohup {} > /dev/null 2>&1 & echo $!'.format(command))))
+            stdout.readline()
+            self.output.put(('status', instance.id, 'running command'))
+        finally:
+            # Close and quit
+            client.close()
+
+        return time() - begintime
+
+    def run_multiple_workers(self, concurrency, repeat, requests,
+                             options=None):
+        """Deploys and runs the workers on all instances, at most
+        concurrent_ssh_sessions at a time. Reports the deploy time when all
+        are done, and then starts the workers through the messengers.
+        Uses the run_single_worker method.
+        """
+
+        begintime = time()
 
-        for i in range(0, self.concurrent_ssh_sessions - 1):
-            # Start processes
-            for p in processes[i * self.concurrent_ssh_sessions:]:
-                p.start()
+        # Get all the necessary data for the messengers, like the dns name,
+        # once before the workers need them.
+        for messenger in self.messengers:
+            messenger.wait_until_running()
+            messenger.load()
 
-            # Then wait for all processes to end
-            for p in processes[i * self.concurrent_ssh_sessions:]:
-                p.join()
+        times = []
+        failed = 0
+
+        with ThreadPoolExecutor(self.concurrent_ssh_sessions) as executor:
+            futures = {}
+
+            for i, messenger in enumerate(self.messengers):
+                for j, instance in enumerate(
+                        self.instances[
+                            i * self.instances_per_messenger:
+                            (i + 1) * self.instances_per_messenger],
+                        i * self.instances_per_messenger):
+                    # Each instance gets its own partition of the feed
+                    futures[executor.submit(
+                        self.run_single_worker,
+                        instance, messenger,
+                        concurrency, repeat, requests,
+                        partitioned(options or {}, j,
+                                    len(self.instances)))] = instance
+
+            for future in as_completed(futures):
+                instance = futures[future]
+
+                try:
+                    times.append(future.result())
+                    self.output.put(('status', instance.id,
+                                     'deployed in {:.1f} s'.format(times[-1])))
+                except Exception as e:
+                    failed += 1
+                    self.output.put(('error', instance.id,
+                                     'Deploy failed: {}'.format(e)))
+
+        self.output.put(('deploy', 'awsec2',
+                         {'instances': len(futures),
+                          'failed': failed,
+                          'seconds': round(time() - begintime, 3),
+                          'slowest': round(max(times, default=0), 3)}))
 
         # Define a start time
-        starttime = int(round(time() + 70))
-        sleep(60)
+        starttime = time() + self.start_delay
 
         waiters = []
 
-        # Collect and redirect data
+        # Send a run messege to all messengers
+        # and start receiving data from all messengers
         for messenger in self.messengers:
-            # Get all the necessary data for the instance,
-            # like IP and dns name.
-            # Even if this was done in run_single_repeater - it was done in
-            # another thread, and the data isn't accessable here.
-            messenger.wait_until_running()
-            messenger.load()
-
-            # Send a run messege to all messengers
-            # and start receiving data from all messengers
             broker = Messenger(self.get_messenger_url(messenger),
                                starttime,
                                self.output)
-            waiters.append(broker.connect())
-            waiters.append(broker.listen())
+            waiters.append(broker.start())
 
         loop = asyncio.get_event_loop()
-        loop.run_until_complete(asyncio.wait(waiters))
+        loop.run_until_complete(asyncio.gather(*waiters))
+
+    def control(self, command):
+        """Broadcasts a control command to the running workers through all
+        messengers.
+        """
+
+        for messenger in self.messengers:
+            # The public name is only known once running
+            messenger.reload()
+            broadcast(self.get_messenger_url(messenger), command)
 
     def shutdown(self):
-        """Deletes keys and policies.
+        """Deletes keys and policies, unless they're kept for the pool.
         """
 
+        if self.pool_ttl is not None:
+            return
+
         if self.keypair is not None:
             self.keypair.delete()
             self.keypair = None
@@ -17,22 +17,167 @@ You should have received a copy of the GNU General Public License
 along with loadr.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import os
+import struct
 import sys
 
-from functools import partial
-from multiprocessing import Array
+from multiprocessing import Process, RawArray, Value, cpu_count
+from threading import Event, Thread
+from time import sleep
 
-from wrkloadr import multirepeater
+from wrkloadr import (BATCH_STATUSES, Control, asyncrepeater, clientdefaults,
+                      compileconfig, configdefaults, optiondefaults,
+                      partitioned, raterepeater, ratedefaults,
+                      replayrepeater)
+
+
+# Ring record: number of columns, ci, ri, rri, status and then start, end
+# and room for extra columns as 64 bit integers.
+RING_ROW = struct.Struct('<BIIIh' + 'q' * 10)
+
+
+class Ring:
+    """A single-producer single-consumer ring buffer of fixed-size data rows
+    in shared memory.
+
+    The producer, a worker process, only moves the write position and the
+    consumer only moves the read position, so no lock is needed. The
+    positions are counted from start and never wrap. If the ring is full the
+    producer waits for the consumer.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.buffer = RawArray('b', size * RING_ROW.size)
+        # Write and read positions
+        self.positions = RawArray('Q', 2)
+
+    def put(self, *data):
+        """Adds a data row. Blocks while the ring is full.
+        """
+
+        written = self.positions[0]
+
+        while written - self.positions[1] >= self.size:
+            sleep(0.001)
+
+        RING_ROW.pack_into(self.buffer,
+                           (written % self.size) * RING_ROW.size,
+                           len(data),
+                           data[0], data[1], data[2],
+                           BATCH_STATUSES.get(data[3], data[3]),
+                           *(data[4:] + (0,) * (14 - len(data))))
+        self.positions[0] = written + 1
+
+    def drain(self):
+        """Returns and removes all data rows in the ring, in bulk.
+        """
+
+        written, read = self.positions[0], self.positions[1]
+
+        if written == read:
+            return []
+
+        buffer = memoryview(self.buffer).cast('B')
+        start, end = read % self.size, written % self.size
+
+        if start < end:
+            records = list(RING_ROW.iter_unpack(
+                buffer[start * RING_ROW.size:end * RING_ROW.size]))
+        else:
+            records = list(RING_ROW.iter_unpack(
+                buffer[start * RING_ROW.size:])) + \
+                list(RING_ROW.iter_unpack(buffer[:end * RING_ROW.size]))
+
+        self.positions[1] = written
+
+        return [r[1:r[0] + 1] for r in records]
+
+
+class RingPool:
+    """A set of Rings, one for each worker process.
+    The worker processes claims their Ring when they start.
+    """
+
+    def __init__(self, count, size):
+        self.rings = [Ring(size) for i in range(count)]
+        self.claimed = Value('i', 0)
+
+    def claim(self):
+        with self.claimed.get_lock():
+            ring = self.rings[self.claimed.value]
+            self.claimed.value += 1
+
+        return ring
+
+    def drain(self):
+        rows = []
+
+        for ring in self.rings:
+            rows += ring.drain()
+
+        return rows
+
+
+class RingWriter:
+    """An output writer that puts data rows into a Ring in shared memory.
+    Other kind of data, like histograms, are put into the session's output
+    Queue.
+    """
+
+    def __init__(self, pool, output, instance):
+        self.ring = pool.claim()
+        self.output = output
+        self.instance = instance
+
+    def wait(self):
+        pass
+
+    def write(self, *data):
+        self.ring.put(*data)
+
+    def record(self, kind, data):
+        self.output.put((kind, self.instance, data))
+
+    def close(self):
+        pass
 
 
 class Localhost:
+    """Runs the workers on this machine, with each instance as a shard: one
+    process pinned to a CPU core, which runs its virtual users as coroutines
+    by the async engine. With 0 instances there's one shard per available
+    core.
+
+    Each shard writes its data rows into its own RingPool, which is drained
+    in bulk into the output Queue, in one batch per shard. The control
+    commands reach them through a Control in shared memory.
+    """
+
+    # Number of data rows in each shard's Ring
+    ring_size = 4096
+    # How long to sleep when the Rings are empty
+    drain_interval = 0.01
+
+    def __init__(self, output, cores=None):
+        """
+            output = Queue
+            cores = The CPU cores to pin the shards to, defaults to all
+                    available cores
+        """
 
-    def __init__(self, output):
         self.output = output
+        self.cores = cores if cores is not None else availablecores()
         self.instances = []
+        self.workers_control = Control()
 
     def create_instances(self, instances, wait=None):
+        if not instances:
+            instances = len(self.cores)
+
         self.instances = ['localhost-%d' % i for i in range(instances)]
+        # Shared with the workers, so it's created before they're forked
+        self.workers_control = Control()
 
     def wait_for_running_instances(self):
         pass
@@ -43,23 +188,120 @@ class Localhost:
     def wait_for_removed_instances(self):
         pass
 
-    def writer(self, instance, *data):
-        csv = ','.join([str(v) for v in data])
-        self.output.put(('data', instance, csv))
-
-    def run_single_worker(self, instance, concurrency,
-                          repeat, requests):
-        multirepeater(concurrency,
-                      repeat,
-                      partial(self.writer, instance),
-                      requests)
-
-    def run_multiple_workers(self, concurrency, repeat, requests):
-        self.run_single_worker('localhost',
-                               len(self.instances) * concurrency,
-                               repeat,
-                               requests)
+    def drain(self, pools, stopped):
+        """Moves data rows from the shards' pools, by instance, into the
+        output Queue until stopped is set, and then a last time.
+        """
+
+        statuses = {val: key for key, val in BATCH_STATUSES.items()}
+
+        while True:
+            stopping = stopped.is_set()
+            drained = False
+
+            for instance, pool in pools.items():
+                rows = pool.drain()
+
+                if not rows:
+                    continue
+
+                drained = True
+                self.output.put(('data', instance, '\n'.join(
+                    [','.join([str(v) for v in row[:3]] +
+                              [str(statuses.get(row[3], row[3]))] +
+                              [str(v) for v in row[4:]])
+                     for row in rows])))
+
+            if stopping:
+                break
+
+            if not drained:
+                sleep(self.drain_interval)
+
+    def run_single_worker(self, i, pool, concurrency, repeat, config,
+                          options):
+        """Returns the process of shard i, pinned to its core, with
+        concurrency virtual users and its partitions of the feed and the
+        replay.
+        """
+
+        writer = (RingWriter, pool, self.output, self.instances[i])
+        options = partitioned(options, i, len(self.instances))
+
+        if options['replay'] is not None:
+            target = replayrepeater
+            args = (concurrency, writer, options, self.workers_control)
+        elif options['rate'] is not None:
+            # The shards' arrivals are interleaved
+            target = raterepeater
+            args = (concurrency, writer, config, options['rate'],
+                    1, i / len(self.instances), options,
+                    self.workers_control)
+        else:
+            target = asyncrepeater
+            args = (concurrency, repeat, writer, config, options,
+                    self.workers_control)
+
+        return Process(target=pinned,
+                       args=(self.cores[i % len(self.cores)], target) + args)
+
+    def run_multiple_workers(self, concurrency, repeat, requests,
+                             options=None):
+        config = configdefaults(requests)
+        options = optiondefaults(options)
+        options['engine'] = 'async'
+        options['client'] = clientdefaults(options['client'], 'async')
+
+        if options['rate'] is not None:
+            options['rate'] = ratedefaults(options['rate'], config)
+
+        # Compiled once, before the shards are forked
+        config = compileconfig(config)
+        pools = {instance: RingPool(1, self.ring_size)
+                 for instance in self.instances}
+        processes = [self.run_single_worker(i, pools[instance], concurrency,
+                                            repeat, config, options)
+                     for i, instance in enumerate(self.instances)]
+        stopped = Event()
+        drainer = Thread(target=self.drain, args=(pools, stopped))
+        drainer.start()
+
+        for p in processes:
+            p.start()
+
+        for p in processes:
+            p.join()
+
+        stopped.set()
+        drainer.join()
         self.output.put(('status', 'localhost', 'ended'))
 
+    def control(self, command):
+        """Applies a control command to the running workers.
+        """
+
+        self.workers_control.command(**command)
+
     def shutdown(self):
         pass
+
+
+def availablecores():
+    """Returns the CPU cores this process may run on.
+    """
+
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+
+    return list(range(cpu_count()))
+
+
+def pinned(core, target, *args):
+    """Runs target with arguments pinned to a CPU core, where the platform
+    supports it.
+    """
+
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, {core})
+
+    target(*args)
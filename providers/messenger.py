@@ -18,19 +18,66 @@ along with loadr.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import asyncio
+import json
 import pika
 
-from time import time
+from pika.adapters.asyncio_connection import AsyncioConnection
+from time import time, time_ns
+
+from wrkloadr import BATCH_CONTENT_TYPE, CONTROL_TYPE, decodebatch
+
+
+def resolver(future):
+    """Returns a pika callback which resolves future with the first argument.
+    """
+
+    def callback(*args):
+        if not future.done():
+            future.set_result(args[0] if args else None)
+
+    return callback
+
+
+def broadcast(url, command):
+    """Broadcasts a control command, like {"command": "pause"}, to all
+    workers of a RabbitMQ messenger, by its signal exchange. See
+    wrkloadr.Control for the commands.
+    """
+
+    connection = pika.BlockingConnection(pika.URLParameters(url))
+
+    try:
+        channel = connection.channel()
+        channel.exchange_declare(exchange='loadr-signal',
+                                 exchange_type='fanout')
+        channel.basic_publish(exchange='loadr-signal',
+                              routing_key='',
+                              body=json.dumps(command),
+                              properties=pika.BasicProperties(
+                                  content_type='application/json',
+                                  type=CONTROL_TYPE))
+    finally:
+        connection.close()
 
 
 class Messenger:
     """Messenger bridge between provider and it's running instances.
-    It's asynchronous and based on RabbitMQ with the pika module.
+    It's asynchronous and based on RabbitMQ with the pika module's asyncio
+    connection adapter, so it never blocks the event loop.
 
     When initiated, it requires a starttime. This starttime is sent to the
     RabbitMQ server and will be recieved by the instances as a start-signal for
     a synchronized start.
 
+    The instances ping the messenger on the loadr-ping queue before starting,
+    and get this clock's time in microseconds back, to estimate their clock's
+    offset to it.
+
+    Incoming data is pushed by RabbitMQ to a consumer, with at most prefetch
+    unacknowledged messages on the way. They are acknowledged in bulk, every
+    ack_batch messages or every ack_interval seconds. The rows of a batch are
+    put into the output Queue as one data message, a line per row.
+
     Using it async:
         m = Messenger("RabbitMQ-url", time(), Queue())
         await m.connect() # Connects to RabbitMQ and sends start-signal
@@ -46,13 +93,20 @@ class Messenger:
     timeout = 60
     # When was the last time we got any data.
     last_fetched_time = 0
+    # Max number of unacknowledged messages pushed to the consumer.
+    prefetch = 1000
+    # Acknowledge after this many messages...
+    ack_batch = 100
+    # ...or after this many seconds.
+    ack_interval = 0.5
 
-    def __init__(self, url, starttime, output):
+    def __init__(self, url, starttime, output, prefetch=None):
         """
             url = RabbitMQ-url
             starttime = When to start the instances requests,
                         unix timestamp
             output = Queue
+            prefetch = Max number of unacknowledged messages
         """
 
         self.url = url
@@ -60,53 +114,150 @@ class Messenger:
         self.starttime = starttime
         self.output = output
 
-    @asyncio.coroutine
-    def connect(self):
+        if prefetch is not None:
+            self.prefetch = prefetch
+
+        self.connection = None
+        self.channel = None
+        self.connected = asyncio.Event()
+        # Delivery tag of the last message and how many are unacknowledged
+        self.delivery_tag = None
+        self.unacked = 0
+
+    async def connect(self):
         """Asynchronous connection and signal-sender.
         Connects to RabbitMQ-url and sends a start-signal.
         """
 
-        parameters = pika.URLParameters(self.url)
-        self.connection = pika.BlockingConnection(parameters)
-        self.channel = self.connection.channel()
+        loop = asyncio.get_event_loop()
+        opened = loop.create_future()
+
+        def failed(connection, error):
+            if not opened.done():
+                opened.set_exception(
+                    pika.exceptions.AMQPConnectionError(error))
+
+        self.closed = loop.create_future()
+        self.connection = AsyncioConnection(pika.URLParameters(self.url),
+                                            on_open_callback=resolver(opened),
+                                            on_open_error_callback=failed,
+                                            on_close_callback=resolver(
+                                                self.closed),
+                                            custom_ioloop=loop)
+        await opened
+
+        future = loop.create_future()
+        self.connection.channel(on_open_callback=resolver(future))
+        self.channel = await future
 
+        future = loop.create_future()
         self.channel.exchange_declare(exchange='loadr-signal',
-                                      exchange_type='fanout')
-        self.channel.queue_declare(queue='loadr-data')
+                                      exchange_type='fanout',
+                                      callback=resolver(future))
+        await future
+
+        future = loop.create_future()
+        self.channel.queue_declare(queue='loadr-data',
+                                   callback=resolver(future))
+        await future
+
+        future = loop.create_future()
+        self.channel.queue_declare(queue='loadr-ping',
+                                   callback=resolver(future))
+        await future
+
+        self.channel.basic_consume(queue='loadr-ping',
+                                   on_message_callback=self.pong,
+                                   auto_ack=True)
 
         self.channel.basic_publish(exchange='loadr-signal',
                                    routing_key='',
                                    body=str(self.starttime))
 
-    @asyncio.coroutine
-    def listen(self):
+        self.connected.set()
+
+    async def listen(self):
         """Asynchronous listens for incoming data.
         When data hasn't been seen since specified timeout - it ends.
         """
 
-        while True:
-            try:
-                m, p, b = self.channel.basic_get(queue='loadr-data')
+        await self.connected.wait()
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self.channel.basic_qos(prefetch_count=self.prefetch,
+                               callback=resolver(future))
+        await future
 
-                if b is not None:
-                    self.last_fetched_time = time()
-                    self.output.put(('data', 'messenger', b.decode()))
-                    self.channel.basic_ack(m.delivery_tag)
-            except:
-                pass
+        self.channel.basic_consume(queue='loadr-data',
+                                   on_message_callback=self.receive)
+
+        # The timeout counts from when the listening starts, at the earliest,
+        # since the workers don't send anything before the start time
+        self.last_fetched_time = max(self.last_fetched_time, time())
+
+        while True:
+            await asyncio.sleep(self.ack_interval)
+            self.ack()
 
             if self.last_fetched_time + self.timeout < time():
                 break
 
-            yield from asyncio.sleep(1)
+        self.ack()
+        self.connection.close()
+        await self.closed
+
+    def receive(self, channel, method, properties, body):
+        """Consumer callback. Puts the message's data into the output Queue.
+        """
+
+        self.last_fetched_time = time()
+        # Which instance the data comes from, if the worker tells
+        source = properties.app_id or 'messenger'
+
+        if properties.content_type == BATCH_CONTENT_TYPE:
+            # The whole batch as one data message, since each message costs
+            # a pickle and a write to the Queue's pipe
+            self.output.put(('data', source, '\n'.join(
+                [','.join([str(v) for v in row])
+                 for row in decodebatch(body)])))
+        elif properties.type is not None:
+            # Other kind of data, like histograms, as json
+            self.output.put((properties.type, source,
+                             json.loads(body.decode())))
+        else:
+            self.output.put(('data', source, body.decode()))
+
+        self.delivery_tag = method.delivery_tag
+        self.unacked += 1
+
+        if self.unacked >= self.ack_batch:
+            self.ack()
+
+    def pong(self, channel, method, properties, body):
+        """Ping consumer callback. Answers with the time in microseconds.
+        """
+
+        channel.basic_publish(exchange='',
+                              routing_key=properties.reply_to,
+                              body=str(time_ns() // 1000),
+                              properties=pika.BasicProperties(
+                                  correlation_id=properties.correlation_id))
+
+    def ack(self):
+        """Acknowledges all messages up to the last received, at once.
+        """
+
+        if self.unacked > 0 and self.channel.is_open:
+            self.channel.basic_ack(self.delivery_tag, multiple=True)
+            self.unacked = 0
 
-    @asyncio.coroutine
-    def start(self):
+    async def start(self):
         """Async waiter for connect and listen methods.
         """
 
-        return asyncio.wait([self.connect(),
-                             self.listen()])
+        await asyncio.gather(self.connect(),
+                             self.listen())
 
     def wait(self):
         """Synchronized wrapper for start().
@@ -24,9 +24,12 @@ setup(
     version='0.1',
     py_modules=['loadr'],
     install_requires=[
+        'aiohttp',
         'boto3',
         'click',
         'gnupg',
+        'numpy',
+        'pandas',
         'paramiko',
         'puka',
         'requests'
@@ -36,5 +39,7 @@ setup(
         loadr=cli:main
         wrkloadr=cli:worker
         clustrloadr=cli:cluster
+        reportloadr=cli:report
+        benchloadr=cli:bench
     ''',
 )
@@ -0,0 +1,48 @@
+"""
+Copyright (c) 2016 Olof Montin <olof@thebrewery.se>
+
+This file is part of loadr.
+
+loadr is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+loadr is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with loadr.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import requests
+
+from time import monotonic
+from unittest import TestCase
+
+from benchmarks import StubServer
+
+
+class TestStubServer(TestCase):
+
+    def test_server(self):
+        server = StubServer(latency=0.05, payload=100)
+        server.start()
+
+        try:
+            with requests.Session() as sess:
+                start = monotonic()
+                res = sess.post(server.url + '/login', json={'a': 1})
+                elapsed = monotonic() - start
+                again = sess.get(server.url + '/items/' + res.json()['token'])
+        finally:
+            server.stop()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(res.json()['token']), 32)
+        self.assertEqual(res.json()['payload'], 'x' * 100)
+        self.assertGreaterEqual(elapsed, 0.05)
+        self.assertEqual(again.json(), res.json())
+        self.assertEqual(server.requests, 2)
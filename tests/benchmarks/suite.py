@@ -0,0 +1,58 @@
+"""
+Copyright (c) 2016 Olof Montin <olof@thebrewery.se>
+
+This file is part of loadr.
+
+loadr is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+loadr is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with loadr.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from unittest import TestCase
+
+from benchmarks import Suite, compare
+
+
+class TestSuite(TestCase):
+
+    def test_run(self):
+        suite = Suite(concurrencies=(2,), requests=20)
+        suite.engines = ('async',)
+        suite.pipeline_rows = 1000
+        results = suite.run()
+
+        self.assertEqual(sorted(results), ['localhost/2',
+                                           'multirepeater/async/2',
+                                           'pipeline/batch',
+                                           'pipeline/ring'])
+        self.assertEqual(results['multirepeater/async/2']['requests'], 20)
+        self.assertEqual(results['multirepeater/async/2']['errors'], 0)
+        self.assertEqual(results['localhost/2']['requests'], 20)
+        self.assertEqual(results['pipeline/ring']['requests'], 1000)
+        self.assertIsNone(results['pipeline/ring']['memory'])
+
+        for result in results.values():
+            self.assertGreater(result['rps'], 0)
+            self.assertGreater(result['cpu'], 0)
+
+    def test_compare(self):
+        baseline = {'results': {'a': {'rps': 100, 'cpu': 10, 'memory': 1000},
+                                'b': {'rps': 100, 'cpu': 10, 'memory': None}}}
+        results = {'a': {'rps': 85, 'cpu': 10.5, 'memory': 1200},
+                   'b': {'rps': 200, 'cpu': 5, 'memory': None},
+                   'c': {'rps': 1, 'cpu': 1000, 'memory': 1}}
+
+        self.assertEqual(compare(results, baseline, 10),
+                         ['a: memory is 1200.0, +20.0% from the baseline '
+                          '1000.0',
+                          'a: rps is 85.0, -15.0% from the baseline 100.0'])
+        self.assertEqual(compare(results, None), [])
@@ -56,7 +56,8 @@ class TestClustrloadr(TestCase):
                 break
 
             if data[0] == 'data':
-                self.assertRegex(data[2], '^([0-9]+,){5}[0-9]+$')
-                lines += 1
+                for line in data[2].splitlines():
+                    self.assertRegex(line, '^([0-9]+,){5}[0-9]+$')
+                    lines += 1
 
         self.assertEqual(lines, 20)
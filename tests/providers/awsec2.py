@@ -41,3 +41,19 @@ class TestAwsec2(TestLocalhost):
                                                'instance_type': 't2.micro',
                                                'image_id': 'ami-d22932be',
                                                'region': 'eu-central-1'}})
+
+    def test_ssh_backoff(self):
+        self.assertEqual([self.provider.ssh_backoff(r) for r in range(6)],
+                         [2, 4, 8, 16, 30, 30])
+
+    def test_image_name(self):
+        name = self.provider.image_name('worker', 'ami-d22932be', 'install',
+                                        ['wrkloadr.py'])
+
+        self.assertTrue(name.startswith('loadr-worker-'))
+        self.assertEqual(name,
+                         self.provider.image_name('worker', 'ami-d22932be',
+                                                  'install', ['wrkloadr.py']))
+        self.assertNotEqual(name,
+                            self.provider.image_name('worker', 'ami-d22932be',
+                                                     'install'))
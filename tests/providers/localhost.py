@@ -25,7 +25,8 @@ from multiprocessing import Process, Queue
 from time import time
 
 from clustrloadr import Session
-from providers.localhost import Localhost
+from providers.localhost import (Localhost, Ring, RingPool, RingWriter,
+                                 availablecores)
 
 
 class TestLocalhost(unittest.TestCase):
@@ -49,13 +50,10 @@ class TestLocalhost(unittest.TestCase):
         self.provider.wait_for_running_instances()
         self.assertEqual(len(self.provider.instances), 1)
 
-        starttime = time() + 10
-
         self.provider.run_multiple_workers(concurrency=2,
                                            repeat=3,
                                            requests=[{'method': 'get',
-                                                      'url': 'https://google.com?q=loadr'}],
-                                           starttime=starttime)
+                                                      'url': 'https://google.com?q=loadr'}])
 
         stdout = []
         stderr = ''
@@ -67,7 +65,8 @@ class TestLocalhost(unittest.TestCase):
                 break
 
             if data[0] == 'data':
-                stdout.append(data)
+                self.assertEqual(data[1], 'localhost-0')
+                stdout += data[2].splitlines()
 
             if data[0] == 'error':
                 sys.stderr.write(data[2])
@@ -83,6 +82,56 @@ class TestLocalhost(unittest.TestCase):
         self.provider.wait_for_removed_instances()
         self.assertEqual(len(self.provider.instances), 0)
 
+    def test_shards(self):
+        self.provider.create_instances(0)
+        self.assertEqual(len(self.provider.instances), len(availablecores()))
+
+        provider = Localhost(output=self.output, cores=[0])
+        provider.create_instances(2)
+        self.assertEqual(len(provider.instances), 2)
+
+    def test_ring(self):
+        ring = Ring(4)
+
+        for i in range(3):
+            ring.put(i, 0, 0, 200, 1, 2)
+
+        self.assertEqual(ring.drain(), [(i, 0, 0, 200, 1, 2)
+                                        for i in range(3)])
+        self.assertEqual(ring.drain(), [])
+
+        # Wraps around the end of the buffer
+        for i in range(4):
+            ring.put(i, 1, 0, 'connection-error', 1, 2, 3)
+
+        self.assertEqual(ring.drain(), [(i, 1, 0, -1, 1, 2, 3)
+                                        for i in range(4)])
+
+    def test_ringwriter(self):
+        pool = RingPool(2, 16)
+        writers = [RingWriter(pool, self.output, 'localhost-0')
+                   for i in range(2)]
+
+        def produce(writer):
+            for i in range(100):
+                writer.write(i, 0, 0, 200, 1, 2)
+
+        processes = [Process(target=produce, args=(writer,))
+                     for writer in writers]
+        rows = []
+
+        for p in processes:
+            p.start()
+
+        while len(rows) < 200:
+            rows += pool.drain()
+
+        for p in processes:
+            p.join()
+
+        self.assertEqual(sorted([row[0] for row in rows]),
+                         sorted(list(range(100)) * 2))
+
     def test_session(self):
         self.session.requests([{'url': 'http://thebrewery.se'}])
         self.session.start([{'provider': 'provider-1',
@@ -106,7 +155,8 @@ class TestLocalhost(unittest.TestCase):
                 break
 
             if data[0] == 'data':
-                self.assertRegex(data[2], '^([0-9]+,){5}[0-9]+$')
-                lines += 1
+                for line in data[2].splitlines():
+                    self.assertRegex(line, '^([0-9]+,){5}[0-9]+$')
+                    lines += 1
 
         self.assertEqual(lines, 20)
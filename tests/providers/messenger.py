@@ -67,7 +67,7 @@ class TestMessenger(TestCase):
 
             waiters = [messenger.connect(), messenger.listen()]
             loop = asyncio.get_event_loop()
-            loop.run_until_complete(asyncio.wait(waiters))
+            loop.run_until_complete(asyncio.gather(*waiters))
 
             lines = 0
 
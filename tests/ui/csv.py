@@ -35,6 +35,7 @@ class TestCsv(TestCase):
         command_run = output.recv()
         self.assertEqual(command_run, ('command', 'run'))
 
+        queue.put(('status', 'session', 'ended'))
         command_quit = output.recv()
         self.assertEqual(command_quit, ('command', 'quit'))
 
@@ -23,6 +23,7 @@ from multiprocessing import get_context
 from unittest import TestCase
 
 from ui import get_ui
+from ui.text import StepStats
 
 class TestText(TestCase):
 
@@ -45,7 +46,24 @@ class TestText(TestCase):
                                              str(i * random.randint(1, 10)),
                                              str(i * random.randint(1, 10))])))
 
+        queue.put(('status', 'session', 'ended'))
+
         command_quit = output.recv()
         self.assertEqual(command_quit, ('command', 'quit'))
 
         ui_process.terminate()
+
+    def test_stepstats(self):
+        stats = StepStats(window=2)
+
+        for second in range(10):
+            stats.record(second, 10 * second, second % 2)
+
+        rate, errors, histogram = stats.rolling()
+
+        self.assertEqual(sorted(stats.seconds), [8, 9])
+        self.assertEqual(rate, 1)
+        self.assertEqual(errors, 0.5)
+        self.assertEqual(histogram.count, 2)
+        self.assertEqual(stats.histogram.count, 10)
+        self.assertEqual(stats.errors, 5)
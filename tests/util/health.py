@@ -0,0 +1,74 @@
+"""
+Copyright (c) 2016 Olof Montin <olof@thebrewery.se>
+
+This file is part of loadr.
+
+loadr is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+loadr is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with loadr.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from unittest import TestCase
+
+from util.health import Saturation, saturated
+
+
+def record(start, end, cpu=10, lag=1000, backlog=1, host=20):
+    return {'start': start, 'end': end, 'cpu': cpu, 'host': host, 'lag': lag,
+            'backlog': backlog}
+
+
+class TestHealth(TestCase):
+
+    def test_saturation(self):
+        saturation = Saturation({'backlog': 10})
+
+        self.assertIsNone(saturation.flag('a', record(0, 100)))
+        self.assertEqual(saturation.flag('a', record(100, 200, cpu=99)),
+                         'a is saturated: cpu 99%')
+        # Another process of the same instance, overlapping
+        self.assertIsNone(saturation.flag('a', record(150, 300,
+                                                      lag=25000)))
+        self.assertEqual(saturation.flag('a', record(1000, 1100,
+                                                     backlog=11)),
+                         'a is saturated: backlog 11')
+        self.assertEqual(saturation.flag('b', record(0, 50, cpu=95,
+                                                     lag=10500)),
+                         'b is saturated: cpu 95%, lag 10.5 ms')
+
+        # Many processes, none of which uses a whole core
+        self.assertEqual(saturation.flag('d', record(0, 100, cpu=30,
+                                                     host=98)),
+                         'd is saturated: host cpu 98%')
+
+        self.assertEqual(saturation.intervals, {'a': [[100, 300],
+                                                      [1000, 1100]],
+                                                'b': [[0, 50]],
+                                                'd': [[0, 100]]})
+        self.assertEqual(saturation.seconds('a'), 0.0003)
+        self.assertEqual(saturation.exclusions(['b', 'c', 'a']),
+                         [(2, 100, 300), (2, 1000, 1100), (0, 0, 50)])
+
+        with self.assertRaises(ValueError):
+            Saturation({'memory': 1})
+
+    def test_saturated(self):
+        records = [{'type': 'clock', 'source': 'a',
+                    'data': {'offset': -50, 'rtt': 10}},
+                   {'type': 'health', 'source': 'a',
+                    'data': record(100, 200, cpu=95)},
+                   {'type': 'health', 'source': 'b',
+                    'data': record(100, 200)},
+                   {'type': 'expect', 'source': 'b', 'data': {}}]
+
+        self.assertEqual(saturated(records).intervals, {'a': [[50, 150]]})
+        self.assertEqual(saturated(records, {'cpu': 100}).intervals, {})
@@ -0,0 +1,118 @@
+"""
+Copyright (c) 2016 Olof Montin <olof@thebrewery.se>
+
+This file is part of loadr.
+
+loadr is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+loadr is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with loadr.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy
+
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from util import store
+from wrkloadr import PHASES, Histogram
+
+
+class TestStore(TestCase):
+
+    def test_storewriter(self):
+        with TemporaryDirectory() as path:
+            writer = store.StoreWriter(path, chunk_size=3)
+
+            for i in range(10):
+                writer.write(i, i % 2, 0, 200, 1000 * i, 1000 * i + 10)
+
+            writer.write(10, 0, 0, 'connection-error', 10000, 10020, 9990)
+            writer.write(11, 0, 0, 200, 11000, 11030, 11000, 1, 2, 3, 4, 5)
+            writer.close()
+
+            columns = store.load(path)
+
+            self.assertEqual(len(columns['end']), 12)
+            # Each chunk of three rows is sorted by step
+            self.assertEqual(list(columns['step'][:6]), [0, 0, 1, 0, 1, 1])
+            self.assertEqual(list(columns['cycle'][:6]), [0, 2, 1, 4, 3, 5])
+            self.assertEqual(columns['status'][9], -1)
+            self.assertEqual(columns['intended'][9], 9990)
+            self.assertEqual(columns['intended'][11], 9000)
+            # Rows without phases have them as -1
+            self.assertEqual([columns[phase][10] for phase in PHASES],
+                             [1, 2, 3, 4, 5])
+            self.assertEqual(columns['ttfb'][11], -1)
+
+            index = store.loadindex(path)
+
+            self.assertEqual(index[:2].tolist(), [[0, 0, 0, 2000, 0, 2],
+                                                  [0, 1, 1000, 1000, 2, 1]])
+            self.assertEqual(index[:, 5].sum(), 12)
+
+    def test_query(self):
+        with TemporaryDirectory() as path:
+            writer = store.StoreWriter(path, chunk_size=10)
+
+            for i in range(100):
+                writer.write(i, i % 3, 0, 200, 1000 * i, 1000 * i + 5,
+                             instance='worker-{}'.format(i % 2))
+
+            writer.close()
+
+            columns = store.query(path, instance='worker-1', step=2,
+                                  start=20000, end=60000)
+
+            self.assertEqual(sorted(columns['cycle'].tolist()),
+                             [23, 29, 35, 41, 47, 53, 59])
+            self.assertEqual(len(store.query(path)['cycle']), 100)
+            self.assertEqual(len(store.query(path, instance='none')['cycle']),
+                             0)
+
+    def test_merge(self):
+        values = numpy.array([0, 3, 2047, 2048, 10 ** 6, 2 ** 40 + 3],
+                             dtype=store.DTYPE)
+        histogram = Histogram()
+        expected = Histogram()
+
+        store.merge(histogram, values)
+
+        for value in values:
+            expected.record(int(value))
+
+        self.assertEqual(histogram.snapshot(), expected.snapshot())
+
+    def test_report(self):
+        with TemporaryDirectory() as path:
+            writer = store.StoreWriter(path)
+
+            for i in range(100):
+                writer.write(i, i % 2, 0, 500 if i % 10 == 0 else 200,
+                             1000000 * i, 1000000 * i + 1000 * i)
+
+            writer.close()
+
+            steps, statuses, timeline = store.report(path, chunk_size=7)
+
+            self.assertEqual(list(steps['requests']), [50, 50])
+            self.assertEqual(list(steps['errors']), [10, 0])
+            self.assertEqual(list(steps['max']), [98, 99])
+            self.assertEqual(list(statuses['status']), [200, 500, 200])
+            self.assertEqual(len(timeline), 100)
+            self.assertEqual(timeline['requests'].sum(), 100)
+
+            steps, statuses, timeline = store.report(
+                path, chunk_size=7, exclude=[(0, 0, 10000000),
+                                             (1, 0, 100000000)])
+
+            self.assertEqual(list(steps['requests']), [45, 45])
+            self.assertEqual(timeline['requests'].sum(), 90)
@@ -0,0 +1,71 @@
+"""
+Copyright (c) 2016 Olof Montin <olof@thebrewery.se>
+
+This file is part of loadr.
+
+loadr is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+loadr is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with loadr.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from unittest import TestCase
+
+from util.thresholds import Thresholds
+from wrkloadr import Histogram
+
+
+class TestThresholds(TestCase):
+
+    def test_thresholds(self):
+        thresholds = Thresholds({'p99': 50,
+                                 'errors': 10,
+                                 'min_requests': 10,
+                                 'steps': {'1': {'p99': 500}}})
+
+        for i in range(20):
+            status = '500' if i % 4 == 0 else '200'
+            thresholds.count(('data', 'instance',
+                              '{},0,0,{},0,{}'.format(i, status, 1000 * i)))
+            thresholds.count(('data', 'instance',
+                              '{},1,0,200,0,{}'.format(i, 1000 * i)))
+
+        self.assertEqual(thresholds.check(),
+                         ['Step 0: errors is 25.0%, above the threshold 10'])
+        self.assertEqual(thresholds.check(), [])
+
+        histogram = Histogram()
+        histogram.record(100000, 100)
+        thresholds.count(('histogram', 'instance', {'histograms': [
+            {'step': 1, 'status': 200, 'histogram': histogram.snapshot()}]}))
+
+        # Step 1 has its own p99 threshold
+        self.assertEqual(thresholds.check(), [])
+
+        thresholds.count(('histogram', 'instance', {'histograms': [
+            {'step': 0, 'status': 200, 'histogram': histogram.snapshot()}]}))
+
+        self.assertEqual(thresholds.check(),
+                         ['Step 0: p99 is 100.0 ms, above the threshold 50'])
+
+    def test_expect(self):
+        thresholds = Thresholds({'expect': 1, 'min_requests': 0})
+        thresholds.count(('expect', 'instance',
+                          {'steps': [{'step': 0,
+                                      'passed': 90,
+                                      'failed': {'status': 10}}]}))
+
+        self.assertEqual(thresholds.check(),
+                         ['Step 0: expect is 10.0%, above the threshold 1'])
+
+    def test_names(self):
+        with self.assertRaises(ValueError):
+            Thresholds({'p99': 50, 'latency': 100})
@@ -18,17 +18,22 @@ along with loadr.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import docker
+import json
 import pika
+import socket
 import sys
 
 from io import StringIO
 from multiprocessing import Value
 from requests import Response, Session
+from tempfile import TemporaryDirectory
 from time import sleep
 from unittest import TestCase
 
 import wrkloadr
 
+from benchmarks import StubServer
+
 
 class HistoryMockup:
 
@@ -57,10 +62,31 @@ class TestWriter:
         for val in args:
             self.test.assertIsInstance(val, int)
 
+    def record(self, kind, data):
+        pass
+
     def close(self):
         pass
 
 
+class RateTestWriter(TestWriter):
+
+    def write(self, *args):
+        self.lines.value += 1
+        self.test.assertEqual(len(args), 7)
+        self.test.assertLessEqual(args[6], args[5])
+
+
+class PhasesTestWriter(TestWriter):
+
+    def write(self, *args):
+        self.lines.value += 1
+        self.test.assertEqual(len(args), 7 + len(wrkloadr.PHASES))
+        self.test.assertEqual(args[6], args[4])
+        self.test.assertGreaterEqual(sum(args[7:]), 0)
+        self.test.assertLessEqual(sum(args[7:]), args[5] - args[4])
+
+
 class TestWrkloadr(TestCase):
 
     def test_parseconfig(self):
@@ -89,6 +115,272 @@ class TestWrkloadr(TestCase):
         self.assertEqual(parsed['body']['from-body-1'],
                          'body: 123')
 
+    def test_requesttemplate(self):
+        history = {'0': {'headers.X-Token': 'abc',
+                         'json.id': 5,
+                         'json.quote': 'a "b"'},
+                   'session': {'json.token': 'xyz'}}
+
+        template = wrkloadr.RequestTemplate({
+            'method': 'POST',
+            'url': 'http://host/{{from(0).json.id}}',
+            'headers': {'Authorization':
+                            "Bearer {{from('session').json.token}}",
+                        'Static': 'value'},
+            'body': {'quote': '{{from(0).json.quote}}',
+                     'nested': {'header': '{{from(0).headers.X-Token}}',
+                                'missing': '{{from(2).json.id}}'},
+                     'static': 1},
+            'repeat': 1})
+
+        method, url, headers, body = template.render(history)
+
+        self.assertEqual(method, 'POST')
+        self.assertEqual(url, 'http://host/5')
+        self.assertEqual(headers, {'Authorization': 'Bearer xyz',
+                                   'Static': 'value'})
+        self.assertIsInstance(body, bytes)
+        self.assertEqual(json.loads(body.decode()),
+                         {'quote': 'a "b"',
+                          'nested': {'header': 'abc',
+                                     'missing': '{{from(2).json.id}}'},
+                          'static': 1})
+
+        static = wrkloadr.RequestTemplate({'method': 'GET',
+                                           'url': 'http://host/',
+                                           'headers': None,
+                                           'body': None,
+                                           'repeat': 1})
+
+        self.assertEqual(static.render(history),
+                         ('GET', 'http://host/', None, b'null'))
+
+    def test_compileconfig(self):
+        config = wrkloadr.compileconfig(wrkloadr.configdefaults(
+            [{'name': 'session',
+              'url': 'http://host/'},
+             {'url': 'http://host/{{from(0).json.id}}',
+              'headers': {'Authorization':
+                              "Bearer {{from('session').json.token}}"},
+              'repeat': 2},
+             {'url': 'http://host/',
+              'body': {'id': '{{from(2).headers.X-Id}}'}}]))
+
+        self.assertEqual(config[0].paths, [['json.id', 'json.token']])
+        self.assertEqual(config[1].paths, [[], ['headers.X-Id']])
+        self.assertEqual(config[2].paths, [[]])
+        self.assertIs(wrkloadr.compileconfig(config), config)
+
+    def test_feedtemplate(self):
+        config = wrkloadr.compileconfig(wrkloadr.configdefaults(
+            [{'url': 'http://host/{{feed.id}}/{{from(0).json.id}}',
+              'body': {'user': '{{feed.user.name}}'}}]))
+        history = {None: {'id': '7', 'user': {'name': 'a'}},
+                   '0': {'json.id': 5}}
+
+        self.assertEqual(config[0].paths, [['json.id']])
+        self.assertEqual(config[0].render(history)[1], 'http://host/7/5')
+        self.assertEqual(config[0].render(history)[3], b'{"user": "a"}')
+        self.assertEqual(config[0].render({})[1],
+                         'http://host/{{feed.id}}/{{from(0).json.id}}')
+
+    def test_feeder(self):
+        with TemporaryDirectory() as path:
+            with open(path + '/users.csv', 'w') as f:
+                f.write('id,name\n')
+
+                for i in range(100):
+                    f.write('{},"user, {}"\n'.format(i, i))
+
+            with open(path + '/users.jsonl', 'w') as f:
+                for i in range(100):
+                    f.write(json.dumps({'id': i}) + '\n\n')
+
+            for name in ('users.csv', 'users.jsonl'):
+                for parts in (1, 3, 7, 100, 150):
+                    ids = []
+
+                    for part in range(parts):
+                        feeder = wrkloadr.Feeder(
+                            {'path': path + '/' + name,
+                             'partition': [part, parts]})
+                        row = feeder.next()
+
+                        while row is not None:
+                            ids.append(int(row['id']))
+                            row = feeder.next()
+
+                    self.assertEqual(sorted(ids), list(range(100)))
+
+                # The extracted parts are partitioned again by the workers
+                ids = []
+
+                for part in range(3):
+                    with open(path + '/part', 'wb') as f:
+                        config = wrkloadr.Feeder(
+                            {'path': path + '/' + name,
+                             'partition': [part, 3]}).extract(f)
+
+                    for process in range(2):
+                        feeder = wrkloadr.Feeder(wrkloadr.partitioned(
+                            {'feed': dict(config, path=path + '/part')},
+                            process, 2)['feed'])
+                        row = feeder.next()
+
+                        while row is not None:
+                            ids.append(int(row['id']))
+                            row = feeder.next()
+
+                self.assertEqual(sorted(ids), list(range(100)))
+
+            feeder = wrkloadr.Feeder({'path': path + '/users.csv',
+                                      'loop': True})
+
+            self.assertEqual(feeder.next(), {'id': '0', 'name': 'user, 0'})
+            self.assertEqual([feeder.next()['id'] for i in range(100)][-2:],
+                             ['99', '0'])
+
+            feeder = wrkloadr.Feeder({'path': path + '/users.jsonl',
+                                      'scope': 'user'})
+            row = feeder.cycle(None)
+
+            self.assertEqual(feeder.cycle(row), {'id': 0})
+
+            with self.assertRaises(ValueError):
+                wrkloadr.Feeder({'path': 'users.xml', 'format': 'xml'})
+
+    def test_partitioned(self):
+        options = wrkloadr.partitioned({'feed': {'path': 'f.csv'},
+                                        'replay': {'path': 'r.log'}}, 1, 3)
+
+        self.assertEqual(options['feed']['partition'], [1, 3])
+        self.assertEqual(options['replay']['partition'], [1, 3])
+
+        options = wrkloadr.partitioned(options, 1, 2)
+
+        self.assertEqual(options['feed'],
+                         {'path': 'f.csv', 'partition': [3, 6]})
+        self.assertEqual(options['replay'],
+                         {'path': 'r.log', 'partition': [4, 6]})
+        self.assertEqual(wrkloadr.partitioned({'feed': None}, 1, 2),
+                         {'feed': None})
+
+    def test_replay(self):
+        with TemporaryDirectory() as path:
+            with open(path + '/access.log', 'w') as f:
+                for i in range(60):
+                    f.write('10.0.0.{} - - [10/Oct/2024:13:55:{:02d} +0000] '
+                            '"GET /item/{} HTTP/1.1" 200 2326 "-" "ua"\n'
+                            .format(i % 7, i, i))
+
+                f.write('not a request\n')
+
+            with open(path + '/requests.jsonl', 'w') as f:
+                f.write(json.dumps({'time': '2024-10-10T13:55:00+00:00',
+                                    'method': 'POST',
+                                    'path': '/login',
+                                    'body': {'user': 'a'},
+                                    'session': 's1'}) + '\n')
+                f.write(json.dumps({'time': 1728568500.5,
+                                    'url': 'http://other/',
+                                    'session': 's2'}) + '\n')
+
+            replay = wrkloadr.Replay({'path': path + '/access.log',
+                                      'base': 'http://host'})
+            requests = list(replay)
+
+            self.assertEqual(len(requests), 60)
+            self.assertEqual(requests[2], (2.0, 2,
+                                           {'method': 'GET',
+                                            'url': 'http://host/item/2'}))
+
+            # Every client's requests are replayed by the same part
+            clients = {}
+
+            for part in range(3):
+                replay = wrkloadr.Replay({'path': path + '/access.log',
+                                          'partition': [part, 3]})
+
+                for offset, number, request in replay:
+                    clients.setdefault(number % 7, set()).add(part)
+
+            self.assertEqual(len(clients), 7)
+            self.assertTrue(all([len(parts) == 1
+                                 for parts in clients.values()]))
+
+            # The extracted parts keep their times, from the whole file's
+            # start, when they are partitioned again by the workers
+            for key in ('client', None):
+                requests = []
+
+                for part in range(3):
+                    with open(path + '/part.log', 'w') as f:
+                        config = wrkloadr.Replay(
+                            {'path': path + '/access.log', 'key': key,
+                             'partition': [part, 3]}).extract(f)
+
+                    for process in range(2):
+                        replay = wrkloadr.Replay(wrkloadr.partitioned(
+                            {'replay': dict(config,
+                                            path=path + '/part.log')},
+                            process, 2)['replay'])
+                        requests.extend([(offset, request['url'])
+                                         for offset, number, request
+                                         in replay])
+
+                self.assertEqual(sorted(requests),
+                                 [(float(i), '/item/{}'.format(i))
+                                  for i in range(60)])
+
+            replay = wrkloadr.Replay({'path': path + '/requests.jsonl',
+                                      'base': 'http://host',
+                                      'key': 'session'})
+
+            self.assertEqual(list(replay),
+                             [(0, 0, {'method': 'POST',
+                                      'url': 'http://host/login',
+                                      'body': {'user': 'a'}}),
+                              (0.5, 1, {'url': 'http://other/'})])
+
+            with self.assertRaises(ValueError):
+                wrkloadr.Replay({'path': 'r.log', 'speed': 0})
+
+    def test_replayrepeater(self):
+        server = StubServer()
+        server.start()
+        lines = Value('i', 0)
+
+        try:
+            with TemporaryDirectory() as path:
+                with open(path + '/requests.jsonl', 'w') as f:
+                    for i in range(3):
+                        f.write(json.dumps({'time': i * 0.01,
+                                            'path': '/{}'.format(i),
+                                            'expect': {'status': 200,
+                                                       'json': ['token']}})
+                                + '\n')
+
+                wrkloadr.replayrepeater(2, (RateTestWriter, self, lines),
+                                        {'replay': {
+                                            'path': path + '/requests.jsonl',
+                                            'base': server.url}})
+        finally:
+            server.stop()
+
+        self.assertEqual(lines.value, 3)
+        self.assertEqual(server.requests, 3)
+
+    def test_extract(self):
+        res = HistoryMockup({'X-Id': '7'},
+                            {'data': {'id': 5, 'list': [1]}})
+
+        self.assertEqual(wrkloadr.extract(res, ['json.data.id',
+                                                'json.data.list.0',
+                                                'json.missing',
+                                                'headers.X-Id']),
+                         {'json.data.id': 5,
+                          'headers.X-Id': '7'})
+
     def test_send(self):
         sess = Session()
         res = wrkloadr.send({'method': 'GET',
@@ -135,6 +427,211 @@ class TestWrkloadr(TestCase):
 
         self.assertEqual(lines.value, 18)
 
+    def test_asyncrepeater(self):
+        lines = Value('i', 0)
+
+        wrkloadr.asyncrepeater(3, 2,
+                               (TestWriter, self, lines),
+                               [{'method': 'GET',
+                                 'url': 'http://thebrewery.se/',
+                                 'headers': None,
+                                 'body': None,
+                                 'repeat': 1},
+                                {'method': 'GET',
+                                 'url': 'http://thebrewery.se/',
+                                 'headers': None,
+                                 'body': None,
+                                 'repeat': 2}])
+
+        self.assertEqual(lines.value, 18)
+
+    def test_multirepeater_async(self):
+        lines = Value('i', 0)
+
+        wrkloadr.multirepeater(2, 3, (TestWriter, self, lines),
+                               [{'method': 'GET',
+                                 'url': 'http://thebrewery.se/',
+                                 'headers': None,
+                                 'body': None,
+                                 'repeat': 1},
+                                {'method': 'GET',
+                                 'url': 'http://thebrewery.se/',
+                                 'headers': None,
+                                 'body': None,
+                                 'repeat': 2}],
+                               {'engine': 'async'})
+
+        self.assertEqual(lines.value, 18)
+
+    def test_clientdefaults(self):
+        self.assertEqual(wrkloadr.clientdefaults(None, 'process'),
+                         {'backend': 'requests',
+                          'reuse': False,
+                          'pool_size': None,
+                          'tls_resumption': False,
+                          'dns_ttl': 10,
+                          'phases': False})
+        self.assertEqual(wrkloadr.clientdefaults({'reuse': True},
+                                                 'async')['backend'],
+                         'aiohttp')
+
+        with self.assertRaises(ValueError):
+            wrkloadr.clientdefaults({'backend': 'http'}, 'async')
+
+        with self.assertRaises(ValueError):
+            wrkloadr.clientdefaults({'backend': 'curl'}, 'process')
+
+    def test_httpclient(self):
+        client = wrkloadr.HttpClient(
+            wrkloadr.clientdefaults({'backend': 'http',
+                                     'reuse': True,
+                                     'tls_resumption': True}, 'process'))
+        config = wrkloadr.RequestTemplate({'method': 'GET',
+                                           'url': 'https://thebrewery.se/',
+                                           'headers': None,
+                                           'body': None,
+                                           'repeat': 1})
+
+        for i in range(2):
+            client.cycle()
+            res = client.send(config, {})
+            self.assertIsInstance(res, wrkloadr.BufferedResponse)
+
+        client.close()
+        self.assertEqual(client.idle, {})
+        self.assertEqual(len(client.sessions), 1)
+
+    def test_httpclient_retry(self):
+        server = StubServer()
+        server.start()
+        client = wrkloadr.HttpClient(
+            wrkloadr.clientdefaults({'backend': 'http', 'reuse': True},
+                                    'process'))
+        client.timeout = 0.2
+        config = wrkloadr.RequestTemplate({'method': 'POST',
+                                           'url': server.url,
+                                           'headers': None,
+                                           'body': 'data'})
+
+        try:
+            client.send(config, {})
+
+            # A pooled connection closed while idle is replaced
+            conn = client.idle[('http', '127.0.0.1', server.port)][0]
+            conn.sock.close()
+            conn.sock, closed = socket.socketpair()
+            closed.close()
+            self.assertEqual(client.send(config, {}).status_code, 200)
+            self.assertEqual(server.requests, 2)
+
+            # But a request which may have been handled isn't sent again
+            server.latency = 0.5
+
+            with self.assertRaises(OSError):
+                client.send(config, {})
+
+            sleep(0.5)
+            self.assertEqual(server.requests, 3)
+        finally:
+            client.close()
+            server.stop()
+
+    def test_multirepeater_client(self):
+        lines = Value('i', 0)
+
+        wrkloadr.multirepeater(2, 3, (TestWriter, self, lines),
+                               [{'method': 'GET',
+                                 'url': 'http://thebrewery.se/',
+                                 'headers': None,
+                                 'body': None,
+                                 'repeat': 1}],
+                               {'client': {'backend': 'http',
+                                           'reuse': True}})
+
+        self.assertEqual(lines.value, 6)
+
+    def test_multirepeater_phases(self):
+        lines = Value('i', 0)
+
+        wrkloadr.multirepeater(2, 2, (PhasesTestWriter, self, lines),
+                               [{'method': 'GET',
+                                 'url': 'http://thebrewery.se/',
+                                 'headers': None,
+                                 'body': None,
+                                 'repeat': 2}],
+                               {'client': {'backend': 'http',
+                                           'phases': True}})
+
+        self.assertEqual(lines.value, 8)
+
+    def test_clock(self):
+        clock = wrkloadr.Clock()
+        anchor = clock.anchor()
+        first = clock()
+        second = clock()
+
+        self.assertLessEqual(first, second)
+        self.assertGreaterEqual(first, anchor['wall'])
+        self.assertLess(abs(first - wrkloadr.millisec() * 1000), 1000000)
+
+    def test_clockoffset(self):
+        self.assertEqual(wrkloadr.clockoffset([]), (None, None))
+        # The remote clock is 5000 us ahead, and the second ping was queued
+        offset, rtt = wrkloadr.clockoffset([(1000, 6600, 2000),
+                                            (3000, 12000, 9000),
+                                            (10000, 15300, 10400)])
+
+        self.assertEqual(offset, 5100)
+        self.assertEqual(rtt, 400)
+
+    def test_arrivals(self):
+        arrivals = list(wrkloadr.arrivals([{'duration': 2, 'target': 10},
+                                           {'duration': 2, 'target': 10},
+                                           {'duration': 2, 'target': 0}]))
+
+        self.assertEqual(len(arrivals), 40)
+        self.assertEqual(arrivals, sorted(arrivals))
+        self.assertAlmostEqual(arrivals[20], 3.0)
+        self.assertLess(arrivals[-1], 6)
+
+        interleaved = sorted(
+            list(wrkloadr.arrivals([{'duration': 1, 'target': 10}],
+                                   10, 0.5, 0)) +
+            list(wrkloadr.arrivals([{'duration': 1, 'target': 10}],
+                                   10, 0.5, 0.5)))
+
+        for i, offset in enumerate(interleaved):
+            self.assertAlmostEqual(offset, i / 10)
+
+    def test_ratedefaults(self):
+        rate = wrkloadr.ratedefaults({'unit': 'requests',
+                                      'stages': [{'duration': 10,
+                                                  'target': 30}]},
+                                     [{'repeat': 1}, {'repeat': 2}])
+
+        self.assertEqual(rate['unit'], 'cycles')
+        self.assertEqual(rate['start'], 0)
+        self.assertEqual(rate['stages'], [{'duration': 10, 'target': 10}])
+
+    def test_multirepeater_rate(self):
+        lines = Value('i', 0)
+
+        wrkloadr.multirepeater(2, 1, (RateTestWriter, self, lines),
+                               [{'method': 'GET',
+                                 'url': 'http://thebrewery.se/',
+                                 'headers': None,
+                                 'body': None,
+                                 'repeat': 1}],
+                               {'rate': {'start': 4,
+                                         'stages': [{'duration': 2,
+                                                     'target': 4}]}})
+
+        self.assertEqual(lines.value, 8)
+
+    def test_spread(self):
+        self.assertEqual(wrkloadr.spread(10, 4), [3, 3, 2, 2])
+        self.assertEqual(wrkloadr.spread(2, 2), [1, 1])
+
     def test_csvwriter(self):
         stream = StringIO()
 
@@ -145,6 +642,228 @@ class TestWrkloadr(TestCase):
 
         self.assertEqual(stream.getvalue(), '0,1,2\n')
 
+    def test_histogram(self):
+        histogram = wrkloadr.Histogram()
+
+        for value in range(1, 100001):
+            histogram.record(value)
+
+        self.assertEqual(histogram.count, 100000)
+        self.assertEqual(histogram.min, 1)
+        self.assertEqual(histogram.max, 100000)
+        self.assertAlmostEqual(histogram.percentile(50), 50000, delta=50)
+        self.assertAlmostEqual(histogram.percentile(99), 99000, delta=99)
+        self.assertEqual(histogram.percentile(100), 100000)
+        self.assertLess(len(histogram.buckets), 10000)
+
+        copy = wrkloadr.Histogram.fromsnapshot(
+            json.loads(json.dumps(histogram.snapshot())))
+        copy.merge(histogram)
+
+        self.assertEqual(copy.count, 200000)
+        self.assertEqual(copy.percentile(50), histogram.percentile(50))
+
+    def test_aggregatewriter(self):
+        stream = StringIO()
+
+        aggregate = wrkloadr.AggregateWriter(wrkloadr.CsvWriter(stream), 1)
+        aggregate.wait()
+        starttime = aggregate.starttime
+        aggregate.write(0, 0, 0, 200, starttime, starttime + 10)
+        aggregate.write(0, 1, 0, 200, starttime, starttime + 20)
+        aggregate.write(0, 1, 0, 404, starttime, starttime + 30)
+        aggregate.write(1, 0, 0, 200, starttime, starttime + 1000000)
+        aggregate.write(1, 1, 0, 200, starttime + 1000000, starttime + 1000010)
+        aggregate.close()
+
+        lines = stream.getvalue().splitlines()
+
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith('# histogram '))
+
+        first = json.loads(lines[0][len('# histogram '):])
+        second = json.loads(lines[1][len('# histogram '):])
+
+        self.assertEqual(len(first['histograms']), 3)
+        self.assertEqual(first['end'], second['start'])
+        self.assertEqual(len(second['histograms']), 1)
+        self.assertEqual(second['histograms'][0]['histogram']['count'], 1)
+
+    def test_control(self):
+        control = wrkloadr.Control()
+
+        self.assertFalse(control.hold())
+
+        control.command('rate', 0.5)
+        self.assertEqual(control.factor.value, 0.5)
+
+        with self.assertRaises(ValueError):
+            control.command('rate', 0)
+
+        with self.assertRaises(ValueError):
+            control.command('restart')
+
+        control.command('stop')
+        self.assertTrue(control.hold())
+
+        # Stopped workers don't send any requests
+        lines = Value('i', 0)
+        wrkloadr.singlerepeater(2,
+                                (TestWriter, self, lines),
+                                [{'method': 'GET',
+                                  'url': 'http://thebrewery.se/',
+                                  'headers': None,
+                                  'body': None,
+                                  'repeat': 1}],
+                                control=control)
+
+        self.assertEqual(lines.value, 0)
+
+    def test_expectation(self):
+        expect = wrkloadr.Expectation({'status': [200, 201],
+                                       'latency': 100,
+                                       'json': ['data.id']})
+        res = wrkloadr.BufferedResponse(200, {}, b'{"data": {"id": 1}}')
+        empty = wrkloadr.BufferedResponse(200, {}, b'{"data": {}}')
+
+        self.assertIsNone(expect.check(200, 50000, res))
+        self.assertEqual(expect.check(404, 50000, res), 'status')
+        self.assertEqual(expect.check('connection-error', 50000, None),
+                         'status')
+        self.assertEqual(expect.check(201, 150000, res), 'latency')
+        self.assertEqual(expect.check(201, 50000, empty), 'json')
+
+        config = wrkloadr.compileconfig(wrkloadr.configdefaults(
+            [{'url': 'http://localhost/', 'expect': {'status': 200}},
+             {'url': 'http://localhost/'}]))
+
+        self.assertIsNotNone(config[0].expect)
+        self.assertIsNone(config[1].expect)
+
+    def test_expectwriter(self):
+        stream = StringIO()
+
+        expect = wrkloadr.ExpectWriter(wrkloadr.CsvWriter(stream), 1)
+        expect.wait()
+        starttime = expect.starttime
+        expect.expect(0, None, starttime + 10)
+        expect.expect(0, 'status', starttime + 20)
+        expect.expect(1, None, starttime + 30)
+        expect.expect(0, 'status', starttime + 1000000)
+        expect.expect(1, 'latency', starttime + 1000010)
+        expect.close()
+
+        lines = stream.getvalue().splitlines()
+
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith('# expect '))
+
+        first = json.loads(lines[0][len('# expect '):])
+        second = json.loads(lines[1][len('# expect '):])
+
+        self.assertEqual(first['steps'],
+                         [{'step': 0, 'passed': 1, 'failed': {'status': 2}},
+                          {'step': 1, 'passed': 1, 'failed': {}}])
+        self.assertEqual(second['steps'],
+                         [{'step': 1, 'passed': 0, 'failed': {'latency': 1}}])
+
+    def test_healthwriter(self):
+        stream = StringIO()
+
+        out = wrkloadr.HealthWriter(wrkloadr.CsvWriter(stream), 1)
+        out.wait()
+        starttime = out.starttime
+        out.pending(1)
+        out.pending(1)
+        out.late(2000)
+        out.late(500)
+        out.write(0, 0, 0, 200, starttime, starttime + 10)
+        out.pending(1)
+        out.write(0, 1, 0, 200, starttime, starttime + 1000000)
+        out.write(1, 0, 0, 200, starttime, starttime + 2000010)
+        out.close()
+
+        lines = stream.getvalue().splitlines()
+        records = [json.loads(line[len('# health '):])
+                   for line in lines if line.startswith('# health ')]
+
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]['start'], starttime)
+        self.assertEqual(records[0]['end'], starttime + 1000000)
+        self.assertEqual(records[0]['lag'], 2000)
+        self.assertEqual(records[0]['backlog'], 2)
+        self.assertGreaterEqual(records[0]['cpu'], 0)
+        self.assertGreaterEqual(records[0]['host'], 0)
+        self.assertLessEqual(records[0]['host'], 100)
+        self.assertEqual(records[1]['start'], starttime + 1000000)
+        self.assertEqual(records[1]['lag'], 0)
+        self.assertEqual(records[1]['backlog'], 1)
+
+    def test_lagprobe(self):
+        class Probed:
+            probe = 0.01
+            lag = None
+            ticks = 0
+
+            def late(self, lag):
+                self.lag = lag
+
+            def tick(self, now):
+                self.ticks += 1
+
+        out = Probed()
+        stopped = wrkloadr.Event()
+        probe = wrkloadr.Thread(target=wrkloadr.lagprobe,
+                                args=(out, stopped))
+        probe.start()
+        sleep(0.1)
+        stopped.set()
+        probe.join()
+
+        self.assertGreaterEqual(out.lag, 0)
+        self.assertGreater(out.ticks, 0)
+
+    def test_tick(self):
+        class Ticked(wrkloadr.CsvWriter):
+            ticks = []
+
+            def tick(self, now):
+                self.ticks.append(now)
+
+        stream = StringIO()
+        out = wrkloadr.HealthWriter(wrkloadr.ExpectWriter(
+            wrkloadr.AggregateWriter(Ticked(stream), 1), 1), 1)
+        out.wait()
+        starttime = out.starttime
+        out.write(0, 0, 0, 200, starttime, starttime + 10)
+        out.expect(0, None, starttime + 10)
+
+        # Nothing is written until the snapshots are due
+        out.tick(starttime + 500000)
+        self.assertEqual(stream.getvalue().count('#'), 0)
+
+        out.tick(starttime + 2000000)
+        self.assertEqual(Ticked.ticks, [starttime + 10,
+                                        starttime + 500000,
+                                        starttime + 2000000])
+
+        for kind in ('histogram', 'expect', 'health'):
+            self.assertEqual(stream.getvalue().count('# ' + kind), 1)
+
+    def test_batch(self):
+        rows = [(0, 1, 2, 200, wrkloadr.millisec(), wrkloadr.millisec()),
+                (3, 4, 5, 'connection-error', 6, 7)]
+        batch = wrkloadr.encodebatch(rows)
+
+        self.assertEqual(len(batch), 10 + 2 * 30)
+        self.assertEqual(wrkloadr.decodebatch(batch), rows)
+
+        rows = [(0, 1, 2, 200, 3, 4, 5)]
+
+        self.assertEqual(wrkloadr.decodebatch(wrkloadr.encodebatch(rows)),
+                         rows)
+
     def test_rabbitwriter(self):
         client = docker.Client(base_url='unix://var/run/docker.sock')
         hostconfig = client.create_host_config(
@@ -175,13 +894,18 @@ class TestWrkloadr(TestCase):
                                       wrkloadr.millisec() / 1000) + 2))
 
             rabbit.wait()
-            rabbit.write(*range(3))
+            rabbit.write(*range(6))
+            rabbit.write(0, 1, 0, 'connection-error', 4, 5)
             rabbit.close()
 
             method_frame, properties, body = channel.basic_get(
                                                 queue='loadr-data')
 
-            self.assertEqual(body.decode(), '0,1,2')
+            self.assertEqual(properties.content_type,
+                             wrkloadr.BATCH_CONTENT_TYPE)
+            self.assertEqual(wrkloadr.decodebatch(body),
+                             [tuple(range(6)),
+                              (0, 1, 0, 'connection-error', 4, 5)])
 
             connection.close()
         finally:
@@ -17,18 +17,25 @@ You should have received a copy of the GNU General Public License
 along with loadr.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import json
+
 from sys import stderr, stdout
 
+from util import health
+from util.thresholds import Thresholds, watch
+
 
 class Csv:
 
-    def __init__(self, input, output):
+    def __init__(self, input, output, thresholds=None, saturation=None):
         self.input = input
         self.output = output
+        self.thresholds = None if thresholds is None \
+            else Thresholds(thresholds)
+        self.saturation = health.Saturation(saturation)
 
     def start(self):
         self.output.send(('command', 'run'))
-        self.output.send(('command', 'quit'))
 
         while True:
             try:
@@ -39,5 +46,25 @@ class Csv:
             if data[0] == 'data':
                 stdout.write('%s\n' % data[2])
 
+            if data[0] in ('histogram', 'expect'):
+                stdout.write('# %s %s\n' % (data[0], json.dumps(data[2])))
+
+            if data[0] == 'deploy':
+                stdout.write('# deploy %s\n' % json.dumps(data[2]))
+
+            if data[0] in ('anchor', 'clock', 'health'):
+                stdout.write('# %s %s %s\n' % (data[0], data[1],
+                                                json.dumps(data[2])))
+
             if data[0] == 'error':
                 stderr.write('%s\n' % data[2])
+
+            if data[0] == 'status' and data[1:] == ('session', 'ended'):
+                break
+
+            health.watch(self.saturation, data)
+
+            if self.thresholds is not None:
+                watch(self.thresholds, data, self.output)
+
+        self.output.send(('command', 'quit'))
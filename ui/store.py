@@ -0,0 +1,98 @@
+"""
+Copyright (c) 2016 Olof Montin <olof@thebrewery.se>
+
+This file is part of loadr.
+
+loadr is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+loadr is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with loadr.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import os
+
+from sys import stderr, stdout
+
+from util.store import StoreWriter
+from util import health
+from util.thresholds import Thresholds, watch
+
+
+class Store:
+    """Writes all data rows into a columnar store at path, for the report
+    command. Other records, like histograms, are written as json lines to
+    the records file within it.
+
+    The times of the rows are normalized to the controller's clock, by the
+    offset in each instance's "clock" record.
+
+    With thresholds, see util.thresholds, the crossed ones are shown, and the
+    run is aborted if they say so. The instances which get saturated, by the
+    saturation limits, see util.health, are shown as well, and the report
+    command can discount their requests by the stored health records.
+    """
+
+    def __init__(self, input, output, path='loadr-results', thresholds=None,
+                 saturation=None):
+        self.input = input
+        self.output = output
+        self.path = path
+        self.thresholds = None if thresholds is None \
+            else Thresholds(thresholds)
+        self.saturation = health.Saturation(saturation)
+
+    def start(self):
+        writer = StoreWriter(self.path)
+        records = open(os.path.join(self.path, 'records'), 'a')
+        # Clock offsets by instance
+        offsets = {}
+        self.output.send(('command', 'run'))
+
+        while True:
+            try:
+                data = self.input.get(True)
+            except:
+                break
+
+            if data[0] == 'data':
+                offset = offsets.get(data[1], 0)
+
+                for line in data[2].splitlines():
+                    row = line.split(',')
+                    # Start, end and intended are times, the phases durations
+                    times = [int(v) + offset for v in row[4:7]]
+                    writer.write(int(row[0]), int(row[1]), int(row[2]),
+                                 int(row[3]) if row[3].isdigit() else row[3],
+                                 *times + [int(v) for v in row[7:]],
+                                 instance=data[1])
+            elif data[0] == 'error':
+                stderr.write('%s\n' % data[2])
+            elif data[0] == 'status':
+                if data[1:] == ('session', 'ended'):
+                    break
+            else:
+                if data[0] == 'clock':
+                    offsets[data[1]] = data[2]['offset']
+
+                records.write('%s\n' % json.dumps({'type': data[0],
+                                                   'source': data[1],
+                                                   'data': data[2]}))
+
+            health.watch(self.saturation, data)
+
+            if self.thresholds is not None:
+                watch(self.thresholds, data, self.output)
+
+        writer.close()
+        records.close()
+        stdout.write('Results stored in %s\n' % self.path)
+        self.output.send(('command', 'quit'))
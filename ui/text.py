@@ -17,34 +17,223 @@ You should have received a copy of the GNU General Public License
 along with loadr.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import pandas
-
-from io import StringIO
+from queue import Empty
 from sys import stderr, stdout
+from time import time
+
+from util import health
+from util.thresholds import Thresholds, iserror, watch
+from wrkloadr import Histogram
+
+
+class StepStats:
+    """Statistics of one request step, both in total and rolling over the
+    last window seconds. The latencies are counted in Histograms, one per
+    second within the window and one in total, so the memory use doesn't
+    grow with the number of requests.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        # [requests, errors, Histogram] indexed by second
+        self.seconds = {}
+        self.histogram = Histogram()
+        self.errors = 0
+        self.first = None
+        self.last = None
+
+    def second(self, second):
+        """Returns the counters of a second, and drops the seconds which are
+        no longer within the window.
+        """
+
+        if self.first is None or second < self.first:
+            self.first = second
+
+        if self.last is None or second > self.last:
+            self.last = second
+
+            for old in [s for s in self.seconds
+                        if s <= second - self.window]:
+                del self.seconds[old]
+
+        if second not in self.seconds:
+            self.seconds[second] = [0, 0, Histogram()]
+
+        return self.seconds[second]
+
+    def record(self, second, latency, error):
+        """Counts a request which ended at second.
+        """
+
+        counters = self.second(second)
+        counters[0] += 1
+        counters[1] += error
+        counters[2].record(latency)
+        self.histogram.record(latency)
+        self.errors += error
+
+    def merge(self, second, histogram, errors):
+        """Counts a whole histogram of requests which ended at second.
+        """
+
+        counters = self.second(second)
+        counters[0] += histogram.count
+        counters[1] += errors
+        counters[2].merge(histogram)
+        self.histogram.merge(histogram)
+        self.errors += errors
+
+    def rolling(self):
+        """Returns requests per second, error rate and a Histogram of the
+        seconds within the window.
+        """
+
+        histogram = Histogram()
+        requests = errors = 0
+
+        for count, error, h in self.seconds.values():
+            requests += count
+            errors += error
+            histogram.merge(h)
+
+        seconds = min(self.window, self.last - self.first + 1)
+
+        return (requests / seconds,
+                errors / requests if requests else 0,
+                histogram)
 
 
 class Text:
+    """Shows live statistics per request step while the data arrives, and a
+    final report when the session has ended.
+
+    With thresholds, see util.thresholds, the crossed ones are shown, and the
+    run is aborted if they say so. The instances which get saturated, by the
+    saturation limits, see util.health, are shown as well.
+    """
 
-    def __init__(self, input, output):
+    # Seconds between the live summaries
+    interval = 1
+    # Seconds of data within the live summaries
+    window = 10
+    # Latency percentiles to show
+    percentiles = (50, 90, 99)
+
+    def __init__(self, input, output, thresholds=None, saturation=None):
         self.input = input
         self.output = output
+        self.thresholds = None if thresholds is None \
+            else Thresholds(thresholds)
+        self.saturation = health.Saturation(saturation)
+        self.steps = {}
+        self.starttime = time()
+
+    def step(self, ri):
+        if ri not in self.steps:
+            self.steps[ri] = StepStats(self.window)
+
+        return self.steps[ri]
+
+    def row(self, line):
+        """Counts a data row: cycle, step, repeat, status, start, end and the
+        optional intended start, which latencies are counted from. The times
+        are in microseconds.
+        """
+
+        data = line.split(',')
+        start = int(data[6] if len(data) > 6 else data[4])
+        end = int(data[5])
+
+        self.step(int(data[1])).record(end // 1000000, end - start,
+                                       iserror(data[3]))
+
+    def histograms(self, record):
+        """Counts an aggregated histogram record.
+        """
+
+        for h in record['histograms']:
+            histogram = Histogram.fromsnapshot(h['histogram'])
+            self.step(h['step']).merge(
+                record['end'] // 1000000,
+                histogram,
+                histogram.count if iserror(h['status']) else 0)
+
+    def summary(self):
+        """Writes the rolling statistics of all steps.
+        """
+
+        stdout.write('{:.0f} s, last {} s:\n'.format(time() - self.starttime,
+                                                     self.window))
+
+        for ri in sorted(self.steps):
+            rate, errors, histogram = self.steps[ri].rolling()
+            stdout.write('  step {}: {:.1f} req/s, {:.1%} errors, {}\n'.format(
+                ri, rate, errors, self.latencies(histogram)))
+
+    def report(self):
+        """Writes the statistics of the whole session for all steps.
+        """
+
+        stdout.write('Report:\n')
+
+        for ri in sorted(self.steps):
+            stats = self.steps[ri]
+            histogram = stats.histogram
+            seconds = stats.last - stats.first + 1
+
+            stdout.write(
+                '  step {}: {} requests, {:.1f} req/s, {:.1%} errors, '
+                'mean {:.1f} ms, {}, max {:.1f} ms\n'.format(
+                    ri,
+                    histogram.count,
+                    histogram.count / seconds,
+                    stats.errors / histogram.count,
+                    histogram.mean() / 1000,
+                    self.latencies(histogram),
+                    histogram.max / 1000))
+
+        for source in sorted(self.saturation.intervals):
+            stdout.write('  {} was saturated for {:.1f} s\n'.format(
+                source, self.saturation.seconds(source)))
+
+    def latencies(self, histogram):
+        return ', '.join(['p{} {:.1f} ms'.format(
+                            p, histogram.percentile(p) / 1000)
+                          for p in self.percentiles])
 
     def start(self):
-        sio = StringIO()
         self.output.send(('command', 'run'))
+        summarized = time()
 
         while True:
             try:
-                data = self.input.get(True)
+                data = self.input.get(True, self.interval)
+            except Empty:
+                data = None
             except:
                 break
 
-            if data[0] == 'data':
-                sio.write(data[2])
-
-            if data[0] == 'error':
+            if data is None:
+                pass
+            elif data[0] == 'data':
+                for line in data[2].splitlines():
+                    self.row(line)
+            elif data[0] == 'histogram':
+                self.histograms(data[2])
+            elif data[0] == 'error':
                 stderr.write('%s\n' % data[2])
+            elif data[0] == 'status' and data[1:] == ('session', 'ended'):
+                break
+
+            health.watch(self.saturation, data)
+
+            if self.thresholds is not None:
+                watch(self.thresholds, data, self.output)
 
-        pandas.read_csv(sio)
+            if time() - summarized >= self.interval and self.steps:
+                self.summary()
+                summarized = time()
 
+        self.report()
         self.output.send(('command', 'quit'))
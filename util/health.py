@@ -0,0 +1,149 @@
+"""
+Copyright (c) 2016 Olof Montin <olof@thebrewery.se>
+
+This file is part of loadr.
+
+loadr is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+loadr is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with loadr.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from sys import stderr
+
+
+class Saturation:
+    """Flags the intervals where an instance's worker processes were
+    saturated, by their "health" records, since the latencies they report
+    then include their own delays:
+        {"cpu": <max percent of a core, or of all the host's cores>,
+         "lag": <max milliseconds late>,
+         "backlog": <max requests sent or due>}
+
+    The intervals are kept merged per instance, so that the requests
+    started within them can be discounted.
+    """
+
+    # Percent of a core a worker process, or of all cores its host, may use
+    cpu = 90
+    # Milliseconds a worker process may be late to run
+    lag = 10
+    # Requests a worker process may have sent or due, None for any number
+    backlog = None
+
+    def __init__(self, config=None):
+        for name, limit in (config or {}).items():
+            if name not in ('cpu', 'lag', 'backlog'):
+                raise ValueError('No saturation limit with name "{}"'
+                                 .format(name))
+
+            setattr(self, name, limit)
+
+        # Merged [start, end] intervals, in microseconds, by instance
+        self.intervals = {}
+
+    def reasons(self, record):
+        """Returns why a health record is saturated, if it is.
+        """
+
+        reasons = []
+
+        if record['cpu'] > self.cpu:
+            reasons.append('cpu {:.0f}%'.format(record['cpu']))
+
+        # The records from before the host was sampled don't have it
+        if record.get('host', 0) > self.cpu:
+            reasons.append('host cpu {:.0f}%'.format(record['host']))
+
+        if record['lag'] / 1000 > self.lag:
+            reasons.append('lag {:.1f} ms'.format(record['lag'] / 1000))
+
+        if self.backlog is not None and record['backlog'] > self.backlog:
+            reasons.append('backlog {}'.format(record['backlog']))
+
+        return reasons
+
+    def flag(self, source, record, offset=0):
+        """Flags the interval of a health record from source, with its times
+        moved by offset, if it's saturated. Returns a message if the instance
+        wasn't already saturated just before it.
+        """
+
+        reasons = self.reasons(record)
+
+        if not reasons:
+            return None
+
+        start, end = record['start'] + offset, record['end'] + offset
+        intervals = self.intervals.setdefault(source, [])
+        touching = [i for i in intervals if i[0] <= end and i[1] >= start]
+
+        for interval in touching:
+            intervals.remove(interval)
+
+        intervals.append([min([start] + [i[0] for i in touching]),
+                          max([end] + [i[1] for i in touching])])
+        intervals.sort()
+
+        if touching:
+            return None
+
+        return '{} is saturated: {}'.format(source, ', '.join(reasons))
+
+    def seconds(self, source):
+        """Returns for how many seconds an instance was saturated.
+        """
+
+        return sum([end - start
+                    for start, end in self.intervals.get(source, [])]) / 1e6
+
+    def exclusions(self, instances):
+        """Returns the flagged intervals as (instance, start, end) tuples,
+        with the instances by their numbers in a list of names.
+        """
+
+        return [(instances.index(source), start, end)
+                for source, intervals in sorted(self.intervals.items())
+                if source in instances
+                for start, end in intervals]
+
+
+def saturated(records, config=None):
+    """Returns a Saturation with the intervals flagged by a run's records,
+    as stored by the Store ui, with the times normalized by each instance's
+    clock offset.
+    """
+
+    saturation = Saturation(config)
+    offsets = {}
+
+    for record in records:
+        if record['type'] == 'clock':
+            offsets[record['source']] = record['data']['offset']
+        elif record['type'] == 'health':
+            saturation.flag(record['source'], record['data'],
+                            offsets.get(record['source'], 0))
+
+    return saturation
+
+
+def watch(saturation, data):
+    """Flags an event within a UI's loop, if it's a health record, and
+    writes to stderr when an instance becomes saturated.
+    """
+
+    if data is None or data[0] != 'health':
+        return
+
+    message = saturation.flag(data[1], data[2])
+
+    if message is not None:
+        stderr.write('%s, its latencies include its own delays\n' % message)
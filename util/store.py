@@ -0,0 +1,390 @@
+"""
+Copyright (c) 2016 Olof Montin <olof@thebrewery.se>
+
+This file is part of loadr.
+
+loadr is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+loadr is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with loadr.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import numpy
+import os
+import pandas
+
+from wrkloadr import BATCH_STATUSES, PHASES, Histogram
+
+# The stored columns. Instance is the number of the instance in the
+# instances file. Intended is the intended start time in rate mode, and the
+# start time otherwise, so the latency is always end - intended. The phases
+# are the durations of the client's phases, or -1 without them. The times
+# are in microseconds.
+COLUMNS = ('instance', 'cycle', 'step', 'repeat', 'status', 'start', 'end',
+           'intended') + PHASES
+# Every column is stored in its own file of little-endian int64
+DTYPE = numpy.dtype('<i8')
+# The index file has one entry per instance and step within each chunk, with
+# the first and last start time, and the rows' offset and count.
+INDEX_COLUMNS = ('instance', 'step', 'first', 'last', 'offset', 'count')
+# Status names by their stored numbers
+STATUS_NAMES = {number: name for name, number in BATCH_STATUSES.items()}
+
+
+class StoreWriter:
+    """Writes data rows to a columnar store, a directory with one file of
+    int64 per column. The rows are buffered and appended in chunks of
+    chunk_size rows.
+
+    Each chunk is sorted by instance, step and start time, and indexed in the
+    index file, so that a query only has to read the parts of the columns
+    with matching rows.
+    """
+
+    chunk_size = 65536
+
+    def __init__(self, path, chunk_size=None):
+        self.path = path
+
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+
+        os.makedirs(path, exist_ok=True)
+        self.rows = []
+        self.instances = loadinstances(path)
+        # Number of rows already stored
+        filename = os.path.join(path, 'end')
+        self.offset = os.path.getsize(filename) // DTYPE.itemsize \
+            if os.path.exists(filename) else 0
+
+    def instance(self, name):
+        """Returns the number of an instance by its name.
+        """
+
+        if name not in self.instances:
+            self.instances.append(name)
+
+            with open(os.path.join(self.path, 'instances'), 'w') as f:
+                json.dump(self.instances, f)
+
+        return self.instances.index(name)
+
+    def write(self, *row, instance=''):
+        """Buffers a data row: cycle, step, repeat, status, start, end and the
+        optional intended start and phases, from the named instance.
+        """
+
+        phases = list(row[7:7 + len(PHASES)])
+
+        self.rows.append((self.instance(instance),
+                          row[0], row[1], row[2],
+                          BATCH_STATUSES.get(row[3], row[3]),
+                          row[4], row[5],
+                          row[6] if len(row) > 6 else row[4]) +
+                         tuple(phases + [-1] * (len(PHASES) - len(phases))))
+
+        if len(self.rows) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Sorts the buffered rows and appends them to the column files, and
+        their entries to the index.
+        """
+
+        if not self.rows:
+            return
+
+        instance, step, start = [COLUMNS.index(c)
+                                 for c in ('instance', 'step', 'start')]
+        chunk = numpy.array(self.rows, dtype=DTYPE)
+        chunk = chunk[numpy.lexsort((chunk[:, start],
+                                     chunk[:, step],
+                                     chunk[:, instance]))]
+
+        for i, column in enumerate(COLUMNS):
+            with open(os.path.join(self.path, column), 'ab') as f:
+                f.write(chunk[:, i].tobytes())
+
+        # Where each instance and step starts and ends within the chunk
+        keys = chunk[:, [instance, step]]
+        changes = numpy.flatnonzero((keys[1:] != keys[:-1]).any(axis=1)) + 1
+        firsts = numpy.concatenate(([0], changes))
+        lasts = numpy.concatenate((changes, [len(chunk)])) - 1
+
+        with open(os.path.join(self.path, 'index'), 'ab') as f:
+            f.write(numpy.column_stack((keys[firsts],
+                                        chunk[firsts, start],
+                                        chunk[lasts, start],
+                                        firsts + self.offset,
+                                        lasts - firsts + 1))
+                    .astype(DTYPE).tobytes())
+
+        self.offset += len(chunk)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+
+
+def loadinstances(path):
+    """Returns the names of a store's instances, by their numbers.
+    """
+
+    try:
+        with open(os.path.join(path, 'instances')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+
+def loadrecords(path):
+    """Yields the records of a store, other than the data rows, as they're
+    written by the Store ui.
+    """
+
+    try:
+        with open(os.path.join(path, 'records')) as f:
+            for line in f:
+                yield json.loads(line)
+    except FileNotFoundError:
+        return
+
+
+def load(path):
+    """Returns all columns of a store, memory-mapped and indexed by name. The
+    phases of a store from before they were stored are all -1.
+    """
+
+    columns = {}
+
+    for column in COLUMNS:
+        filename = os.path.join(path, column)
+
+        if not os.path.exists(filename):
+            columns[column] = numpy.full(len(columns['end']), -1,
+                                         dtype=DTYPE)
+        elif os.path.getsize(filename) == 0:
+            columns[column] = numpy.zeros(0, dtype=DTYPE)
+        else:
+            columns[column] = numpy.memmap(filename, dtype=DTYPE, mode='r')
+
+    return columns
+
+
+def loadindex(path):
+    """Returns the index of a store, memory-mapped with one entry per row.
+    """
+
+    filename = os.path.join(path, 'index')
+
+    if os.path.getsize(filename) == 0:
+        return numpy.zeros((0, len(INDEX_COLUMNS)), dtype=DTYPE)
+
+    return numpy.memmap(filename, dtype=DTYPE, mode='r') \
+        .reshape(-1, len(INDEX_COLUMNS))
+
+
+def query(path, instance=None, step=None, start=None, end=None):
+    """Returns the columns of the rows from an instance, by name or number,
+    and a step, which started from start up to end, in microseconds. Leave
+    out any of them to not filter by it.
+
+    Only the parts of the memory-mapped columns which the index points out
+    are read.
+    """
+
+    if type(instance) is str:
+        instances = loadinstances(path)
+
+        if instance not in instances:
+            return {column: numpy.zeros(0, dtype=DTYPE) for column in COLUMNS}
+
+        instance = instances.index(instance)
+
+    index = loadindex(path)
+    selected = numpy.ones(len(index), dtype=bool)
+
+    if instance is not None:
+        selected &= index[:, 0] == instance
+
+    if step is not None:
+        selected &= index[:, 1] == step
+
+    if start is not None:
+        selected &= index[:, 3] >= start
+
+    if end is not None:
+        selected &= index[:, 2] < end
+
+    columns = load(path)
+    parts = {column: [] for column in COLUMNS}
+
+    for offset, count in index[selected][:, 4:6].tolist():
+        rows = slice(offset, offset + count)
+        starts = columns['start'][rows]
+        matching = numpy.ones(count, dtype=bool)
+
+        if start is not None:
+            matching &= starts >= start
+
+        if end is not None:
+            matching &= starts < end
+
+        for column in COLUMNS:
+            parts[column].append(columns[column][rows][matching])
+
+    return {column: numpy.concatenate(values) if values
+            else numpy.zeros(0, dtype=DTYPE)
+            for column, values in parts.items()}
+
+
+def chunks(columns, chunk_size):
+    """Yields slices of the columns, at most chunk_size rows each.
+    """
+
+    rows = len(columns['end'])
+
+    for i in range(0, rows, chunk_size):
+        yield {column: values[i:i + chunk_size]
+               for column, values in columns.items()}
+
+
+def histogramindex(values, histogram):
+    """The vectorized version of Histogram.index.
+    """
+
+    values = numpy.maximum(values, 0)
+    # The bit length of each value
+    shift = numpy.maximum(numpy.frexp(values)[1] - histogram.bits, 0)
+
+    return numpy.where(values < histogram.subcount,
+                       values,
+                       shift * histogram.halfcount + (values >> shift))
+
+
+def merge(histogram, values):
+    """Counts an array of values into a Histogram, vectorized.
+    """
+
+    if len(values) == 0:
+        return
+
+    indexes, counts = numpy.unique(histogramindex(values, histogram),
+                                   return_counts=True)
+
+    for index, count in zip(indexes.tolist(), counts.tolist()):
+        histogram.buckets[index] = histogram.buckets.get(index, 0) + count
+
+    low, high = int(values.min()), int(values.max())
+    histogram.count += len(values)
+    histogram.total += int(numpy.maximum(values, 0).sum())
+    histogram.min = max(low, 0) if histogram.min is None \
+        else min(histogram.min, max(low, 0))
+    histogram.max = max(high, 0) if histogram.max is None \
+        else max(histogram.max, high)
+
+
+def discount(columns, exclude):
+    """Returns the columns without the rows of an instance which started
+    within any of its (instance, start, end) intervals in exclude.
+    """
+
+    kept = numpy.ones(len(columns['end']), dtype=bool)
+
+    for instance, start, end in exclude:
+        kept &= ~((columns['instance'] == instance) &
+                  (columns['start'] >= start) &
+                  (columns['start'] < end))
+
+    return {column: values[kept] for column, values in columns.items()}
+
+
+def report(path, chunk_size=StoreWriter.chunk_size * 16, exclude=None,
+           **filters):
+    """Computes, over a store, chunk by chunk:
+        steps - requests, errors and latency percentiles, in ms, per step
+        statuses - requests per step and status
+        timeline - requests and errors per second
+    and returns them as pandas DataFrames.
+
+    The latencies are counted in one Histogram per step, so the memory use
+    doesn't grow with the number of rows. With any filters, the same as for
+    query, only the matching rows are counted, and the rows within exclude,
+    see discount, are left out.
+    """
+
+    columns = query(path, **filters) if filters else load(path)
+    histograms = {}
+    statuses = {}
+
+    if len(columns['end']) == 0:
+        firstsecond = lastsecond = 0
+    else:
+        firstsecond = int(columns['end'].min()) // 1000000
+        lastsecond = int(columns['end'].max()) // 1000000
+
+    requests = numpy.zeros(lastsecond - firstsecond + 1, dtype=DTYPE)
+    errors = numpy.zeros(lastsecond - firstsecond + 1, dtype=DTYPE)
+
+    for chunk in chunks(columns, chunk_size):
+        if exclude:
+            chunk = discount(chunk, exclude)
+
+        latency = chunk['end'] - chunk['intended']
+        failed = (chunk['status'] < 0) | (chunk['status'] >= 400)
+        second = chunk['end'] // 1000000 - firstsecond
+
+        requests += numpy.bincount(second, minlength=len(requests))
+        errors += numpy.bincount(second[failed], minlength=len(errors))
+
+        for step in numpy.unique(chunk['step']):
+            step = int(step)
+            selected = chunk['step'] == step
+            values = latency[selected]
+
+            if step not in histograms:
+                histograms[step] = Histogram()
+
+            merge(histograms[step], values)
+
+            for status, count in zip(*numpy.unique(chunk['status'][selected],
+                                                   return_counts=True)):
+                key = (step, int(status))
+                statuses[key] = statuses.get(key, 0) + int(count)
+
+    steps = pandas.DataFrame(
+        [{'step': step,
+          'requests': histogram.count,
+          'errors': sum([count for (s, status), count in statuses.items()
+                         if s == step and (status < 0 or status >= 400)]),
+          'mean': histogram.mean() / 1000,
+          'p50': histogram.percentile(50) / 1000,
+          'p90': histogram.percentile(90) / 1000,
+          'p99': histogram.percentile(99) / 1000,
+          'max': histogram.max / 1000}
+         for step, histogram in sorted(histograms.items())],
+        columns=['step', 'requests', 'errors', 'mean',
+                 'p50', 'p90', 'p99', 'max'])
+
+    statuses = pandas.DataFrame(
+        [{'step': step,
+          'status': STATUS_NAMES.get(status, status),
+          'requests': count}
+         for (step, status), count in sorted(statuses.items())],
+        columns=['step', 'status', 'requests'])
+
+    timeline = pandas.DataFrame({'requests': requests, 'errors': errors},
+                                index=pandas.Index(
+                                    numpy.arange(firstsecond, lastsecond + 1),
+                                    name='second'))
+
+    return steps, statuses, timeline
@@ -0,0 +1,194 @@
+"""
+Copyright (c) 2016 Olof Montin <olof@thebrewery.se>
+
+This file is part of loadr.
+
+loadr is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+loadr is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with loadr.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import re
+
+from sys import stderr
+from time import time
+
+from wrkloadr import Histogram
+
+# Latency percentile thresholds, like "p99" or "p99.9"
+PERCENTILE = re.compile(r'^p(\d+(\.\d+)?)$')
+
+
+class Thresholds:
+    """Run-level thresholds, evaluated per request step on the merged data of
+    all instances:
+        {"p99": <max milliseconds>,
+         "errors": <max percent of the requests>,
+         "expect": <max percent of the expectation checks>,
+         "min_requests": <requests of a step before it's evaluated>,
+         "abort": <whether to abort the run when one is crossed>,
+         "steps": {"<ri>": {<thresholds of only step ri>}}}
+
+    Any latency percentile can be used, like "p50" or "p99.9". The data rows,
+    histogram and expect records are counted as they arrive by count, and
+    check returns the thresholds crossed since the last check. The UIs do
+    both by evaluate.
+    """
+
+    # Requests of a step before its thresholds are evaluated
+    min_requests = 100
+    # Seconds between the checks by evaluate
+    interval = 1
+
+    def __init__(self, config):
+        config = dict(config)
+        self.abort = config.pop('abort', True)
+
+        if 'min_requests' in config:
+            self.min_requests = config.pop('min_requests')
+
+        self.overrides = {int(ri): thresholds
+                          for ri, thresholds
+                          in config.pop('steps', {}).items()}
+        self.thresholds = config
+
+        for thresholds in [config] + list(self.overrides.values()):
+            for name in thresholds:
+                if name not in ('errors', 'expect') and \
+                   not PERCENTILE.match(name):
+                    raise ValueError('No threshold with name "{}"'
+                                     .format(name))
+
+        # [requests, errors, checks, failed checks, Histogram] by step
+        self.steps = {}
+        # The (step, threshold) pairs already crossed
+        self.crossed = set()
+        self.checked = time()
+
+    def step(self, ri):
+        if ri not in self.steps:
+            self.steps[ri] = [0, 0, 0, 0, Histogram()]
+
+        return self.steps[ri]
+
+    def count(self, data):
+        """Counts an event from the output Queue, if it's a data row,
+        histogram or expect record.
+        """
+
+        if data[0] == 'data':
+            for line in data[2].splitlines():
+                row = line.split(',')
+                start = int(row[6] if len(row) > 6 else row[4])
+                counters = self.step(int(row[1]))
+                counters[0] += 1
+                counters[1] += iserror(row[3])
+                counters[4].record(int(row[5]) - start)
+        elif data[0] == 'histogram':
+            for h in data[2]['histograms']:
+                histogram = Histogram.fromsnapshot(h['histogram'])
+                counters = self.step(h['step'])
+                counters[0] += histogram.count
+                counters[1] += histogram.count if iserror(h['status']) else 0
+                counters[4].merge(histogram)
+        elif data[0] == 'expect':
+            for s in data[2]['steps']:
+                failed = sum(s['failed'].values())
+                counters = self.step(s['step'])
+                counters[2] += s['passed'] + failed
+                counters[3] += failed
+
+    def value(self, name, ri):
+        """Returns the current value of a threshold for step ri, or None if
+        there's nothing to evaluate yet.
+        """
+
+        requests, errors, checks, failed, histogram = self.steps[ri]
+
+        if name == 'errors':
+            return 100 * errors / requests if requests else None
+
+        if name == 'expect':
+            return 100 * failed / checks if checks else None
+
+        if not histogram.count:
+            return None
+
+        return histogram.percentile(
+            float(PERCENTILE.match(name).group(1))) / 1000
+
+    def check(self):
+        """Returns a message for each threshold which has been crossed since
+        the last check.
+        """
+
+        messages = []
+
+        for ri in sorted(self.steps):
+            if self.steps[ri][0] < self.min_requests:
+                continue
+
+            thresholds = dict(self.thresholds, **self.overrides.get(ri, {}))
+
+            for name, limit in sorted(thresholds.items()):
+                if (ri, name) in self.crossed:
+                    continue
+
+                value = self.value(name, ri)
+
+                if value is not None and value > limit:
+                    self.crossed.add((ri, name))
+                    messages.append(
+                        'Step {}: {} is {:.1f}{}, above the threshold {}'
+                        .format(ri, name, value,
+                                ' ms' if name.startswith('p') else '%',
+                                limit))
+
+        return messages
+
+    def evaluate(self, data):
+        """Counts an event, which may be None, and checks the thresholds if
+        it's more than interval seconds since the last check.
+        """
+
+        if data is not None:
+            self.count(data)
+
+        if time() - self.checked < self.interval:
+            return []
+
+        self.checked = time()
+
+        return self.check()
+
+
+def watch(thresholds, data, output):
+    """Evaluates Thresholds by an event within a UI's loop. The crossed
+    thresholds are written to stderr, and the run is aborted by a command
+    through the UI's output Pipe, if the thresholds say so.
+    """
+
+    messages = thresholds.evaluate(data)
+
+    for message in messages:
+        stderr.write('%s\n' % message)
+
+    if messages and thresholds.abort:
+        output.send(('command', 'abort'))
+
+
+def iserror(status):
+    """Whether a status is an error: a failed connection or a HTTP status of
+    400 or above.
+    """
+
+    return not str(status).isdigit() or int(status) >= 400
@@ -17,14 +17,36 @@ You should have received a copy of the GNU General Public License
 along with loadr.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import asyncio
+import csv
 import json
+import math
+import mmap
+import os
 import pika
+import re
+import socket
+import ssl
+import struct
 import sys
+import zlib
 
-from multiprocessing import Process
+from collections.abc import Mapping
+from datetime import datetime
+from http.client import HTTPConnection, HTTPException, RemoteDisconnected
+from multiprocessing import Process, RawValue, cpu_count
 from requests import Request, Session, ConnectionError
-from re import finditer
-from time import time, sleep
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from threading import Event, RLock, Thread
+from time import monotonic_ns, process_time, time, time_ns, sleep
+from urllib.parse import urlsplit
+
+try:
+    import aiohttp
+except ImportError:
+    # Only required by the async engine
+    aiohttp = None
 
 
 """
@@ -39,6 +61,50 @@ request-sending possible and a executable-routine.
 """
 
 
+# Content type of binary batches of data rows
+BATCH_CONTENT_TYPE = 'application/x-loadr-batch'
+# Batch header: magic, version, extra columns and number of rows
+BATCH_HEADER = struct.Struct('<4sBBI')
+# Row columns: ci, ri, rri and status - and then start, end and any extra
+# columns as 64 bit integers.
+BATCH_ROW = '<IIIh'
+# Statuses which aren't http status codes
+BATCH_STATUSES = {'connection-error': -1}
+# Message type of control commands on the signal exchange
+CONTROL_TYPE = 'control'
+
+
+def encodebatch(rows):
+    """Packs data rows into a compact binary batch with fixed-width rows.
+    All rows must have the same number of columns.
+    """
+
+    extra = len(rows[0]) - 6
+    row = struct.Struct(BATCH_ROW + 'q' * (2 + extra))
+
+    return BATCH_HEADER.pack(b'LDRB', 1, extra, len(rows)) + \
+        b''.join([row.pack(r[0], r[1], r[2],
+                           BATCH_STATUSES.get(r[3], r[3]),
+                           *r[4:])
+                  for r in rows])
+
+
+def decodebatch(body):
+    """Unpacks a binary batch into a list of data rows.
+    """
+
+    magic, version, extra, count = BATCH_HEADER.unpack_from(body)
+
+    if magic != b'LDRB' or version != 1:
+        raise ValueError('Not a version 1 batch')
+
+    statuses = {val: key for key, val in BATCH_STATUSES.items()}
+    row = struct.Struct(BATCH_ROW + 'q' * (2 + extra))
+
+    return [r[:3] + (statuses.get(r[3], r[3]),) + r[4:]
+            for r in row.iter_unpack(body[BATCH_HEADER.size:])]
+
+
 class CsvWriter:
     """An output writer that writes data to stream as csv.
     """
@@ -52,6 +118,12 @@ class CsvWriter:
     def write(self, *data):
         self.stream.write(','.join([str(v) for v in data]) + '\n')
 
+    def record(self, kind, data):
+        """Writes other kind of data, like histograms, as a json comment line.
+        """
+
+        self.stream.write('# {} {}\n'.format(kind, json.dumps(data)))
+
     def close(self):
         pass
 
@@ -61,17 +133,53 @@ class RabbitWriter:
     This is the writer to use when running on a remote instance.
     It'll use the wait method by waiting for a start-signal from the RabbitMQ
     server.
+
+    The signal exchange also carries control commands, see Control, which
+    listen applies while the workers are running.
+
+    The start-signal is the controller's unix time to start at. Before
+    starting, the writer pings the messenger to estimate the offset of this
+    instance's clock to the controller's, starts at that time by its own
+    clock, and records the offset as a "clock" record:
+        {"offset": <controller time - this time, us>,
+         "rtt": <round-trip time, us>}
+
+    The data rows are buffered and sent as binary batches, see encodebatch.
+    A batch is sent when it has batch_size rows, or when a row is written or
+    the writer is ticked batch_interval seconds after the last batch was
+    sent, so that rows aren't held back by a slow target.
     """
 
-    def __init__(self, url):
+    # Max number of rows per batch
+    batch_size = 1000
+    # Max number of seconds between batches
+    batch_interval = 1
+    # Number of pings to estimate the clock offset by
+    pings = 8
+    # Seconds to wait for each pong
+    ping_timeout = 1
+
+    def __init__(self, url, batch_size=None, batch_interval=None):
         """Connects to RabbitMQ.
         """
 
+        if batch_size is not None:
+            self.batch_size = batch_size
+
+        if batch_interval is not None:
+            self.batch_interval = batch_interval
+
+        self.batch = []
+        self.batch_time = time()
+        # The host name tells which instance the data comes from
+        self.properties = pika.BasicProperties(content_type=BATCH_CONTENT_TYPE,
+                                               app_id=socket.gethostname())
+
         parameters = pika.URLParameters(url)
         self.connection = pika.BlockingConnection(parameters)
         self.channel = self.connection.channel()
 
-        queue = self.channel.queue_declare()
+        queue = self.channel.queue_declare(queue='', exclusive=True)
         self.channel.exchange_declare(exchange='loadr-signal',
                                       exchange_type='fanout')
         self.channel.queue_bind(exchange='loadr-signal',
@@ -80,6 +188,9 @@ class RabbitWriter:
         self.channel.queue_declare(queue='loadr-data')
 
         self.queue = queue.method.queue
+        # Where the messenger sends the pongs
+        self.replies = self.channel.queue_declare(
+            queue='', exclusive=True).method.queue
 
     def wait(self):
         """Wait until there's a start-signal from RabbitMQ server.
@@ -89,179 +200,2550 @@ class RabbitWriter:
             method_frame, properties, body = self.channel.basic_get(
                 queue=self.queue)
 
-            if body is not None:
+            if body is None:
+                sleep(1)
+                continue
+
+            self.channel.basic_ack(method_frame.delivery_tag)
+
+            # Control commands are applied by listen
+            if properties.type != CONTROL_TYPE:
                 break
 
-            sleep(1)
+        offset, rtt = self.ping()
+
+        if offset is None:
+            offset = 0
 
-        self.channel.basic_ack(method_frame.delivery_tag)
-        timeout = int(body) - round(millisec() / 1000)
+        self.record('clock', {'offset': offset, 'rtt': rtt})
+
+        # The controller's start time by this clock
+        starttime = round(float(body) * 1000000) - offset
+        timeout = (starttime - microsec()) / 1000000
 
         if timeout > 0:
             sleep(timeout)
 
+    def ping(self):
+        """Pings the messenger, which answers with the controller's time, and
+        returns the clock offset and round-trip time by clockoffset. Gives up
+        at the first ping without a pong.
+        """
+
+        samples = []
+
+        for i in range(self.pings):
+            properties = pika.BasicProperties(reply_to=self.replies,
+                                              correlation_id=str(i))
+            sent = microsec()
+            self.channel.basic_publish(exchange='',
+                                       routing_key='loadr-ping',
+                                       body=str(sent),
+                                       properties=properties)
+
+            for method, properties, body in self.channel.consume(
+                    self.replies,
+                    auto_ack=True,
+                    inactivity_timeout=self.ping_timeout):
+                if body is None or properties.correlation_id == str(i):
+                    break
+
+            if body is None:
+                break
+
+            samples.append((sent, int(body), microsec()))
+
+        self.channel.cancel()
+
+        return clockoffset(samples)
+
+    @staticmethod
+    def listen(url, control):
+        """Applies the control commands from the signal exchange to control,
+        until the connection is closed.
+        """
+
+        connection = pika.BlockingConnection(pika.URLParameters(url))
+        channel = connection.channel()
+        queue = channel.queue_declare(queue='', exclusive=True).method.queue
+        channel.exchange_declare(exchange='loadr-signal',
+                                 exchange_type='fanout')
+        channel.queue_bind(exchange='loadr-signal', queue=queue)
+
+        def apply(channel, method, properties, body):
+            if properties.type == CONTROL_TYPE:
+                control.command(**json.loads(body.decode()))
+
+        channel.basic_consume(queue=queue,
+                              on_message_callback=apply,
+                              auto_ack=True)
+        channel.start_consuming()
+
     def write(self, *data):
-        """Send data to RabbitMQ.
+        """Add data to the batch, and send it to RabbitMQ when it's full or
+        old enough.
+        """
+
+        self.batch.append(data)
+
+        if len(self.batch) >= self.batch_size or \
+           time() - self.batch_time >= self.batch_interval:
+            self.flush()
+
+    def tick(self, now=None):
+        """Sends the batch if it's more than batch_interval seconds since the
+        last one.
+        """
+
+        if self.batch and time() - self.batch_time >= self.batch_interval:
+            self.flush()
+
+    def flush(self):
+        """Send the batch to RabbitMQ.
+        """
+
+        if self.batch:
+            self.channel.basic_publish(exchange='',
+                                       routing_key='loadr-data',
+                                       body=encodebatch(self.batch),
+                                       properties=self.properties)
+            self.batch = []
+
+        self.batch_time = time()
+
+    def record(self, kind, data):
+        """Send other kind of data, like histograms, as json to RabbitMQ.
+        The kind is set as the message type.
         """
 
-        properties = pika.BasicProperties(content_type='text/plain')
+        properties = pika.BasicProperties(content_type='application/json',
+                                          type=kind,
+                                          app_id=self.properties.app_id)
         self.channel.basic_publish(exchange='',
                                    routing_key='loadr-data',
-                                   body=','.join([str(v) for v in data]),
+                                   body=json.dumps(data),
                                    properties=properties)
 
     def close(self):
-        """Closes connection to RabbitMQ.
+        """Sends what's left of the batch and closes connection to RabbitMQ.
         """
 
+        self.flush()
         self.connection.close()
 
 
-def millisec():
-    """Returns a unix timestamp in milliseconds.
+class AggregateWriter:
+    """An output writer wrapper which aggregates the latencies into one
+    Histogram per request step and status. Every interval seconds it records
+    a "histogram" snapshot of them to the wrapped writer, and starts over:
+        {"start": <us>,
+         "end": <us>,
+         "histograms": [{"step": <ri>,
+                         "status": <status>,
+                         "histogram": <Histogram.snapshot()>}, ...]}
+
+    The data rows are only passed on to the wrapped writer if rows is set.
+    Rows with an intended start time gets their latency counted from it.
+    The latencies are in microseconds.
     """
 
-    return int(round(time() * 1000))
+    def __init__(self, out, interval, rows=False):
+        self.out = out
+        self.interval = interval * 1000000
+        self.rows = rows
+        self.histograms = {}
+        self.starttime = microsec()
 
+    def wait(self):
+        self.out.wait()
+        self.starttime = microsec()
 
-def configdefaults(config):
-    """Setting default data to config and returns it.
-    Maybe rewrite this with collections.defaultdict for simplicity.
+    def write(self, *data):
+        key = (data[1], data[3])
+
+        if key not in self.histograms:
+            self.histograms[key] = Histogram()
+
+        self.histograms[key].record(data[5] - data[6 if len(data) > 6 else 4])
+
+        if self.rows:
+            self.out.write(*data)
+
+        if data[5] - self.starttime >= self.interval:
+            self.flush(data[5])
+
+    def record(self, kind, data):
+        self.out.record(kind, data)
+
+    def tick(self, now):
+        if now - self.starttime >= self.interval:
+            self.flush(now)
+
+        tick(self.out, now)
+
+    def flush(self, endtime=None):
+        """Records a snapshot of all histograms and resets them.
+        """
+
+        if endtime is None:
+            endtime = microsec()
+
+        if self.histograms:
+            self.out.record('histogram', {
+                'start': self.starttime,
+                'end': endtime,
+                'histograms': [{'step': step,
+                                'status': status,
+                                'histogram': histogram.snapshot()}
+                               for (step, status), histogram
+                               in self.histograms.items()]})
+
+        self.histograms = {}
+        self.starttime = endtime
+
+    def close(self):
+        self.flush()
+        self.out.close()
+
+
+class ExpectWriter:
+    """An output writer wrapper which counts the requests' expectation checks
+    per request step, instead of writing them per row. Every interval seconds,
+    and when closed, it records an "expect" snapshot of the counters to the
+    wrapped writer, and starts over:
+        {"start": <us>,
+         "end": <us>,
+         "steps": [{"step": <ri>,
+                    "passed": <count>,
+                    "failed": {<check>: <count>, ...}}, ...]}
     """
 
-    defaults = {'method': 'GET',
-                'headers': None,
-                'body': None,
-                'repeat': 1}
+    # Seconds between the snapshots
+    interval = 1
 
-    for req in config:
-        for key, val in defaults.items():
-            if key not in req:
-                req[key] = val
+    def __init__(self, out, interval=None):
+        self.out = out
 
-    return config
+        if interval is not None:
+            self.interval = interval
 
+        self.steps = {}
+        self.starttime = microsec()
 
-def parseconfig(data, history):
-    """Parses request config with history data.
-    Takes content with pattern: "{{from(1).json.data}}" and replaces it
-    with data from previous requests.
+    def wait(self):
+        self.out.wait()
+        self.starttime = microsec()
+
+    def write(self, *data):
+        self.out.write(*data)
+
+    def record(self, kind, data):
+        self.out.record(kind, data)
+
+    def expect(self, ri, failed, endtime):
+        """Counts a checked request of step ri, which ended at endtime, by
+        the check it failed, or as passed if None.
+        """
+
+        if ri not in self.steps:
+            self.steps[ri] = {'passed': 0, 'failed': {}}
+
+        if failed is None:
+            self.steps[ri]['passed'] += 1
+        else:
+            counters = self.steps[ri]['failed']
+            counters[failed] = counters.get(failed, 0) + 1
+
+        if endtime - self.starttime >= self.interval * 1000000:
+            self.flush(endtime)
+
+    def tick(self, now):
+        if now - self.starttime >= self.interval * 1000000:
+            self.flush(now)
+
+        tick(self.out, now)
+
+    def flush(self, endtime=None):
+        """Records a snapshot of all counters and resets them.
+        """
+
+        if endtime is None:
+            endtime = microsec()
+
+        if self.steps:
+            self.out.record('expect', {
+                'start': self.starttime,
+                'end': endtime,
+                'steps': [dict(counters, step=step)
+                          for step, counters in self.steps.items()]})
+
+        self.steps = {}
+        self.starttime = endtime
+
+    def close(self):
+        self.flush()
+        self.out.close()
+
+
+class HealthWriter:
+    """An output writer wrapper which samples the health of its worker
+    process. Every interval seconds, and when closed, it records a "health"
+    snapshot to the wrapped writer, and starts over:
+        {"start": <us>,
+         "end": <us>,
+         "cpu": <percent of a core used by the process>,
+         "host": <percent of all cores used on the host>,
+         "lag": <max us the process was late to run>,
+         "backlog": <max requests sent or due, but not yet done>}
+
+    The lag is sampled every probe seconds by a lagprobe, or an
+    asynclagprobe within an event loop, and by the rate scheduler when it's
+    late to start a cycle. The backlog is counted up by the engines by
+    pending, and down by every written row.
+
+    The probes also tick the wrapped writers, so that what they send by
+    time, like batches and snapshots, isn't held back by a slow target. The
+    wrapped writers are only used by one thread at a time, by the lock.
+
+    The host's CPU use counts too, since with the process engine every
+    virtual user is a process of its own, and none of them may use a whole
+    core while the host is saturated.
+
+    A saturated worker reports latencies which include its own delays, so the
+    controller flags them, see util.health.
     """
 
-    if type(data) is str:
-        for match in finditer('{{from\(([^)]+)\)\.(.+?)}}', data):
-            if match.group(1) in history:
-                prop = history[match.group(1)]
-                keys = match.group(2).split('.')
-
-                if keys[0] == 'json':
-                    # JSON data from body
-                    prop = prop.json()
-                elif keys[0] == 'headers':
-                    # Data from headers
-                    prop = prop.headers
-                else:
-                    continue
+    # Seconds between the snapshots
+    interval = 1
+    # Seconds between the lag probes
+    probe = 0.1
 
-                for k in keys[1:]:
-                    if k in prop:
-                        prop = prop[k]
-                        continue
+    def __init__(self, out, interval=None):
+        self.out = out
 
-                    prop = None
-                    break
+        if interval is not None:
+            self.interval = interval
 
-                if prop is not None:
-                    data = data.replace(match.group(0), prop)
+        self.requests = 0
+        self.lock = RLock()
+        self.reset(microsec())
 
-        return data
+    def reset(self, starttime):
+        self.starttime = starttime
+        self.cputime = process_time()
+        self.hosttime = hostcputime()
+        self.lag = 0
+        self.backlog = self.requests
 
-    if type(data) is dict:
-        config = {}
+    def wait(self):
+        self.out.wait()
+        self.reset(microsec())
 
-        for key, val in data.items():
-            config[key] = parseconfig(val, history)
+    def write(self, *data):
+        with self.lock:
+            self.requests -= 1
+            self.out.write(*data)
+            self.tick(data[5])
+
+    def record(self, kind, data):
+        with self.lock:
+            self.out.record(kind, data)
+
+    def expect(self, ri, failed, endtime):
+        with self.lock:
+            self.out.expect(ri, failed, endtime)
+
+    def pending(self, count):
+        """Counts requests which are sent or due, or no longer due if count is
+        negative.
+        """
 
-        return config
+        self.requests += count
+        self.backlog = max(self.backlog, self.requests)
 
-    return data
+    def late(self, lag):
+        """Samples a lag, in microseconds.
+        """
 
+        self.lag = max(self.lag, lag)
 
-def send(config, sess, history):
-    """Sends a request specified by config-dict:
-    {
-        "method": "POST",
-        "url": "https://some-host",
-        "header": { advanced-session-header-with-content-type },
-        "body": { some-data }
-    }
+    def tick(self, now=None):
+        """Records a snapshot if it's more than interval seconds since the
+        last one, and ticks the wrapped writer.
+        """
+
+        if now is None:
+            now = microsec()
+
+        with self.lock:
+            if now - self.starttime >= self.interval * 1000000:
+                self.flush(now)
+
+            tick(self.out, now)
+
+    def flush(self, endtime=None):
+        """Records a snapshot of the samples and resets them.
+        """
+
+        if endtime is None:
+            endtime = microsec()
+
+        with self.lock:
+            if endtime > self.starttime:
+                self.out.record('health', {
+                    'start': self.starttime,
+                    'end': endtime,
+                    'cpu': round((process_time() - self.cputime) * 1e8 /
+                                 (endtime - self.starttime), 1),
+                    'host': hostcpu(self.hosttime, hostcputime()),
+                    'lag': self.lag,
+                    'backlog': self.backlog})
+
+            self.reset(endtime)
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.out.close()
+
+
+def hostcputime():
+    """Returns the host's busy and total CPU time, in ticks, from /proc/stat,
+    or None where there is none.
     """
 
-    config = parseconfig(config, history)
-    req = Request(config['method'],
-                  config['url'],
-                  headers=config['headers'],
-                  data=json.dumps(config['body']))
+    try:
+        with open('/proc/stat') as f:
+            ticks = [int(v) for v in f.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
 
-    return sess.send(sess.prepare_request(req))
+    # Idle and waiting for I/O
+    idle = sum(ticks[3:5])
 
+    return sum(ticks) - idle, sum(ticks)
 
-def singlerepeater(repeat, writer, config):
-    """A request repeater. It runs through the request config x times,
-    where x is repeat.
 
-    It'll create a new requests.Session and history record for each repeat.
+def hostcpu(before, after):
+    """Returns the percent of all cores used on the host between two
+    hostcputime samples, or by the load average where there are none.
     """
 
-    out = writer[0](*writer[1:])
-    out.wait()
+    if before is None or after is None:
+        return round(os.getloadavg()[0] * 100 / cpu_count(), 1)
 
-    for ci in range(0, repeat):
-        sess = Session()
-        history = {}
-        ri = 0
+    if after[1] == before[1]:
+        return 0.0
 
-        for req in config:
-            for rri in range(int(req['repeat'])):
-                starttime = millisec()
+    return round((after[0] - before[0]) * 100 / (after[1] - before[1]), 1)
 
-                try:
-                    res = send(req, sess, history)
-                    history[str(ri)] = res
-                    status = res.status_code
-                except ConnectionError as e:
-                    status = 'connection-error'
 
-                endtime = millisec()
+def tick(out, now):
+    """Ticks a writer, if it does anything by time.
+    """
 
-                out.write(ci,
-                          ri,
-                          rri,
-                          status,
-                          starttime,
-                          endtime)
+    if hasattr(out, 'tick'):
+        out.tick(now)
 
-                ri += 1
 
-                if 'name' in req:
-                    history[req['name']] = res
+def lagprobe(out, stopped):
+    """Samples how late a thread of the worker process is to wake up, every
+    probe seconds until stopped is set, and records the snapshots when
+    they're due, even while the writing thread waits for a response.
+    """
 
-        sess.close()
+    while True:
+        starttime = microsec()
 
-    out.close()
+        if stopped.wait(out.probe):
+            return
 
+        now = microsec()
+        out.late(max(now - starttime - int(out.probe * 1000000), 0))
+        out.tick(now)
 
-def multirepeater(concurrency, repeat, writer, requestconfig):
-    """Setting up multiple singlerepeaters by threading for true concurrency.
+
+async def asynclagprobe(out):
+    """Samples how late the event loop is to wake up, every probe seconds,
+    and records the snapshots when they're due. Runs until cancelled.
     """
 
-    config = configdefaults(requestconfig)
-    processes = [Process(target=singlerepeater,
-                         args=(repeat, writer, config))
-                 for x in range(concurrency)]
+    while True:
+        starttime = microsec()
+        await asyncio.sleep(out.probe)
+        now = microsec()
+        out.late(max(now - starttime - int(out.probe * 1000000), 0))
+        out.tick(now)
 
-    for p in processes:
-        p.start()
+
+class Histogram:
+    """A HDR (high dynamic range) histogram of positive integers, like
+    latencies. The values are counted in log-linear buckets which keeps the
+    precision of x significant digits, where x is digits, for any size of
+    value. Only the buckets in use are stored.
+
+    Histograms with the same digits can be merged, which makes it possible to
+    aggregate them from many workers.
+    """
+
+    def __init__(self, digits=3):
+        self.digits = digits
+        # Sub buckets within each power of two
+        self.bits = math.ceil(math.log2(2 * 10 ** digits))
+        self.subcount = 1 << self.bits
+        self.halfcount = self.subcount >> 1
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def index(self, value):
+        """Returns the bucket index for value.
+        """
+
+        if value < self.subcount:
+            return value
+
+        shift = value.bit_length() - self.bits
+
+        return shift * self.halfcount + (value >> shift)
+
+    def value(self, index):
+        """Returns the middle value of the bucket by index.
+        """
+
+        if index < self.subcount:
+            return index
+
+        shift = (index - self.subcount) // self.halfcount + 1
+
+        return ((index - shift * self.halfcount) << shift) + \
+            (1 << (shift - 1))
+
+    def record(self, value, count=1):
+        """Counts a value.
+        """
+
+        value = max(int(value), 0)
+        index = self.index(value)
+        self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += count
+        self.total += value * count
+
+        if self.min is None or value < self.min:
+            self.min = value
+
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Adds all counted values of another histogram to this one.
+        """
+
+        if other.digits != self.digits:
+            raise ValueError('Can only merge histograms with the same digits')
+
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+
+        self.count += other.count
+        self.total += other.total
+
+        if other.min is not None and (self.min is None or
+                                      other.min < self.min):
+            self.min = other.min
+
+        if other.max is not None and (self.max is None or
+                                      other.max > self.max):
+            self.max = other.max
+
+        return self
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def percentile(self, percent):
+        """Returns the value below which percent of all values are.
+        """
+
+        if self.count == 0:
+            return None
+
+        rank = max(math.ceil(self.count * percent / 100), 1)
+        seen = 0
+
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+
+            if seen >= rank:
+                return min(max(self.value(index), self.min), self.max)
+
+        return self.max
+
+    def snapshot(self):
+        """Returns a compact json-able dict of the histogram, with the used
+        buckets as a flat list of index and count pairs.
+        """
+
+        buckets = []
+
+        for index in sorted(self.buckets):
+            buckets += [index, self.buckets[index]]
+
+        return {'digits': self.digits,
+                'count': self.count,
+                'total': self.total,
+                'min': self.min,
+                'max': self.max,
+                'buckets': buckets}
+
+    @classmethod
+    def fromsnapshot(cls, snapshot):
+        """Creates a histogram from a snapshot.
+        """
+
+        histogram = cls(snapshot['digits'])
+        buckets = snapshot['buckets']
+        histogram.buckets = dict(zip(buckets[0::2], buckets[1::2]))
+        histogram.count = snapshot['count']
+        histogram.total = snapshot['total']
+        histogram.min = snapshot['min']
+        histogram.max = snapshot['max']
+
+        return histogram
+
+
+class BufferedResponse:
+    """A response with its body already read into memory.
+    It's what the async engine stores in the history, and it looks enough like
+    a requests.Response for parseconfig to pick data from it.
+    """
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content.decode())
+
+
+class Control:
+    """Commands to the running workers, shared by all worker processes:
+        run - the default, and resumes paused workers
+        pause - the workers hold before their next request
+        stop - the workers end after their current request
+        rate - the rate mode's rate is multiplied by factor
+    The state is in shared memory, so checking it between the requests is
+    only a memory read. It must be created before the processes are forked.
+    """
+
+    RUN = 0
+    PAUSE = 1
+    STOP = 2
+
+    # Seconds between the checks while paused or waiting for an arrival
+    interval = 0.1
+
+    def __init__(self):
+        self.state = RawValue('i', self.RUN)
+        self.factor = RawValue('d', 1.0)
+
+    def command(self, command, factor=None):
+        """Applies a command by name: "run", "pause", "stop" or "rate" with
+        a factor.
+        """
+
+        if command == 'rate':
+            if factor is None or factor <= 0:
+                raise ValueError('The rate factor must be above 0')
+
+            self.factor.value = factor
+        elif command == 'run':
+            self.state.value = self.RUN
+        elif command == 'pause':
+            self.state.value = self.PAUSE
+        elif command == 'stop':
+            self.state.value = self.STOP
+        else:
+            raise ValueError('No control command with name "{}"'
+                             .format(command))
+
+    def hold(self):
+        """Waits while paused. Returns whether the workers are to stop.
+        """
+
+        while self.state.value == self.PAUSE:
+            sleep(self.interval)
+
+        return self.state.value == self.STOP
+
+    async def asynchold(self):
+        """The coroutine version of hold.
+        """
+
+        while self.state.value == self.PAUSE:
+            await asyncio.sleep(self.interval)
+
+        return self.state.value == self.STOP
+
+
+def clockoffset(samples):
+    """Returns the offset of a remote clock to this one and the round-trip
+    time, from (sent, remote time, received) samples of pings, all in
+    microseconds, or (None, None) without samples.
+
+    As in NTP, the remote time is assumed to be taken halfway through the
+    round-trip, and the sample with the shortest round-trip, the one least
+    delayed by queueing, is used.
+    """
+
+    if not samples:
+        return None, None
+
+    sent, remote, received = min(samples, key=lambda s: s[2] - s[0])
+
+    return remote - (sent + received) // 2, received - sent
+
+
+def millisec():
+    """Returns a unix timestamp in milliseconds.
+    """
+
+    return int(round(time() * 1000))
+
+
+class Clock:
+    """Unix timestamps in microseconds, measured by the monotonic clock and
+    placed on the wall-clock by an anchor taken when the clock is created.
+    Durations between them are never affected by adjustments of the
+    wall-clock, and they're comparable between processes.
+    """
+
+    def __init__(self):
+        self.wall = time_ns()
+        self.monotonic = monotonic_ns()
+
+    def __call__(self):
+        return (self.wall + monotonic_ns() - self.monotonic) // 1000
+
+    def anchor(self):
+        """Returns the anchor, in microseconds, as it's recorded.
+        """
+
+        return {'wall': self.wall // 1000,
+                'monotonic': self.monotonic // 1000}
+
+
+# The clock all rows are timed by
+microsec = Clock()
+# The phases of a request, in the order they happen. They're written as
+# extra columns, in microseconds, with the "phases" client option.
+PHASES = ('dns', 'connect', 'tls', 'ttfb', 'download')
+
+
+def configdefaults(config):
+    """Setting default data to config and returns it.
+    Maybe rewrite this with collections.defaultdict for simplicity.
+    """
+
+    defaults = {'method': 'GET',
+                'headers': None,
+                'body': None,
+                'repeat': 1}
+
+    for req in config:
+        for key, val in defaults.items():
+            if key not in req:
+                req[key] = val
+
+    return config
+
+
+def optiondefaults(options):
+    """Setting default worker options and returns them.
+    Options are the session configuration's extra keys, like "engine".
+    """
+
+    defaults = {'engine': 'process',
+                'rate': None,
+                'aggregate': None,
+                'rows': True,
+                'client': None,
+                'health': None,
+                'feed': None,
+                'replay': None}
+
+    if options is None:
+        options = {}
+
+    for key, val in defaults.items():
+        if key not in options:
+            options[key] = val
+
+    return options
+
+
+def openwriter(writer, options, config=None, expect=False):
+    """Creates an output writer by its (class, arguments...) tuple.
+    With the "aggregate" option it's wrapped by an AggregateWriter, and if
+    any request in the compiled config expects anything, or if expect is set
+    since the requests aren't known beforehand, by an ExpectWriter.
+    It's always wrapped by a HealthWriter, which records a snapshot every
+    "health" seconds, or every second by default.
+
+    The clock's anchor is recorded first, so that the rows can be aligned
+    with other instances' rows.
+    """
+
+    out = writer[0](*writer[1:])
+
+    if options['aggregate'] is not None:
+        out = AggregateWriter(out, options['aggregate'], options['rows'])
+
+    if expect or config is not None and \
+            any([req.expect is not None for req in config]):
+        out = ExpectWriter(out)
+
+    out = HealthWriter(out, options['health'])
+
+    out.record('anchor', microsec.anchor())
+
+    return out
+
+
+# Pattern of references to data from previous requests:
+# "{{from(1).json.data}}" or "{{from('name').headers.Some-header}}"
+REFERENCE = re.compile(r'{{from\(([^)]+)\)\.(.+?)}}')
+# Pattern of references to the virtual user's row from the feed:
+# "{{feed.user_id}}" or "{{feed.address.city}}"
+FEED_REFERENCE = re.compile(r'{{feed\.(.+?)}}')
+
+
+class Reference:
+    """A reference to data in a previous request's response, by the request's
+    index or name, and the path to the data, like "json.data.id".
+    """
+
+    def __init__(self, source, path, text):
+        self.source = source.strip('\'"')
+        self.path = path
+        self.text = text
+
+    def resolve(self, history):
+        """Returns the referenced data, or None if it's not found.
+        The history contains the extracted data of previous responses.
+        """
+
+        if self.source not in history:
+            return None
+
+        return history[self.source].get(self.path)
+
+
+class FeedReference:
+    """A reference to data in the virtual user's row from the feed, by its
+    path, like "user_id" or, in a json line, "address.city".
+
+    The row is kept in the history under None, which no request can refer
+    to, so its paths are never extracted from any response.
+    """
+
+    source = None
+
+    def __init__(self, path, text):
+        self.path = path
+        self.text = text
+
+    def resolve(self, history):
+        prop = history.get(None)
+
+        for k in self.path.split('.'):
+            if not isinstance(prop, Mapping) or k not in prop:
+                return None
+
+            prop = prop[k]
+
+        return prop
+
+
+def extract(res, paths):
+    """Extracts the data in paths from a response, like "json.data.id" or
+    "headers.Content-Type", and returns it as a dict indexed by path.
+    The body is only json decoded once, and only if needed.
+    """
+
+    data = {}
+    body = None
+
+    for path in paths:
+        keys = path.split('.')
+
+        if keys[0] == 'json':
+            # JSON data from body
+            if body is None:
+                try:
+                    body = res.json()
+                except ValueError:
+                    body = {}
+
+            prop = body
+        elif keys[0] == 'headers':
+            # Data from headers
+            prop = res.headers
+        else:
+            continue
+
+        for k in keys[1:]:
+            if not isinstance(prop, Mapping) or k not in prop:
+                prop = None
+                break
+
+            prop = prop[k]
+
+        if prop is not None:
+            data[path] = prop
+
+    return data
+
+
+class Template:
+    """A string with references, split once into its static parts and
+    references. References which can't be resolved are left as they are.
+    """
+
+    def __init__(self, text):
+        self.parts = []
+        self.references = []
+        position = 0
+        matches = sorted(list(REFERENCE.finditer(text)) +
+                         list(FEED_REFERENCE.finditer(text)),
+                         key=lambda match: match.start())
+
+        for match in matches:
+            if match.re is FEED_REFERENCE:
+                reference = FeedReference(match.group(1), match.group(0))
+            else:
+                reference = Reference(match.group(1), match.group(2),
+                                      match.group(0))
+
+            self.parts += [text[position:match.start()], reference]
+            self.references.append(reference)
+            position = match.end()
+
+        self.parts.append(text[position:])
+
+    def render(self, history):
+        data = ''
+
+        for part in self.parts:
+            if type(part) is str:
+                data += part
+            else:
+                value = part.resolve(history)
+                data += part.text if value is None else str(value)
+
+        return data
+
+
+class DictTemplate:
+    """A dict with one or more Templates among its values.
+    """
+
+    def __init__(self, data):
+        self.static = {key: val for key, val in data.items()
+                       if not isinstance(val, (Template, DictTemplate))}
+        self.dynamic = [(key, val) for key, val in data.items()
+                        if isinstance(val, (Template, DictTemplate))]
+        self.references = [reference
+                           for key, val in self.dynamic
+                           for reference in val.references]
+
+    def render(self, history):
+        data = dict(self.static)
+
+        for key, val in self.dynamic:
+            data[key] = val.render(history)
+
+        return data
+
+
+class BodyTemplate:
+    """A request body, pre-encoded as json bytes.
+    If the body has references it's split into static bytes and the
+    Templates in between, whose rendered strings are json encoded on render.
+    """
+
+    # Placeholder for templates within the json encoded body
+    placeholder = '@@loadr-template-{}@@'
+
+    def __init__(self, data):
+        self.templates = []
+        text = json.dumps(self.replace(compiledata(data)))
+        self.parts = []
+        position = 0
+
+        for i, template in enumerate(self.templates):
+            placeholder = json.dumps(self.placeholder.format(i))
+            index = text.index(placeholder, position)
+            self.parts += [text[position:index].encode(), template]
+            position = index + len(placeholder)
+
+        self.parts.append(text[position:].encode())
+        self.references = [reference
+                           for template in self.templates
+                           for reference in template.references]
+
+    def replace(self, data):
+        """Replaces all Templates with placeholders and collects them.
+        """
+
+        if isinstance(data, Template):
+            self.templates.append(data)
+            return self.placeholder.format(len(self.templates) - 1)
+
+        if isinstance(data, DictTemplate):
+            data = dict(data.static, **dict(data.dynamic))
+
+        if type(data) is dict:
+            return {key: self.replace(val) for key, val in data.items()}
+
+        return data
+
+    def render(self, history):
+        if len(self.parts) == 1:
+            return self.parts[0]
+
+        return b''.join([part if type(part) is bytes
+                         else json.dumps(part.render(history)).encode()
+                         for part in self.parts])
+
+
+class Expectation:
+    """A request's "expect" config, compiled once so that checking a response
+    is cheap:
+        {"status": <status or list of statuses>,
+         "latency": <max milliseconds>,
+         "json": [<path to a field which must be in the json body>, ...]}
+    """
+
+    def __init__(self, config):
+        status = config.get('status')
+        latency = config.get('latency')
+
+        if status is None:
+            self.status = None
+        elif type(status) is list:
+            self.status = set(status)
+        else:
+            self.status = {status}
+
+        self.latency = None if latency is None else latency * 1000
+        self.paths = ['json.' + path for path in config.get('json', [])]
+
+    def check(self, status, latency, res):
+        """Returns the first check which a response fails, "status",
+        "latency" or "json", or None if it passes. The latency is in
+        microseconds, and the response is None if the request failed.
+        """
+
+        if self.status is not None and status not in self.status:
+            return 'status'
+
+        if self.latency is not None and latency > self.latency:
+            return 'latency'
+
+        if self.paths and (res is None or
+                           len(extract(res, self.paths)) < len(self.paths)):
+            return 'json'
+
+        return None
+
+
+class RequestTemplate:
+    """A request config compiled once, so that only the references has to be
+    resolved for each request.
+
+    The paths are, for each repeat of the request, which data later requests
+    refers to in its response. It's set by compileconfig.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.name = config.get('name')
+        self.repeat = int(config.get('repeat', 1))
+        self.method = compiledata(config['method'])
+        self.url = compiledata(config['url'])
+        self.headers = compiledata(config['headers'])
+        self.body = BodyTemplate(config['body'])
+        self.expect = Expectation(config['expect']) \
+            if config.get('expect') else None
+        self.references = references(self.method) + \
+            references(self.url) + \
+            references(self.headers) + \
+            self.body.references
+        self.paths = [[] for rri in range(self.repeat)]
+
+    def extract(self, res, rri):
+        """Extracts the data later requests refers to from the response of
+        repeat rri. Returns None if nothing is refered to.
+        """
+
+        if not self.paths[rri]:
+            return None
+
+        return extract(res, self.paths[rri])
+
+    def render(self, history):
+        """Returns method, url, headers and the encoded body.
+        """
+
+        return (renderdata(self.method, history),
+                renderdata(self.url, history),
+                renderdata(self.headers, history),
+                self.body.render(history))
+
+
+def compiledata(data):
+    """Compiles strings with references into Templates, and dicts with such
+    strings into DictTemplates. Everything else is returned as it is.
+    """
+
+    if type(data) is str:
+        template = Template(data)
+        return template if template.references else data
+
+    if type(data) is dict:
+        data = {key: compiledata(val) for key, val in data.items()}
+
+        for val in data.values():
+            if isinstance(val, (Template, DictTemplate)):
+                return DictTemplate(data)
+
+    return data
+
+
+def references(data):
+    """Returns all References in compiled data.
+    """
+
+    if isinstance(data, (Template, DictTemplate)):
+        return data.references
+
+    return []
+
+
+def renderdata(data, history):
+    """Renders compiled data with history data.
+    """
+
+    if isinstance(data, (Template, DictTemplate)):
+        return data.render(history)
+
+    return data
+
+
+def compileconfig(config):
+    """Compiles a request config list into RequestTemplates.
+    Already compiled request configs are returned as they are.
+
+    Every request gets to know which data later requests refers to in its
+    responses, by the request's index or name. So only that data has to be
+    extracted and kept in the history.
+    """
+
+    if all([isinstance(req, RequestTemplate) for req in config]):
+        return config
+
+    config = [RequestTemplate(req) for req in config]
+    paths = {}
+
+    for req in config:
+        for reference in req.references:
+            # Feed references aren't extracted from any response
+            if reference.source is not None:
+                paths.setdefault(reference.source, set()).add(reference.path)
+
+    ri = 0
+
+    for req in config:
+        for rri in range(req.repeat):
+            req.paths[rri] = sorted(paths.get(str(ri), set()) |
+                                    paths.get(req.name, set()))
+            ri += 1
+
+    return config
+
+
+def parseconfig(data, history):
+    """Parses request config with history data.
+    Takes content with pattern: "{{from(1).json.data}}" and replaces it
+    with data from previous responses in history.
+    """
+
+    data = compiledata(data)
+    extracted = {}
+
+    for reference in references(data):
+        if reference.source in history:
+            extracted.setdefault(reference.source, {}).update(
+                extract(history[reference.source], [reference.path]))
+
+    return renderdata(data, extracted)
+
+
+class Feeder:
+    """Streams rows of variables, like credentials or search terms, from a
+    feed file into the virtual users' requests, as "{{feed.<column>}}":
+        {"path": <csv file with a header line, or json lines>,
+         "format": <"csv" or "jsonl", by the path's extension by default>,
+         "scope": <"cycle" for a row per cycle, or "user" for one row for
+                   all cycles of a virtual user>,
+         "loop": <whether to start over when the rows run out>,
+         "partition": [<part>, <number of parts>]}
+
+    The file is memory-mapped and read one line at a time, so it's never
+    loaded. Only the rows within its partition are read: a byte range of
+    the file, moved to the starts of lines, so the partitions split the rows
+    between them without duplicates. See partitioned.
+
+    When the rows run out, without loop, the virtual users stop.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.path = config['path']
+        self.format = config.get(
+            'format', 'csv' if self.path.endswith('.csv') else 'jsonl')
+        self.scope = config.get('scope', 'cycle')
+        self.loop = config.get('loop', False)
+        self.partition = config.get('partition', [0, 1])
+
+        if self.format not in ('csv', 'jsonl'):
+            raise ValueError('No feed format with name "{}"'
+                             .format(self.format))
+
+        if self.scope not in ('cycle', 'user'):
+            raise ValueError('No feed scope with name "{}"'
+                             .format(self.scope))
+
+        self.map = None
+        self.header = None
+
+    def open(self):
+        """Maps the file, and finds the byte range of the partition.
+        """
+
+        with open(self.path, 'rb') as f:
+            if f.seek(0, 2) == 0:
+                self.map = b''
+            else:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        base = 0
+
+        if self.format == 'csv':
+            newline = self.map.find(b'\n')
+            base = len(self.map) if newline < 0 else newline + 1
+            self.header = next(csv.reader(
+                [self.map[:base].decode('utf-8').strip()]), [])
+
+        part, parts = self.partition
+        size = len(self.map) - base
+        self.start = self.align(base + size * part // parts, base)
+        self.end = self.align(base + size * (part + 1) // parts, base)
+        self.position = self.start
+        # Rows since the partition was started over
+        self.rows = 0
+
+    def align(self, offset, base):
+        """Returns where the first line which starts at or after offset
+        starts.
+        """
+
+        if offset <= base or self.map[offset - 1:offset] == b'\n':
+            return offset
+
+        newline = self.map.find(b'\n', offset)
+
+        return len(self.map) if newline < 0 else newline + 1
+
+    def next(self):
+        """Returns the next row of the partition, or None when the rows run
+        out.
+        """
+
+        if self.map is None:
+            self.open()
+
+        while True:
+            if self.position >= self.end:
+                if not self.loop or self.rows == 0:
+                    return None
+
+                self.position = self.start
+                self.rows = 0
+
+            newline = self.map.find(b'\n', self.position, self.end)
+            stop = self.end if newline < 0 else newline
+            line = self.map[self.position:stop].strip()
+            self.position = stop + 1
+
+            if line:
+                self.rows += 1
+
+                return self.parse(line.decode('utf-8'))
+
+    def parse(self, line):
+        if self.format == 'csv':
+            return dict(zip(self.header, next(csv.reader([line]))))
+
+        return json.loads(line)
+
+    def extract(self, f):
+        """Writes the partition, with the csv header, to the binary file f,
+        so that only it has to be shipped to a remote instance. Returns the
+        config of the written feed.
+        """
+
+        if self.map is None:
+            self.open()
+
+        if self.format == 'csv':
+            newline = self.map.find(b'\n')
+            f.write(self.map[:len(self.map) if newline < 0 else newline + 1])
+
+        f.write(self.map[self.start:self.end])
+
+        return dict(self.config, format=self.format, partition=[0, 1])
+
+    def cycle(self, row):
+        """Returns the row for a virtual user's next cycle, by its row in
+        the previous cycle, None if it's the first. None when the rows run
+        out.
+        """
+
+        if row is not None and self.scope == 'user':
+            return row
+
+        return self.next()
+
+
+# Pattern of access log lines, in the common or combined log format:
+# client - user [time] "method path protocol" ...
+ACCESS_LOG = re.compile(r'^(\S+) \S+ \S+ \[([^\]]+)\] "(\S+) (\S+)[^"]*"')
+
+
+class Replay:
+    """A replay of timestamped requests from a file, at their original pace
+    times speed:
+        {"path": <json lines, or an access log>,
+         "format": <"jsonl" or "log", by the path's extension by default>,
+         "base": <url which the paths are relative to>,
+         "speed": <how many times faster than the original pace>,
+         "key": <field which the requests are sharded by>,
+         "start": <time the requests are replayed from, in seconds, the
+                   first request's by default>,
+         "partition": [<part>, <number of parts>]}
+
+    A json line is a request config, like those of the requests cycle, with
+    its time in seconds or ISO 8601, and a path instead of an url if it's
+    relative to the base:
+        {"time": 1700000000.25, "method": "POST", "path": "/login",
+         "headers": {...}, "body": {...}, "session": "abc"}
+
+    An access log line, in the common or combined log format, is a request
+    with its method, path and time, whose key is the client's address.
+
+    The file is streamed one line at a time, and only the requests of the
+    partition are replayed: those whose key hashes to it, so that all
+    requests of a session, by key, are replayed by the same process. Without
+    a key the requests are spread by their line numbers. The lines which
+    can't be parsed are skipped.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.path = config['path']
+        self.format = config.get(
+            'format', 'log' if self.path.endswith('.log') else 'jsonl')
+        self.base = config.get('base', '')
+        self.speed = config.get('speed', 1)
+        self.key = config.get('key', 'client' if self.format == 'log'
+                              else None)
+        self.partition = config.get('partition', [0, 1])
+        self.start = config.get('start')
+
+        if self.format not in ('jsonl', 'log'):
+            raise ValueError('No replay format with name "{}"'
+                             .format(self.format))
+
+        if self.speed <= 0:
+            raise ValueError('The replay speed must be above 0')
+
+    def parse(self, line):
+        """Returns the time, key and request config of a line, or None if it
+        can't be parsed.
+        """
+
+        if self.format == 'log':
+            match = ACCESS_LOG.match(line)
+
+            if match is None:
+                return None
+
+            client, timestamp, method, path = match.groups()
+
+            try:
+                timestamp = datetime.strptime(
+                    timestamp, '%d/%b/%Y:%H:%M:%S %z').timestamp()
+            except ValueError:
+                return None
+
+            return (timestamp,
+                    client if self.key == 'client' else None,
+                    {'method': method, 'url': self.base + path})
+
+        try:
+            request = json.loads(line)
+            timestamp = request.pop('time')
+
+            if type(timestamp) is str:
+                # Before python 3.11 fromisoformat doesn't parse a Z
+                timestamp = datetime.fromisoformat(
+                    re.sub('Z$', '+00:00', timestamp)).timestamp()
+        except (ValueError, KeyError, AttributeError):
+            return None
+
+        if 'url' not in request:
+            request['url'] = self.base + request.pop('path', '')
+
+        key = request.pop(self.key, None) if self.key is not None else None
+
+        return timestamp, key, {name: request[name]
+                                for name in ('method', 'url', 'headers',
+                                             'body', 'expect')
+                                if name in request}
+
+    def lines(self):
+        """Yields the time, line number, line, key and request config of
+        each request in the partition, and sets the start if it's not set.
+        """
+
+        part, parts = self.partition
+
+        with open(self.path, encoding='utf-8', errors='replace') as f:
+            for number, line in enumerate(f):
+                parsed = self.parse(line)
+
+                if parsed is None:
+                    continue
+
+                timestamp, key, request = parsed
+
+                if self.start is None:
+                    self.start = timestamp
+
+                shard = number if key is None \
+                    else zlib.crc32(str(key).encode())
+
+                if shard % parts == part:
+                    yield timestamp, number, line, key, request
+
+    def __iter__(self):
+        """Yields the time in seconds, from the start, line number and
+        request config of each request in the partition.
+        """
+
+        for timestamp, number, line, key, request in self.lines():
+            yield timestamp - self.start, number, request
+
+    def extract(self, f):
+        """Writes the lines of the partition to the text file f, so that only
+        they have to be shipped to a remote instance. Returns the config of
+        the written replay, which starts when the whole file does. Its lines
+        are numbered anew, so unless all of them have keys, which still hash
+        to the same partition, it's no longer partitioned.
+        """
+
+        keyed = True
+
+        for timestamp, number, line, key, request in self.lines():
+            f.write(line if line.endswith('\n') else line + '\n')
+            keyed = keyed and key is not None
+
+        return dict(self.config, format=self.format, start=self.start,
+                    partition=self.partition if keyed else [0, 1])
+
+
+def getfeeder(options):
+    """Returns a Feeder by the "feed" option, or None if there's no feed.
+    """
+
+    return None if options['feed'] is None else Feeder(options['feed'])
+
+
+def partitioned(options, part, parts):
+    """Returns the options for one of a number of parts, where the
+    partitions of the feed and the replay, if any, are split into as many
+    parts. Used to split them between the instances, and then their
+    processes.
+
+    The feed's partitions are byte ranges, so its parts are next to each
+    other. The replay's are hashes modulo the number of partitions, so its
+    parts are every count:th partition.
+    """
+
+    if options.get('feed') is not None:
+        first, count = options['feed'].get('partition', [0, 1])
+        options = dict(options, feed=dict(options['feed'],
+                                          partition=[first * parts + part,
+                                                     count * parts]))
+
+    if options.get('replay') is not None:
+        first, count = options['replay'].get('partition', [0, 1])
+        options = dict(options, replay=dict(options['replay'],
+                                            partition=[first + count * part,
+                                                       count * parts]))
+
+    return options
+
+
+def send(config, sess, history):
+    """Sends a request specified by a RequestTemplate, or config-dict:
+    {
+        "method": "POST",
+        "url": "https://some-host",
+        "header": { advanced-session-header-with-content-type },
+        "body": { some-data }
+    }
+    """
+
+    if type(config) is dict:
+        config = RequestTemplate(config)
+
+    method, url, headers, body = config.render(history)
+    req = Request(method, url, headers=headers, data=body)
+
+    return sess.send(sess.prepare_request(req))
+
+
+async def asyncsend(config, sess, history, marks=None):
+    """Same as send, but sends the request with an aiohttp.ClientSession and
+    returns a BufferedResponse. The session's traces put their marks into
+    the marks dict, if any.
+    """
+
+    if type(config) is dict:
+        config = RequestTemplate(config)
+
+    method, url, headers, body = config.render(history)
+
+    async with sess.request(method, url,
+                            headers=headers,
+                            data=body,
+                            trace_request_ctx=marks) as res:
+        content = await res.read()
+
+    if marks is not None:
+        marks['done'] = monotonic_ns()
+
+    return BufferedResponse(res.status, res.headers, content)
+
+
+class RequestsClient:
+    """HTTP client backend based on requests.Session.
+    Without reuse each request cycle gets a new session, and by that new
+    connections. With reuse the session and its connection pool are kept
+    between the cycles, and only the cookies are cleared.
+
+    Of the phases only ttfb, which includes any connecting, and download
+    are measured.
+    """
+
+    errors = (ConnectionError,)
+
+    def __init__(self, options):
+        self.reuse = options['reuse']
+        self.pool_size = options['pool_size'] or 10
+        self.phases = options['phases']
+        self.sess = None
+
+    def cycle(self):
+        """Prepares the client for a new request cycle.
+        """
+
+        if self.reuse and self.sess is not None:
+            self.sess.cookies.clear()
+            return
+
+        self.close()
+        self.sess = Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_size,
+                              pool_maxsize=self.pool_size)
+        self.sess.mount('http://', adapter)
+        self.sess.mount('https://', adapter)
+
+    def send(self, config, history, phases=None):
+        """Sends a request specified by a RequestTemplate, and measures its
+        phases into the phases dict, if any.
+        """
+
+        if phases is None:
+            return send(config, self.sess, history)
+
+        method, url, headers, body = config.render(history)
+        req = self.sess.prepare_request(Request(method, url,
+                                                headers=headers,
+                                                data=body))
+        starttime = monotonic_ns()
+        res = self.sess.send(req, stream=True)
+        headertime = monotonic_ns()
+        res.content
+        phases['ttfb'] = (headertime - starttime) // 1000
+        phases['download'] = (monotonic_ns() - headertime) // 1000
+
+        return res
+
+    def close(self):
+        if self.sess is not None:
+            self.sess.close()
+            self.sess = None
+
+
+class HttpClient:
+    """Low-level HTTP client backend based on http.client, with its own
+    connection pool, TLS session resumption and DNS cache.
+
+    Without reuse all connections are closed before each request cycle, so
+    every cycle has to connect again, like a new user. With tls_resumption
+    the TLS sessions are kept so that new connections can resume them. The
+    resolved addresses are cached for dns_ttl seconds.
+
+    It measures all phases. They're 0 when a pooled connection is used.
+
+    It doesn't handle cookies.
+    """
+
+    errors = (OSError, HTTPException)
+    # How a pooled connection, closed by the server while idle, fails before
+    # any response arrives, which is when the request is sent again
+    stale = (RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+    # Seconds to wait for connects and responses
+    timeout = 60
+
+    def __init__(self, options):
+        self.reuse = options['reuse']
+        self.pool_size = options['pool_size'] or 10
+        self.tls_resumption = options['tls_resumption']
+        self.dns_ttl = options['dns_ttl']
+        self.phases = options['phases']
+        self.context = ssl.create_default_context()
+        # Idle connections, TLS sessions and addresses indexed by host
+        self.idle = {}
+        self.sessions = {}
+        self.addresses = {}
+
+    def resolve(self, host, port):
+        """Returns a (cached) address for host and port.
+        """
+
+        key = (host, port)
+
+        if key in self.addresses and self.addresses[key][1] > time():
+            return self.addresses[key][0]
+
+        address = socket.getaddrinfo(host, port,
+                                     type=socket.SOCK_STREAM)[0][4][:2]
+
+        if self.dns_ttl:
+            self.addresses[key] = (address, time() + self.dns_ttl)
+
+        return address
+
+    def connect(self, scheme, host, port, phases):
+        """Returns a new connection, with a TLS session resumed if possible.
+        The time of each step is put into phases.
+        """
+
+        starttime = monotonic_ns()
+        address = self.resolve(host, port)
+        resolvedtime = monotonic_ns()
+        sock = socket.create_connection(address, self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connectedtime = monotonic_ns()
+
+        if scheme == 'https':
+            sock = self.context.wrap_socket(
+                sock,
+                server_hostname=host,
+                session=self.sessions.get((host, port))
+                if self.tls_resumption else None)
+
+            if self.tls_resumption:
+                self.sessions[(host, port)] = sock.session
+
+        phases['dns'] = (resolvedtime - starttime) // 1000
+        phases['connect'] = (connectedtime - resolvedtime) // 1000
+        phases['tls'] = (monotonic_ns() - connectedtime) // 1000
+
+        conn = HTTPConnection(host, port, timeout=self.timeout)
+        conn.sock = sock
+
+        return conn
+
+    def cycle(self):
+        """Prepares the client for a new request cycle.
+        """
+
+        if not self.reuse:
+            self.close()
+
+    def send(self, config, history, phases=None):
+        """Sends a request specified by a RequestTemplate and returns a
+        BufferedResponse. A pooled connection which turns out to be closed,
+        before any response arrives, is replaced by a new one. Any other
+        error is raised, so that no request is sent twice once it may have
+        been handled. The phases are measured into the phases dict, if any.
+        """
+
+        if phases is None:
+            phases = {}
+
+        method, url, headers, body = config.render(history)
+        parts = urlsplit(url)
+        scheme = parts.scheme
+        port = parts.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parts.hostname, port)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        idle = self.idle.setdefault(key, [])
+
+        while True:
+            pooled = len(idle) > 0
+
+            if pooled:
+                conn = idle.pop()
+                phases['dns'] = phases['connect'] = phases['tls'] = 0
+            else:
+                conn = self.connect(scheme, parts.hostname, port, phases)
+
+            try:
+                starttime = monotonic_ns()
+                conn.request(method, path, body=body, headers=headers or {})
+                res = conn.getresponse()
+                break
+            except self.stale:
+                conn.close()
+
+                if not pooled:
+                    raise
+            except self.errors:
+                conn.close()
+                raise
+
+        try:
+            headertime = monotonic_ns()
+            content = res.read()
+        except self.errors:
+            conn.close()
+            raise
+
+        phases['ttfb'] = (headertime - starttime) // 1000
+        phases['download'] = (monotonic_ns() - headertime) // 1000
+
+        if res.will_close or len(idle) >= self.pool_size:
+            conn.close()
+        else:
+            idle.append(conn)
+
+        return BufferedResponse(res.status,
+                                CaseInsensitiveDict(res.getheaders()),
+                                content)
+
+    def close(self):
+        for idle in self.idle.values():
+            for conn in idle:
+                conn.close()
+
+        self.idle = {}
+
+        if not self.tls_resumption:
+            self.sessions = {}
+
+
+class AiohttpClient:
+    """HTTP client backend for the async engine, based on aiohttp.
+    Each request cycle gets its own aiohttp.ClientSession, and cookies.
+    With reuse all sessions share one connection pool that's kept between
+    the cycles, otherwise each session gets a new pool. The pool keeps at
+    most pool_size connections per host, and the resolved addresses are
+    cached for dns_ttl seconds.
+
+    The phases are measured by tracing the sessions, where connect includes
+    the TLS handshake.
+    """
+
+    def __init__(self, options):
+        if aiohttp is None:
+            raise ImportError('The aiohttp client requires the aiohttp module')
+
+        # A response cut off, or aiohttp's total timeout, fails only its
+        # request, like a failed connection
+        self.errors = (aiohttp.ClientError, asyncio.TimeoutError)
+        self.reuse = options['reuse']
+        self.pool_size = options['pool_size'] or 0
+        self.dns_ttl = options['dns_ttl']
+        self.phases = options['phases']
+        self.connector = None
+        self.traces = [self.trace()] if self.phases else []
+
+    def trace(self):
+        """Returns an aiohttp.TraceConfig which measures the phases into the
+        dict passed as a request's trace_request_ctx.
+        """
+
+        def mark(name):
+            async def marker(session, context, params):
+                if context.trace_request_ctx is not None:
+                    context.trace_request_ctx[name] = monotonic_ns()
+
+            return marker
+
+        async def reused(session, context, params):
+            if context.trace_request_ctx is not None:
+                context.trace_request_ctx['reused'] = True
+
+        trace = aiohttp.TraceConfig()
+        trace.on_dns_resolvehost_start.append(mark('dnsstart'))
+        trace.on_dns_resolvehost_end.append(mark('dnsend'))
+        trace.on_connection_create_start.append(mark('connectstart'))
+        trace.on_connection_create_end.append(mark('connectend'))
+        trace.on_connection_reuseconn.append(reused)
+        trace.on_request_headers_sent.append(mark('sent'))
+        trace.on_request_end.append(mark('headers'))
+
+        return trace
+
+    def measure(self, marks, phases):
+        """Puts the phases measured from the traced marks into phases.
+        """
+
+        if marks.get('reused'):
+            phases['dns'] = phases['connect'] = 0
+        elif 'connectend' in marks:
+            dns = marks['dnsend'] - marks['dnsstart'] \
+                if 'dnsend' in marks else 0
+            phases['dns'] = dns // 1000
+            phases['connect'] = (marks['connectend'] - marks['connectstart'] -
+                                 dns) // 1000
+
+        if 'headers' in marks:
+            phases['ttfb'] = (marks['headers'] - marks['sent']) // 1000
+            phases['download'] = (marks['done'] - marks['headers']) // 1000
+
+    def connect(self):
+        return aiohttp.TCPConnector(limit=0,
+                                    limit_per_host=self.pool_size,
+                                    use_dns_cache=bool(self.dns_ttl),
+                                    ttl_dns_cache=self.dns_ttl or None)
+
+    def session(self):
+        """Returns a new aiohttp.ClientSession for a request cycle.
+        """
+
+        if not self.reuse:
+            return aiohttp.ClientSession(connector=self.connect(),
+                                         trace_configs=self.traces)
+
+        if self.connector is None:
+            self.connector = self.connect()
+
+        return aiohttp.ClientSession(connector=self.connector,
+                                     connector_owner=False,
+                                     trace_configs=self.traces)
+
+    async def close(self):
+        if self.connector is not None:
+            await self.connector.close()
+            self.connector = None
+
+
+# HTTP client backends by name
+CLIENTS = {'requests': RequestsClient,
+           'http': HttpClient,
+           'aiohttp': AiohttpClient}
+
+
+def clientdefaults(client, engine):
+    """Setting default data to the client option and returns it.
+    The default backend depends on the engine.
+    """
+
+    defaults = {'backend': 'requests' if engine == 'process' else 'aiohttp',
+                'reuse': False,
+                'pool_size': None,
+                'tls_resumption': False,
+                'dns_ttl': 10,
+                'phases': False}
+
+    if client is None:
+        client = {}
+
+    for key, val in defaults.items():
+        if key not in client:
+            client[key] = val
+
+    if client['backend'] not in CLIENTS:
+        raise ValueError('No client with name "{}"'.format(client['backend']))
+
+    if (client['backend'] == 'aiohttp') != (engine != 'process'):
+        raise ValueError('The client "{}" can\'t be used by the engine "{}"'
+                         .format(client['backend'], engine))
+
+    return client
+
+
+def getclient(options, engine):
+    """Creates the HTTP client backend specified by the "client" option, for
+    the engine which runs it.
+    """
+
+    client = clientdefaults(options['client'], engine)
+
+    return CLIENTS[client['backend']](client)
+
+
+def singlerepeater(repeat, writer, config, options=None, control=None):
+    """A request repeater. It runs through the request config x times,
+    where x is repeat, or until stopped by control or the feed runs out.
+
+    It'll prepare the client for each repeat.
+    """
+
+    config = compileconfig(config)
+    options = optiondefaults(options)
+    client = getclient(options, 'process')
+    feeder = getfeeder(options)
+    row = None
+
+    if control is None:
+        control = Control()
+
+    out = openwriter(writer, options, config)
+    out.wait()
+    stopped = Event()
+    probe = Thread(target=lagprobe, args=(out, stopped), daemon=True)
+    probe.start()
+
+    for ci in range(0, repeat):
+        if feeder is not None:
+            row = feeder.cycle(row)
+
+            if row is None:
+                break
+
+        client.cycle()
+
+        if not singlecycle(ci, out, config, client, control, row):
+            break
+
+    stopped.set()
+    probe.join()
+    client.close()
+    out.close()
+
+
+def singlecycle(ci, out, config, client, control, row=None):
+    """Runs through the request config once, as cycle number ci, with a new
+    history record, which starts with the row from the feed, if any. Returns
+    False if stopped by control.
+    """
+
+    history = {} if row is None else {None: row}
+    ri = 0
+
+    for req in config:
+        for rri in range(req.repeat):
+            if control.state.value and control.hold():
+                return False
+
+            phases = {} if client.phases else None
+            res = None
+            out.pending(1)
+            starttime = microsec()
+
+            try:
+                res = client.send(req, history, phases)
+                status = res.status_code
+                extracted = req.extract(res, rri)
+
+                if extracted is not None:
+                    history[str(ri)] = extracted
+
+                    if req.name is not None:
+                        history[req.name] = extracted
+            except client.errors as e:
+                status = 'connection-error'
+
+            endtime = microsec()
+
+            if req.expect is not None:
+                out.expect(ri,
+                           req.expect.check(status,
+                                            endtime - starttime,
+                                            res),
+                           endtime)
+
+            if phases is None:
+                out.write(ci,
+                          ri,
+                          rri,
+                          status,
+                          starttime,
+                          endtime)
+            else:
+                out.write(ci,
+                          ri,
+                          rri,
+                          status,
+                          starttime,
+                          endtime,
+                          starttime,
+                          *[phases.get(phase, -1) for phase in PHASES])
+
+            ri += 1
+
+    return True
+
+
+async def asynccycle(ci, out, config, client, control, intended=None,
+                     row=None):
+    """Runs through the request config once, as cycle number ci.
+    It'll create a new aiohttp.ClientSession, by the client, and history
+    record for the cycle, which starts with the row from the feed, if any.
+    Returns False if stopped by control.
+
+    If intended is set - the time in microseconds when the cycle was
+    scheduled to start - it's written as an extra column after the end time.
+    The following requests in the cycle are intended to start when the
+    previous one ended. With the client's phases the start time is written
+    as intended, if not set, followed by the phases.
+    """
+
+    async with client.session() as sess:
+        history = {} if row is None else {None: row}
+        ri = 0
+
+        for req in config:
+            for rri in range(req.repeat):
+                if control.state.value and await control.asynchold():
+                    return False
+
+                marks = {} if client.phases else None
+                res = None
+                out.pending(1)
+                starttime = microsec()
+
+                try:
+                    res = await asyncsend(req, sess, history, marks)
+                    status = res.status_code
+                    extracted = req.extract(res, rri)
+
+                    if extracted is not None:
+                        history[str(ri)] = extracted
+
+                        if req.name is not None:
+                            history[req.name] = extracted
+                except client.errors as e:
+                    status = 'connection-error'
+
+                endtime = microsec()
+
+                if req.expect is not None:
+                    out.expect(ri,
+                               req.expect.check(status,
+                                                endtime - starttime,
+                                                res),
+                               endtime)
+
+                if marks is not None:
+                    phases = {}
+                    client.measure(marks, phases)
+                    out.write(ci,
+                              ri,
+                              rri,
+                              status,
+                              starttime,
+                              endtime,
+                              starttime if intended is None else intended,
+                              *[phases.get(phase, -1) for phase in PHASES])
+
+                    if intended is not None:
+                        intended = endtime
+                elif intended is None:
+                    out.write(ci,
+                              ri,
+                              rri,
+                              status,
+                              starttime,
+                              endtime)
+                else:
+                    out.write(ci,
+                              ri,
+                              rri,
+                              status,
+                              starttime,
+                              endtime,
+                              intended)
+                    intended = endtime
+
+                ri += 1
+
+    return True
+
+
+async def asyncsinglerepeater(repeat, out, config, client, control,
+                              feeder=None):
+    """The coroutine version of singlerepeater. It's one virtual user within
+    an event loop and writes to an output writer, and takes rows from a
+    feeder, shared with the other users.
+    """
+
+    row = None
+
+    for ci in range(0, repeat):
+        if feeder is not None:
+            row = feeder.cycle(row)
+
+            if row is None:
+                break
+
+        if not await asynccycle(ci, out, config, client, control, row=row):
+            break
+
+
+def asyncrepeater(users, repeat, writer, config, options=None, control=None):
+    """Runs x asyncsinglerepeaters as coroutines within one event loop, where
+    x is users. All users share the same output writer and client.
+    """
+
+    if aiohttp is None:
+        raise ImportError('The async engine requires the aiohttp module')
+
+    config = compileconfig(config)
+    options = optiondefaults(options)
+    client = getclient(options, 'async')
+    feeder = getfeeder(options)
+
+    if control is None:
+        control = Control()
+
+    out = openwriter(writer, options, config)
+    out.wait()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    probe = loop.create_task(asynclagprobe(out))
+    loop.run_until_complete(asyncio.gather(
+        *[asyncsinglerepeater(repeat, out, config, client, control, feeder)
+          for u in range(users)]))
+    probe.cancel()
+    loop.run_until_complete(asyncio.gather(probe, return_exceptions=True))
+    loop.run_until_complete(client.close())
+    loop.close()
+
+    out.close()
+
+
+def arrivals(stages, rate=0, share=1, phase=0):
+    """Yields the time in seconds, from start, of each scheduled arrival.
+    Each stage changes the rate linearly from the previous rate to its target
+    during its duration:
+        [{"duration": 30, "target": 100}, ...]
+
+    The share is how large part of the rate to schedule and the phase, 0 to
+    1, shifts the arrivals. It's used to interleave schedulers in different
+    processes.
+    """
+
+    offset = 0
+    count = 0
+    k = phase
+
+    for stage in stages:
+        start, target = rate * share, stage['target'] * share
+        duration = stage['duration']
+        total = (start + target) / 2 * duration
+
+        while duration > 0 and k < count + total:
+            # Solve the arrival's time t within the stage from:
+            # k - count = start * t + (target - start) * t^2 / (2 * duration)
+            x = k - count
+            a = (target - start) / (2 * duration)
+
+            if a == 0:
+                t = x / start
+            else:
+                t = (-start + math.sqrt(max(start ** 2 + 4 * a * x, 0))) / \
+                    (2 * a)
+
+            yield offset + t
+            k += 1
+
+        count += total
+        offset += duration
+        rate = stage['target']
+
+
+class Timetable:
+    """A timetable of times in seconds from its start, which runs at the
+    control's rate factor times speed, and stands still while paused.
+    """
+
+    def __init__(self, out, control, speed=1):
+        self.out = out
+        self.control = control
+        self.speed = speed
+        # When, in microseconds, the timetable was at position, in seconds
+        self.anchor = microsec()
+        self.position = 0
+        self.factor = control.factor.value * speed
+
+    async def wait(self, offset):
+        """Waits until the time offset, and returns when it was intended to
+        be, in microseconds, or None if stopped by control. How late it
+        wakes up is sampled as lag.
+        """
+
+        control = self.control
+        slept = False
+
+        while True:
+            if control.state.value:
+                paused = microsec()
+
+                if await control.asynchold():
+                    break
+
+                self.anchor += microsec() - paused
+
+            if control.factor.value * self.speed != self.factor:
+                now = microsec()
+                self.position += (now - self.anchor) / 1000000 * self.factor
+                self.anchor = now
+                self.factor = control.factor.value * self.speed
+
+            intended = self.anchor + \
+                int((offset - self.position) / self.factor * 1000000)
+            delay = (intended - microsec()) / 1000000
+
+            if delay <= 0:
+                break
+
+            # Wake up in time to notice any commands
+            await asyncio.sleep(min(delay, control.interval))
+            slept = True
+
+        if control.state.value == Control.STOP:
+            return None
+
+        if slept:
+            self.out.late(max(microsec() - intended, 0))
+
+        return intended
+
+
+async def asyncscheduler(users, out, config, client, rate, share, phase,
+                         control, feeder=None):
+    """Open-loop scheduler. Starts request cycles on the rate's timetable,
+    no matter how long the previous cycles took.
+    At most x cycles are running at the same time, where x is users. Cycles
+    that have to wait for a free user still record when they were intended to
+    start.
+
+    The Timetable runs at the control's rate factor, and stands still while
+    paused. The cycles waiting for a free user are counted as pending.
+
+    Every cycle takes a new row from the feeder, if any, whatever its scope,
+    and the scheduling stops when the rows run out.
+
+    If a cycle raises, the scheduling stops and, once the running cycles are
+    done, the exception is raised.
+    """
+
+    semaphore = asyncio.Semaphore(users)
+    running = set()
+    timetable = Timetable(out, control)
+
+    # Exceptions of the cycles, which stop the scheduling
+    failed = []
+
+    def done(task):
+        running.discard(task)
+        semaphore.release()
+
+        if not task.cancelled() and task.exception() is not None:
+            failed.append(task.exception())
+
+    for ci, offset in enumerate(arrivals(rate['stages'],
+                                         rate['start'],
+                                         share,
+                                         phase)):
+        intended = await timetable.wait(offset)
+
+        if intended is None or failed:
+            break
+
+        row = None if feeder is None else feeder.next()
+
+        if feeder is not None and row is None:
+            break
+
+        out.pending(1)
+        await semaphore.acquire()
+        out.pending(-1)
+
+        task = asyncio.ensure_future(asynccycle(
+            ci, out, config, client, control, intended, row))
+        task.add_done_callback(done)
+        running.add(task)
+
+    if running:
+        await asyncio.wait(running)
+
+    if failed:
+        raise failed[0]
+
+
+def raterepeater(users, writer, config, rate, share, phase, options=None,
+                 control=None):
+    """Runs an asyncscheduler within its own event loop.
+    """
+
+    if aiohttp is None:
+        raise ImportError('The async engine requires the aiohttp module')
+
+    config = compileconfig(config)
+    options = optiondefaults(options)
+    client = getclient(options, 'async')
+
+    if control is None:
+        control = Control()
+
+    out = openwriter(writer, options, config)
+    out.wait()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    probe = loop.create_task(asynclagprobe(out))
+    loop.run_until_complete(asyncscheduler(users, out, config, client,
+                                           rate, share, phase, control,
+                                           getfeeder(options)))
+    probe.cancel()
+    loop.run_until_complete(asyncio.gather(probe, return_exceptions=True))
+    loop.run_until_complete(client.close())
+    loop.close()
+
+    out.close()
+
+
+async def asyncreplayer(users, out, replay, client, control):
+    """Replays the requests of a Replay on its timetable, each one as a
+    request cycle of its own, numbered by its line in the file. Like the
+    asyncscheduler at most x requests are running at the same time, where x
+    is users, and every row records when its request was intended to start.
+    Like the asyncscheduler it stops, and raises, if a request cycle raises.
+    """
+
+    semaphore = asyncio.Semaphore(users)
+    running = set()
+    timetable = Timetable(out, control, replay.speed)
+
+    # Exceptions of the cycles, which stop the scheduling
+    failed = []
+
+    def done(task):
+        running.discard(task)
+        semaphore.release()
+
+        if not task.cancelled() and task.exception() is not None:
+            failed.append(task.exception())
+
+    for offset, ci, request in replay:
+        intended = await timetable.wait(offset)
+
+        if intended is None or failed:
+            break
+
+        config = compileconfig(configdefaults([request]))
+        out.pending(1)
+        await semaphore.acquire()
+        out.pending(-1)
+
+        task = asyncio.ensure_future(asynccycle(
+            ci, out, config, client, control, intended))
+        task.add_done_callback(done)
+        running.add(task)
+
+    if running:
+        await asyncio.wait(running)
+
+    if failed:
+        raise failed[0]
+
+
+def replayrepeater(users, writer, options=None, control=None):
+    """Runs an asyncreplayer, by the "replay" option, within its own event
+    loop.
+    """
+
+    if aiohttp is None:
+        raise ImportError('The async engine requires the aiohttp module')
+
+    options = optiondefaults(options)
+    client = getclient(options, 'async')
+    replay = Replay(options['replay'])
+
+    if control is None:
+        control = Control()
+
+    # Any replayed request may expect something
+    out = openwriter(writer, options, expect=True)
+    out.wait()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    probe = loop.create_task(asynclagprobe(out))
+    loop.run_until_complete(asyncreplayer(users, out, replay, client,
+                                          control))
+    probe.cancel()
+    loop.run_until_complete(asyncio.gather(probe, return_exceptions=True))
+    loop.run_until_complete(client.close())
+    loop.close()
+
+    out.close()
+
+
+def ratedefaults(rate, config):
+    """Setting default data to the rate option and returns it.
+    A rate in requests per second is converted to cycles per second.
+    """
+
+    defaults = {'unit': 'cycles',
+                'start': 0,
+                'stages': []}
+
+    for key, val in defaults.items():
+        if key not in rate:
+            rate[key] = val
+
+    if rate['unit'] == 'requests':
+        requests = sum([int(req['repeat']) for req in config])
+        rate['start'] = rate['start'] / requests
+        rate['stages'] = [dict(stage, target=stage['target'] / requests)
+                          for stage in rate['stages']]
+        rate['unit'] = 'cycles'
+    elif rate['unit'] != 'cycles':
+        raise ValueError('No rate unit with name "{}"'.format(rate['unit']))
+
+    return rate
+
+
+def spread(count, buckets):
+    """Spreads count as evenly as possible over x buckets.
+    """
+
+    return [count // buckets + (1 if i < count % buckets else 0)
+            for i in range(buckets)]
+
+
+def processcount(concurrency, options):
+    """Returns how many processes multirepeater will start.
+    """
+
+    if options['rate'] is not None or options['replay'] is not None or \
+       options['engine'] == 'async':
+        return min(cpu_count(), concurrency)
+
+    return concurrency
+
+
+def multirepeater(concurrency, repeat, writer, requestconfig, options=None,
+                  control=None):
+    """Setting up multiple singlerepeaters by threading for true concurrency.
+
+    With the "async" engine there will only be one process per core, and the
+    concurrency is spread over them as coroutines.
+
+    With the "rate" option the request cycles are started on a fixed
+    timetable instead, and the concurrency is the maximum number of
+    simultaneous cycles. With the "replay" option the requests of a file are
+    replayed on their original timetable the same way, instead of the
+    request config.
+
+    All processes share the control, and if the writer class can listen for
+    control commands it does so while they're running. The feed and the
+    replay, if any, are partitioned between the processes.
+    """
+
+    config = configdefaults(requestconfig)
+    options = optiondefaults(options)
+
+    if control is None:
+        control = Control()
+
+    if options['rate'] is not None:
+        rate = ratedefaults(options['rate'], config)
+
+    # Validate the client before the processes are forked
+    options['client'] = clientdefaults(
+        options['client'],
+        'async' if options['rate'] is not None or
+        options['replay'] is not None else options['engine'])
+
+    # Compile the request config once, before the processes are forked
+    config = compileconfig(config)
+
+    if options['replay'] is not None:
+        # Open-loop replay mode. It's always run by the async engine and
+        # repeat is not used since the file defines the length.
+        cores = processcount(concurrency, options)
+        processes = [Process(target=replayrepeater,
+                             args=(users, writer,
+                                   partitioned(options, i, cores), control))
+                     for i, users in enumerate(spread(concurrency, cores))]
+    elif options['rate'] is not None:
+        # Open-loop, rate driven, mode. It's always run by the async engine
+        # and repeat is not used since the stages defines the length.
+        cores = processcount(concurrency, options)
+        processes = [Process(target=raterepeater,
+                             args=(users, writer, config,
+                                   rate, 1 / cores, i / cores,
+                                   partitioned(options, i, cores), control))
+                     for i, users in enumerate(spread(concurrency, cores))]
+    elif options['engine'] == 'process':
+        processes = [Process(target=singlerepeater,
+                             args=(repeat, writer, config,
+                                   partitioned(options, x, concurrency),
+                                   control))
+                     for x in range(concurrency)]
+    elif options['engine'] == 'async':
+        cores = processcount(concurrency, options)
+        processes = [Process(target=asyncrepeater,
+                             args=(users, repeat, writer, config,
+                                   partitioned(options, i, cores), control))
+                     for i, users in enumerate(spread(concurrency, cores))]
+    else:
+        raise ValueError('No engine with name "{}"'.format(options['engine']))
+
+    for p in processes:
+        p.start()
+
+    if hasattr(writer[0], 'listen'):
+        Thread(target=writer[0].listen,
+               args=(writer[1], control),
+               daemon=True).start()
 
     for p in processes:
         p.join()
@@ -277,15 +2759,18 @@ if __name__ == '__main__':
             'repeat and requests.')
         sys.exit(2)
 
-    if len(sys.argv) > 4:
-        # Arguments: rabbitmq url, concurrency, repeat and requests file
+    if not sys.argv[1].isdigit():
+        # Arguments: rabbitmq url, concurrency, repeat, requests file
+        # and optional options
         multirepeater(int(sys.argv[2]),
                       int(sys.argv[3]),
                       (RabbitWriter, sys.argv[1]),
-                      json.loads(sys.argv[4]))
+                      json.loads(sys.argv[4]),
+                      json.loads(sys.argv[5]) if len(sys.argv) > 5 else None)
     else:
-        # Arguments: concurrency, repeat and requests file
+        # Arguments: concurrency, repeat, requests file and optional options
         multirepeater(int(sys.argv[1]),
                       int(sys.argv[2]),
-                      (CsvWriter, sys.stdout.write),
-                      json.loads(sys.argv[3]))
+                      (CsvWriter, sys.stdout),
+                      json.loads(sys.argv[3]),
+                      json.loads(sys.argv[4]) if len(sys.argv) > 4 else None)